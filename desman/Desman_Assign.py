@@ -0,0 +1,156 @@
+import sys, getopt
+import os
+import numpy as np
+import logging
+import multiprocessing
+
+from numpy import log
+from numpy.random import RandomState
+
+#user defined modules
+from . import Desman_Utils as du
+from . import Init_NMFT as inmft
+from . import HaploSNP_Sampler as hsnp
+
+#C code for tau sampling
+import sampletau
+
+#per worker process state set by init_worker
+_worker = {}
+
+#Init_NMFT default stopping change in divergence for all not selected positions
+NTF_MIN_CHANGE = 1.0e-5
+
+def init_worker(description, ns_mask, gamma, gamma_store, eta_store, gamma_mean, eta_mean, no_iter, precision):
+    sampletau.initRNG()
+
+    (shm, snps) = du.attach_array(description)
+    _worker['segment'] = shm
+    _worker['snps'] = snps
+    _worker['ns_mask'] = ns_mask
+    _worker['n_ns'] = np.sum(ns_mask)
+    _worker['gamma'] = gamma
+    _worker['gamma_store'] = gamma_store
+    _worker['eta_store'] = eta_store
+    _worker['gamma_mean'] = gamma_mean
+    _worker['eta_mean'] = eta_mean
+    _worker['no_iter'] = no_iter
+    _worker['precision'] = precision
+
+def assign_chunk(task):
+    """Samples tau for the not selected positions in rows start to end of the
+    original filtered variants with gamma and eta taken from the stored traces"""
+    (start, end, seed) = task
+    snps = np.copy(_worker['snps'][start:end][_worker['ns_mask'][start:end]],order='C')
+    if snps.shape[0] == 0:
+        return (start, end, None, None, None, None)
+
+    G = _worker['gamma'].shape[1]
+    prng = RandomState(seed)
+    sampletau.setRNG(seed)
+
+    #divergence sums over positions so each chunk stops at its share of the serial change
+    min_change = NTF_MIN_CHANGE*snps.shape[0]/_worker['n_ns']
+    init_NMFT_NS = inmft.Init_NMFT(snps,G,prng,min_change=min_change,precision=_worker['precision'])
+    init_NMFT_NS.gamma = np.transpose(_worker['gamma'])
+    init_NMFT_NS.factorize_tau()
+
+    #only tau is stored so stores are compact
+    haplo_SNP_NS = hsnp.HaploSNP_Sampler(snps,G,prng,max_iter=_worker['no_iter'],store='compact',precision=_worker['precision'])
+
+    haplo_SNP_NS.tau = init_NMFT_NS.get_tau()
+    haplo_SNP_NS.updateTauIndices()
+    haplo_SNP_NS.gamma_star = _worker['gamma_mean']
+    haplo_SNP_NS.eta_star = _worker['eta_mean']
+    haplo_SNP_NS.gamma_store = _worker['gamma_store']
+    haplo_SNP_NS.eta_store = _worker['eta_store']
+
+    haplo_SNP_NS.updateTau()
+    haplo_SNP_NS.updateTau()
+
+    #log likelihood of this chunk of the collated tau star at every stored gamma and eta
+    ll_star = np.array([haplo_SNP_NS.logLikelihood(haplo_SNP_NS.gamma_store[i],haplo_SNP_NS.tau_star,haplo_SNP_NS.eta_store[i])
+                        for i in range(haplo_SNP_NS.gamma_store.shape[0])])
+
+    return (start, end, haplo_SNP_NS.tau_star, haplo_SNP_NS.probabilisticTau(), ll_star, haplo_SNP_NS.ll_store)
+
+def log_prior(haplo_SNP, cGamma, cEta):
+    """Dirichlet prior terms of HaploSNP_Sampler.logPosterior"""
+    logPrior = 0.0
+    for s in range(haplo_SNP.S):
+        logPrior += du.log_dirichlet_pdf(cGamma[s,:], haplo_SNP.alpha)
+
+    for a in range(4):
+        logPrior += du.log_dirichlet_pdf(cEta[a,:], haplo_SNP.delta)
+
+    return logPrior
+
+def assign_not_selected(output_Results, haplo_SNP, variant_Filter, variants, genomes, no_iter, workers, chunk_size=10000, precision='float64'):
+    """Assigns tau to the positions left out by random selection. As gamma and eta are
+    fixed from the stored traces positions are independent, so blocks of chunk_size
+    original filtered positions are sampled on a process pool, each with its own seed
+    drawn from haplo_SNP.randomState, and the collated tau files are written block by
+    block in position order without holding all positions in memory. 
+    
+    Every block samples iteration i with the same stored gamma and eta so the summed 
+    block log likelihoods at i are those of one joint state and give the mean deviance. 
+    Tau star is chosen per block though, so the log posterior written is evaluated at 
+    the collated tau star, the maximum over the stored gamma and eta"""
+
+    snps_original = variant_Filter.snps_filter_original
+    indices_original = np.asarray(variant_Filter.selected_indices_original)
+    selected_mask = variant_Filter.selected[indices_original]
+    ns_mask = selected_mask != True
+    #row of haplo_SNP for each selected original position
+    selected_rows = np.cumsum(selected_mask) - 1
+
+    N = snps_original.shape[0]
+    starts = list(range(0, N, chunk_size))
+    seeds = haplo_SNP.randomState.randint(np.iinfo(np.int32).max, size=len(starts))
+    tasks = [(start, min(start + chunk_size, N), seed) for (start, seed) in zip(starts, seeds)]
+
+    tau_star = haplo_SNP.tau_star
+    pTau = haplo_SNP.probabilisticTau()
+    G = haplo_SNP.G
+
+    fit = {'ll_store' : np.zeros(haplo_SNP.max_iter), 'll_star' : np.zeros(haplo_SNP.max_iter)}
+
+    def collate(results):
+        for (start, end, tau_NS, pTau_NS, ll_star, ll_store) in results:
+            selected = selected_mask[start:end]
+
+            collateTau = np.zeros((end - start,G,4), dtype=np.int)
+            collatePTau = np.zeros((end - start,G,4))
+            collateTau[selected] = tau_star[selected_rows[start:end][selected]]
+            collatePTau[selected] = pTau[selected_rows[start:end][selected]]
+
+            if tau_NS is not None:
+                collateTau[~selected] = tau_NS
+                collatePTau[~selected] = pTau_NS
+                fit['ll_store'] += ll_store
+                fit['ll_star'] += ll_star
+
+            yield (indices_original[start:end], collateTau, collatePTau)
+
+    workers = max(1, min(workers, len(tasks)))
+    logging.info('Assign %d not selected variant positions in %d chunks on %d workers' % (np.sum(ns_mask), len(tasks), workers))
+
+    (shm, description) = du.share_array(snps_original)
+    try:
+        pool = multiprocessing.Pool(processes=workers, initializer=init_worker,
+                                    initargs=(description, ns_mask, haplo_SNP.gamma, haplo_SNP.gamma_store, haplo_SNP.eta_store,
+                                              haplo_SNP.gammaMean(), haplo_SNP.etaMean(), no_iter, precision))
+        try:
+            output_Results.output_collated_Tau_chunks(collate(pool.imap(assign_chunk, tasks)), variants)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shm.close()
+        shm.unlink()
+
+    #positions are independent given gamma and eta so chunk log likelihoods add
+    prior = np.array([log_prior(haplo_SNP, haplo_SNP.gamma_store[i], haplo_SNP.eta_store[i]) for i in range(haplo_SNP.max_iter)])
+    lp_star = np.max(fit['ll_star'] + prior) + np.sum(ns_mask)*G*log(1.0/4.0)
+
+    output_Results.outPredFitStats(genomes, G, lp_star, -2.0*np.mean(fit['ll_store']))
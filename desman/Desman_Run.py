@@ -0,0 +1,331 @@
+import sys, getopt
+import os
+import pandas as p
+import numpy as np
+import logging
+import multiprocessing
+import hashlib
+
+from numpy.random import RandomState
+
+#user defined modules
+from . import Variant_Filter as vf
+from . import Init_NMFT as inmft
+from . import HaploSNP_Sampler as hsnp
+from . import HaploSNP_EM as hem
+from . import Output_Results as outr
+from . import Desman_Utils as du
+from . import Desman_Assign as dassign
+from . import Phase_Timer as pt
+
+#C code for tau sampling
+import sampletau
+
+def reset_logging():
+    """Removes root handlers so the next Output_Results can open its own log file"""
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+        handler.close()
+
+#bump when the cached filter state changes
+FILTER_CACHE_VERSION = 1
+
+def filter_key(args):
+    """Hex sha256 of the variant file contents and the arguments that change the filter"""
+    digest = hashlib.sha256()
+    with open(args.variant_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    
+    parameters = (FILTER_CACHE_VERSION, args.filter_variants, args.optimiseP, args.min_coverage, args.max_qvalue, args.min_variant_freq)
+    digest.update(repr(parameters).encode())
+    
+    return digest.hexdigest()
+
+def read_filter(args):
+    """Reads the variants and runs filter_variants, with args.filter_cache set the table 
+    and applied filter are loaded from, or written to, a subdirectory of it named by 
+    filter_key so changed inputs or parameters never reuse a stale filter"""
+    if args.filter_cache is None:
+        variants = p.read_csv(args.variant_file, header=0, index_col=0)
+        return (variants,) + filter_variants(variants, args)
+    
+    cache_dir = os.path.join(args.filter_cache, filter_key(args))
+    if os.path.isdir(cache_dir):
+        logging.info('Loading variants and filter from cache %s' % cache_dir)
+        (variants, variant_Filter) = vf.load_filter(cache_dir)
+        logging.info('Running Desman with %d samples and %d variant positions.' %(variant_Filter.S,variant_Filter.V))
+    else:
+        variants = p.read_csv(args.variant_file, header=0, index_col=0)
+        variant_Filter = apply_filter(variants, args)
+        logging.info('Writing variants and filter to cache %s' % cache_dir)
+        vf.save_filter(cache_dir, variants, variant_Filter)
+    
+    return (variants,) + filter_variants(variants, args, variant_Filter)
+
+def apply_filter(variants, args):
+    """Constructs the variant filter and applies likelihood ratio filtering if -f"""
+    filter_variants = args.filter_variants
+
+    #create new random state with fixed seed
+    logging.info('Set fixed seed for random position selection = 238329')
+    prng = RandomState(238329)
+
+    #construct variant filter to only select most likely SNPS
+    variant_Filter = vf.Variant_Filter(variants, randomState = prng, optimise = args.optimiseP, threshold = filter_variants, min_coverage = args.min_coverage, qvalue_cutoff = args.max_qvalue)
+    if variant_Filter.S < 1 or variant_Filter.V < 1:
+        logging.error('Not enough samples with minimum coverage %d or variant positions %d. Exiting!'%(variant_Filter.S,variant_Filter.V))
+        sys.exit(-1)
+
+    logging.info('Running Desman with %d samples and %d variant positions.' %(variant_Filter.S,variant_Filter.V))
+
+    #perform variant filtering if -f selected
+    if filter_variants is not None:
+        logging.info('Begun filtering variants with parameters: optimise probability = %s, lr threshold = %s, min. coverage = %s, q-value threshold = %s, min. variant frequency = %s'
+                     % (args.optimiseP, filter_variants, args.min_coverage, args.max_qvalue, args.min_variant_freq))
+
+        variant_Filter.get_filtered_VariantsLogRatio(workers = args.filter_workers)
+
+        logging.info("Completed variant filtering")
+
+    return variant_Filter
+
+def filter_variants(variants, args, variant_Filter=None):
+    """Applies the eta file and random selection to variant_Filter, constructed and 
+    filtered by apply_filter if not given, returning the filter and the effective 
+    random selection size"""
+    random_select = args.random_select
+    eta_file = args.eta_file
+
+    if variant_Filter is None:
+        variant_Filter = apply_filter(variants, args)
+
+    #set eta transition matrix if file provided
+    if eta_file is not None:
+        logging.info('Set eta error transition matrix from = %s' % eta_file)
+        eta_df = p.read_csv(eta_file, header=0, index_col=0)
+        variant_Filter.eta = eta_df.values
+
+    if random_select is not None:
+        if random_select < variant_Filter.V:
+            logging.info('Selected %d random variant positions to infer haplotypes from' % random_select)
+            variant_Filter.select_Random(random_select)
+        else:
+            logging.info('Not enough variable positions for random selection %d >= %d using all' % (random_select,variant_Filter.V))
+            random_select = None
+
+    return (variant_Filter, random_select)
+
+def split_strain(tau, gamma, genomes):
+    """Adds strains to a converged solution until it has genomes strains by repeatedly
+    copying the tau of the strain with highest gamma variance across samples and halving its gamma"""
+    tau = np.copy(tau)
+    gamma = np.copy(gamma)
+
+    while tau.shape[1] < genomes:
+        g = np.argmax(np.var(gamma,axis=0))
+
+        tau = np.concatenate((tau,tau[:,g:g+1,:]),axis=1)
+        gamma[:,g] *= 0.5
+        gamma = np.concatenate((gamma,gamma[:,g:g+1]),axis=1)
+
+    return (np.copy(tau,order='C'), np.copy(gamma,order='C'))
+
+def run_desman(output_Results, variants, variant_Filter, genomes, random_seed, random_select, args, warm_start=None):
+    """Initialises and runs the haplotype sampler for one genome number and seed
+    writing all results through output_Results. If warm_start = (tau, gamma, eta) is
+    given from a converged solution with fewer strains it is split to initialise the
+    sampler in place of NTF and only args.warm_burn burn-in iterations are run"""
+    no_iter = args.no_iter
+    burn_iter = None
+
+    logging.info('Finding %d genomes with %d samples and %d variant positions.' %(genomes,variant_Filter.S,variant_Filter.snps_filter.shape[0]))
+
+    logging.info('Set second adjustable random seed = %d',random_seed)
+    prng = RandomState(random_seed)
+    sampletau.setRNG(random_seed)
+
+    #per phase wall times written to timings.json
+    timer = pt.Phase_Timer(log_iter=args.timing_iter)
+    timer_NS = pt.Phase_Timer(log_iter=args.timing_iter)
+
+    em_iter = args.em_iter
+    if args.em_only and em_iter is None:
+        em_iter = 100
+
+    checkpoint_file = None
+    checkpoint_iter = args.checkpoint_iter
+    if args.resume and checkpoint_iter is None:
+        checkpoint_iter = 50
+    if checkpoint_iter is not None:
+        checkpoint_file = output_Results.outputDir + "/checkpoint.npz"
+
+    resume = args.resume and not args.em_only and os.path.exists(checkpoint_file)
+
+    #estimate memory before allocating and shrink stores to fit --max_memory
+    max_memory = None
+    if args.max_memory is not None:
+        max_memory = du.parse_memory(args.max_memory)
+    max_iter = no_iter if no_iter is not None else 250
+    (store, thin, estimate) = du.plan_storage(variant_Filter.snps_filter.shape[0],variant_Filter.S,genomes,max_iter,max_memory,
+                                              frame_bytes=variants.memory_usage().sum())
+    logging.info('Estimated peak memory %.1f MB: %s' % (estimate['total']/1024.0**2,
+                 ', '.join(['%s %.1f MB' % (name, estimate[name]/1024.0**2) for name in sorted(estimate) if name != 'total'])))
+    if store != 'full':
+        logging.info('Using %s stores of every %d iterations to fit memory budget of %.1f MB' % (store, thin, max_memory/1024.0**2))
+    if max_memory is not None and estimate['total'] > max_memory:
+        logging.warning('Estimated peak memory exceeds budget of %.1f MB even with smallest stores' % (max_memory/1024.0**2))
+    if args.resume and not resume:
+        logging.info('No checkpoint to resume from in %s starting new run' % output_Results.outputDir)
+
+    if warm_start is not None:
+        (tau_start, gamma_start, eta_start) = warm_start
+        (tau_start, gamma_start) = split_strain(tau_start, gamma_start, genomes)
+        #stores are sized to max_iter so burn-in cannot run longer
+        burn_iter = min(args.warm_burn, max_iter)
+
+    if resume:
+        em_iter = None
+    elif warm_start is not None:
+        logging.info('Warm start from converged solution with %d strains' % warm_start[0].shape[1])
+        if not args.em_only:
+            em_iter = None
+    else:
+        init_NMFT = inmft.Init_NMFT(variant_Filter.snps_filter,genomes,prng,timer=timer,n_run=args.nmf_restarts,
+                                    workers=min(args.nmf_restarts,multiprocessing.cpu_count()),solver=args.nmf_solver,
+                                    precision=args.precision)
+        logging.info('Perform NTF initialisation')
+        if args.nmf_subsample is not None:
+            init_NMFT.workers = multiprocessing.cpu_count()
+            init_NMFT.factorize_subsample(args.nmf_subsample)
+        else:
+            init_NMFT.factorize()
+
+    if em_iter is not None:
+        haplo_EM = hem.HaploSNP_EM(variant_Filter.snps_filter,genomes,max_iter=em_iter)
+        if warm_start is not None:
+            haplo_EM.gamma = gamma_start
+            haplo_EM.eta = np.copy(eta_start,order='C')
+        else:
+            haplo_EM.gamma = np.copy(init_NMFT.get_gamma(),order='C')
+            haplo_EM.eta = np.copy(variant_Filter.eta,order='C')
+        logging.info('Refine NTF initialisation with EM')
+        haplo_EM.update()
+
+    temper = args.temper
+    if temper is not None and multiprocessing.current_process().daemon:
+        logging.warning('Already in a worker process so cannot start tempered chains, running single chain')
+        temper = None
+
+    if args.em_only:
+        haplo_SNP = haplo_EM
+    else:
+        haplo_SNP = hsnp.HaploSNP_Sampler(variant_Filter.snps_filter,genomes,prng,max_iter=no_iter,
+                                          checkpoint_file=checkpoint_file,checkpoint_iter=checkpoint_iter,
+                                          mini_batch=args.mini_batch,tau_batch=args.tau_batch,
+                                          temper=temper,temper_beta=args.temper_beta,swap_iter=args.swap_iter,timer=timer,
+                                          store=store,thin=thin,store_file=output_Results.outputDir + "/tau_store.dat",
+                                          precision=args.precision)
+
+        start_iter = 0
+        if resume:
+            start_iter = haplo_SNP.readCheckpoint(checkpoint_file)
+        elif warm_start is not None:
+            haplo_SNP.tau = tau_start
+            haplo_SNP.gamma = gamma_start
+            haplo_SNP.eta = np.copy(eta_start,order='C')
+        elif em_iter is not None:
+            haplo_SNP.tau = np.copy(haplo_EM.tau_star,order='C')
+            haplo_SNP.gamma = np.copy(haplo_EM.gamma_star,order='C')
+            haplo_SNP.eta = np.copy(haplo_EM.eta_star,order='C')
+        else:
+            haplo_SNP.tau = np.copy(init_NMFT.get_tau(),order='C') #Necessary to have C-order for passing to Cython
+            haplo_SNP.gamma = np.copy(init_NMFT.get_gamma(),order='C')
+            haplo_SNP.eta = np.copy(variant_Filter.eta,order='C')
+
+        if not resume:
+            haplo_SNP.updateTauIndices()
+
+        if haplo_SNP.n_update == 0:
+            logging.info('Start Gibbs sampler burn-in phase')
+            haplo_SNP.update(burn_iter,start_iter=start_iter)
+            #after burn-in phase remove degeneracies
+            haplo_SNP.removeDegenerate()
+            start_iter = 0
+        logging.info('Start Gibbs sampler sampling phase')
+        haplo_SNP.update(start_iter=start_iter)
+
+    #output results to files
+    output_Results.set_Variants(variants)
+
+    output_Results.set_Variant_Filter(variant_Filter)
+
+    output_Results.set_haplo_SNP(haplo_SNP,genomes)
+
+    output_Results.output_Filtered_Tau(haplo_SNP.tau_star)
+
+    #compute estimate of posterior probabilities over tau
+    meanTau = haplo_SNP.tauMean()
+    output_Results.output_Tau_Mean(meanTau)
+
+    output_Results.output_Gamma(haplo_SNP.gamma_star)
+
+    gamma_mean = haplo_SNP.gammaMean()
+    output_Results.output_Gamma_Mean(gamma_mean)
+
+    output_Results.output_Eta(haplo_SNP.eta_star)
+
+    eta_mean = haplo_SNP.etaMean()
+    output_Results.output_Eta_Mean(eta_mean)
+
+    output_Results.output_Selected_Variants()
+
+    #If we selected random set now assign the rest
+    ns_workers = args.ns_workers
+    if ns_workers is not None and multiprocessing.current_process().daemon:
+        logging.info('Already in a worker process assigning not selected SNPs in this process')
+        ns_workers = None
+
+    if random_select is not None and not args.em_only and ns_workers is not None and ns_workers > 1:
+        dassign.assign_not_selected(output_Results, haplo_SNP, variant_Filter, variants, genomes, no_iter, ns_workers, args.ns_chunk, args.precision)
+    elif random_select is not None:
+        #selected flags all positions, not selected are rows of the original filtered variants
+        ns_mask = variant_Filter.selected[variant_Filter.selected_indices_original] != True
+        snps_notselected = variant_Filter.snps_filter_original[ns_mask,:]
+
+        if args.em_only:
+            haplo_SNP_NS = hem.HaploSNP_EM(snps_notselected,haplo_SNP.G)
+            haplo_SNP_NS.gamma_star = np.copy(haplo_SNP.gammaMean(),order='C')
+            haplo_SNP_NS.eta_star = np.copy(haplo_SNP.etaMean(),order='C')
+            logging.info('Compute EM tau posteriors on not selected SNPs fixed gamma')
+            haplo_SNP_NS.updateTau()
+        else:
+            init_NMFT_NS = inmft.Init_NMFT(snps_notselected,haplo_SNP.G,haplo_SNP.randomState,timer=timer_NS,precision=args.precision)
+
+            init_NMFT_NS.gamma = np.transpose(haplo_SNP.gamma)
+            logging.info('Perform NTF initialisation on not selected SNPs fixed gamma')
+            init_NMFT_NS.factorize_tau()
+
+            #only tau is stored when assigning not selected positions so stores are always compact
+            (store_NS, thin_NS, estimate_NS) = du.plan_storage(snps_notselected.shape[0],variant_Filter.S,haplo_SNP.G,max_iter,max_memory,store='compact')
+            haplo_SNP_NS = hsnp.HaploSNP_Sampler(snps_notselected,haplo_SNP.G,haplo_SNP.randomState,max_iter=no_iter,timer=timer_NS,
+                                                 store=store_NS,thin=thin_NS,store_file=output_Results.outputDir + "/tau_store_NS.dat",
+                                                 precision=args.precision)
+
+            haplo_SNP_NS.tau = init_NMFT_NS.get_tau()
+            haplo_SNP_NS.updateTauIndices()
+            haplo_SNP_NS.gamma_star = np.copy(haplo_SNP.gammaMean(),order='C')
+            haplo_SNP_NS.eta_star = np.copy(haplo_SNP.etaMean(),order='C')
+            haplo_SNP_NS.gamma_store = np.copy(haplo_SNP.gamma_store,order='C')
+            haplo_SNP_NS.eta_store = np.copy(haplo_SNP.eta_store,order='C')
+
+            logging.info('Start Gibbs sampler burn-in phase')
+            haplo_SNP_NS.updateTau()
+            logging.info('Start Gibbs sampler sampling phase')
+            haplo_SNP_NS.updateTau()
+        output_Results.outPredFit(haplo_SNP_NS,genomes)
+        output_Results.output_collated_Tau(haplo_SNP_NS,variants)
+
+    pt.write_timings(output_Results.outputDir + "/timings.json", {'sampler' : timer, 'not_selected' : timer_NS})
+
+    return haplo_SNP
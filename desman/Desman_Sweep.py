@@ -0,0 +1,156 @@
+import sys, getopt
+import os
+import numpy as np
+import logging
+import multiprocessing
+import pandas as p
+
+#user defined modules
+from . import Desman_Utils as du
+from . import Variant_Filter as vf
+from . import Desman_Run as drun
+from . import Output_Results as outr
+
+#C code for tau sampling
+import sampletau
+
+#filter attributes that runs use, arrays among them are placed in shared memory
+WORKER_ATTRIBUTES = ['S','V','NS','eta','sample_indices','selected','selected_indices',
+                     'selected_indices_original','snps_filter','snps_filter_original']
+
+def parse_range(range_string):
+    """Parses '2-8', '2,4,6' or '3' into a list of ints"""
+    values = []
+    for token in range_string.split(','):
+        token = token.strip()
+        if '-' in token:
+            (start, end) = token.split('-')
+            values.extend(list(range(int(start), int(end) + 1)))
+        else:
+            values.append(int(token))
+    return values
+
+def share_arrays(variant_Filter):
+    """Copies the arrays of the filter attributes runs use into shared memory returning 
+    the segments, a description from which workers can attach views and a filter with 
+    only the remaining small attributes"""
+    segments = []
+    shared = []
+    worker_Filter = vf.Variant_Filter.__new__(vf.Variant_Filter)
+    for name in WORKER_ATTRIBUTES:
+        value = getattr(variant_Filter, name, None)
+        if name in ['selected_indices','selected_indices_original'] and value is not None:
+            value = np.asarray(value)
+        
+        if not isinstance(value, np.ndarray):
+            setattr(worker_Filter, name, value)
+            continue
+
+        (shm, description) = du.share_array(value)
+
+        segments.append(shm)
+        shared.append((name, description))
+
+    return (segments, shared, worker_Filter)
+
+def share_variants(variants):
+    """Copies the counts and factorised contig names of variants into shared memory 
+    returning the segments and a description for attach_variants"""
+    (codes, names) = p.factorize(variants.index)
+    segments = []
+    arrays = []
+    for array in [np.ascontiguousarray(variants.values), codes]:
+        (shm, description) = du.share_array(array)
+        segments.append(shm)
+        arrays.append(description)
+
+    return (segments, (arrays, names, variants.index.name, list(variants.columns)))
+
+def attach_variants(description, segments):
+    """Rebuilds the variants frame of share_variants over views of the shared counts"""
+    ((values_description, codes_description), names, index_name, columns) = description
+    (shm_values, values) = du.attach_array(values_description)
+    (shm_codes, codes) = du.attach_array(codes_description)
+    segments.extend([shm_values, shm_codes])
+
+    index = p.Index(names.take(codes), name=index_name)
+    return p.DataFrame(values, index=index, columns=columns, copy=False)
+
+#per worker process state set by init_worker
+_worker = {}
+
+def init_worker(variants_description, variant_Filter, shared, random_select, args):
+    sampletau.initRNG()
+
+    _worker['segments'] = []
+    for (name, description) in shared:
+        (shm, array) = du.attach_array(description)
+        _worker['segments'].append(shm)
+        setattr(variant_Filter, name, array)
+
+    _worker['variants'] = attach_variants(variants_description, _worker['segments'])
+    _worker['variant_Filter'] = variant_Filter
+    _worker['random_select'] = random_select
+    _worker['args'] = args
+
+def run_task(task):
+    (genomes, seed, warm_start) = task
+    args = _worker['args']
+    output_dir = "%s_%d_%d" % (args.output_dir, genomes, seed)
+
+    drun.reset_logging()
+    output_Results = outr.Output_Results(output_dir,append=args.resume)
+
+    haplo_SNP = drun.run_desman(output_Results, _worker['variants'], _worker['variant_Filter'],
+                                genomes, seed, _worker['random_select'], args, warm_start=warm_start)
+
+    solution = (haplo_SNP.tau_star, haplo_SNP.gamma_star, haplo_SNP.eta_star)
+
+    return (genomes, seed, haplo_SNP.G, haplo_SNP.lp_star, solution)
+
+def sweep(variants, variant_Filter, random_select, genomes_list, seeds, args, workers=None, warm_start=False):
+    """Runs every (genomes, seed) combination on a bounded process pool sharing one
+    copy of the filtered variants, output goes to <output_dir>_<G>_<seed>. With
+    warm_start genome numbers are run in increasing order and each is initialised
+    by splitting the highest posterior solution found at the previous genome number"""
+
+    if warm_start:
+        levels = [[(g, r) for r in seeds] for g in sorted(genomes_list)]
+    else:
+        #longest runs first to keep the pool busy
+        levels = [[(g, r) for g in sorted(genomes_list, reverse=True) for r in seeds]]
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, max([len(level) for level in levels])))
+
+    #the eta and assign files are consumed by filtering and cannot be sent to workers
+    args.eta_file = None
+    args.assign_file = None
+
+    (segments, shared, worker_Filter) = share_arrays(variant_Filter)
+    (variant_segments, variants_description) = share_variants(variants)
+    segments.extend(variant_segments)
+    logging.info('Placed variants and filter in %d shared memory segments' % len(segments))
+
+    logging.info('Running %d desman jobs on %d workers' % (sum([len(level) for level in levels]), workers))
+    try:
+        pool = multiprocessing.Pool(processes=workers, initializer=init_worker,
+                                    initargs=(variants_description, worker_Filter, shared, random_select, args))
+        try:
+            best = None
+            for level in levels:
+                tasks = [(g, r, best) for (g, r) in level]
+                lp_best = None
+                for (genomes, seed, G, lp_star, solution) in pool.imap_unordered(run_task, tasks):
+                    logging.info('Finished genomes = %d, seed = %d, non-degenerate haplotypes = %d, nlp = %f' % (genomes, seed, G, lp_star))
+                    if warm_start and (lp_best is None or lp_star > lp_best):
+                        lp_best = lp_star
+                        best = solution
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        for shm in segments:
+            shm.close()
+            shm.unlink()
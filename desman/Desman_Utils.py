@@ -74,4 +74,163 @@ def unique(a):
     diff = np.diff(a, axis=0)
     ui = np.ones(len(a), 'bool')
     ui[1:] = (diff != 0).any(axis=1) 
-    return a[ui]
\ No newline at end of file
+    return a[ui]
+
+def tau_decode(indices, G):
+    """Returns the NXGX4 indicator arrays of tau state indices by base 4 decoding, 
+    the first genome being the most significant digit"""
+    indices = np.asarray(indices)
+    digits = (indices[:,np.newaxis] // (4 ** np.arange(G - 1, -1, -1))) % 4
+    
+    return (digits[:,:,np.newaxis] == np.arange(4)).astype(np.int)
+
+def tau_encode(tau):
+    """Returns the state index of each of the NXGX4 indicator arrays tau"""
+    G = tau.shape[1]
+    
+    return np.einsum('vga,ga->v',tau,tau_map(G))
+
+def tau_states(G, start=0, end=None):
+    """Returns assignments of bases to genomes for tau states start to end, all 4^G 
+    by default, as TXGX4 indicator array"""
+    if end is None:
+        end = 4 ** G
+    
+    return tau_decode(np.arange(start,end), G)
+
+def tau_state_blocks(G, block_size):
+    """Generates (start, tau_states(G,start,end)) over all states in blocks so that 
+    consumers need not hold all 4^G states at once"""
+    nTauStates = 4 ** G
+    for start in range(0, nTauStates, block_size):
+        yield (start, tau_states(G, start, min(start + block_size, nTauStates)))
+
+def tau_map(G):
+    """Returns GX4 array mapping a tau assignment onto its state index"""
+    
+    return np.outer(4 ** np.arange(G - 1, -1, -1), np.arange(4))
+
+def get_rng_state(randomState):
+    """Returns the state of a numpy RandomState as a dict of arrays for checkpoints"""
+    (name, keys, pos, has_gauss, cached_gaussian) = randomState.get_state()
+    
+    return {'rng_keys' : keys, 'rng_pos' : np.array(pos), 
+            'rng_has_gauss' : np.array(has_gauss), 'rng_cached_gaussian' : np.array(cached_gaussian)}
+
+def set_rng_state(randomState, state):
+    """Restores a numpy RandomState from a dict written by get_rng_state"""
+    randomState.set_state(('MT19937', state['rng_keys'], int(state['rng_pos']),
+                           int(state['rng_has_gauss']), float(state['rng_cached_gaussian'])))
+
+def write_checkpoint(fileName, state):
+    """Writes a dict of arrays to a compressed binary checkpoint, replacing any 
+    previous checkpoint only once the new one is complete"""
+    tmpName = fileName + ".tmp"
+    with open(tmpName, 'wb') as f:
+        np.savez_compressed(f, **state)
+    os.replace(tmpName, fileName)
+
+def read_checkpoint(fileName):
+    """Reads a checkpoint written by write_checkpoint into a dict of arrays"""
+    with np.load(fileName) as data:
+        state = {key : data[key] for key in data.files}
+    
+    return state
+
+def write_rows(fileName, array, start, end):
+    """Writes rows start to end of array at their offsets in a raw binary file, so that
+    a store filled row by row is saved incrementally"""
+    mode = 'r+b' if os.path.exists(fileName) else 'wb'
+    with open(fileName, mode) as f:
+        f.seek(start*array.itemsize*int(np.prod(array.shape[1:])))
+        np.ascontiguousarray(array[start:end]).tofile(f)
+
+def read_rows(fileName, array, end):
+    """Reads the first end rows written by write_rows into array"""
+    if end == 0:
+        return
+    
+    rows = np.fromfile(fileName, dtype=array.dtype, count=end*int(np.prod(array.shape[1:])))
+    array[:end] = np.reshape(rows, (end,) + array.shape[1:])
+
+def share_array(array):
+    """Copies array into a new shared memory segment returning the segment, which the 
+    caller must unlink, and a picklable description for attach_array"""
+    from multiprocessing import shared_memory
+    
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes,1))
+    view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    view[:] = array
+    
+    return (shm, (shm.name, array.shape, array.dtype.str))
+
+def attach_array(description):
+    """Attaches to a segment created by share_array returning the segment and an array view"""
+    from multiprocessing import shared_memory
+    
+    (shm_name, shape, dtype) = description
+    shm = shared_memory.SharedMemory(name=shm_name)
+    
+    return (shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf))
+
+def parse_memory(memory):
+    """Parses a memory size such as '512M', '16G' or a number of bytes into bytes"""
+    units = {'K' : 1024, 'M' : 1024**2, 'G' : 1024**3, 'T' : 1024**4}
+    memory = str(memory).strip().upper().rstrip('B')
+    if memory[-1] in units:
+        return int(float(memory[:-1])*units[memory[-1]])
+    
+    return int(float(memory))
+
+def estimate_memory(V, S, G, max_iter, store='full', thin=1, tau_block=4096, position_block=1024, frame_bytes=0):
+    """Returns a dict of the estimated bytes of the large arrays of a desman run with V 
+    positions, S samples and G strains, and their total under key 'total'"""
+    n_store = (max_iter + thin - 1)//thin
+    int_bytes = 8
+    float_bytes = 8
+    
+    estimate = {}
+    #filter copies and sampler variants
+    estimate['variants'] = 2*V*S*4*int_bytes
+    estimate['frames'] = frame_bytes
+    #NTF frequency matrix, its reconstruction and elementwise temporaries
+    estimate['ntf'] = 5*V*4*S*float_bytes + V*4*G*float_bytes
+    #current mu and E and the sampleMu einsum temporary
+    estimate['mu_E'] = V*S*4*G*int_bytes + V*S*16*int_bytes + V*S*16*G*float_bytes
+    #tau state blocks in assignTau and logTauProb
+    tau_block = min(tau_block, 4 ** G)
+    estimate['tau_states'] = tau_block*G*4*int_bytes + 2*tau_block*S*4*float_bytes + 2*position_block*tau_block*float_bytes
+    estimate['traces'] = max_iter*(S*G + 16 + 1)*float_bytes
+    
+    if store == 'full':
+        estimate['tau_store'] = n_store*V*G*4*int_bytes
+        estimate['mu_store'] = n_store*V*S*4*G*int_bytes
+        estimate['E_store'] = n_store*V*S*16*int_bytes
+    else:
+        #streamed tau store is memory mapped so counts against disk not memory
+        estimate['tau_store'] = 0 if store == 'stream' else n_store*V*G*4
+        estimate['mu_store'] = n_store*S*G*int_bytes
+        estimate['E_store'] = n_store*16*int_bytes
+    
+    estimate['total'] = sum(estimate.values())
+    return estimate
+
+def plan_storage(V, S, G, max_iter, max_memory=None, store='full', max_thin=8, **kwargs):
+    """Returns (store, thin, estimate) for the first of store, compact, compact thinned 
+    by 2, 4 up to max_thin, then stream likewise whose estimate fits max_memory bytes, 
+    or the last of these if none fit"""
+    plans = []
+    if store == 'full':
+        plans.append(('full',1))
+    for option in ['compact', 'stream']:
+        thin = 1
+        while thin <= max_thin:
+            plans.append((option, thin))
+            thin *= 2
+    
+    for (store, thin) in plans:
+        estimate = estimate_memory(V, S, G, max_iter, store=store, thin=thin, **kwargs)
+        if max_memory is None or estimate['total'] <= max_memory:
+            break
+    
+    return (store, thin, estimate)
@@ -11,6 +11,8 @@ import sampletau
 from scipy.special import gammaln
 from numpy import array, log, exp
 from . import Init_NMFT as inmft
+from . import Desman_Utils as du
+from . import Phase_Timer as pt
 import logging
 
 MIN_DELTA = 1.0e-10
@@ -38,14 +40,18 @@ def log_Poisson(cov,cov_exp):
 
 class Eta_Sampler():
     
-    def __init__(self,randomState,variants,covs,gamma,delta,cov_sd,epsilon,init_eta,max_iter=None,tau_iter=None,max_eta=2,eta_scale=0.01,max_var=None):
+    def __init__(self,randomState,variants,covs,gamma,delta,cov_sd,epsilon,init_eta,max_iter=None,tau_iter=None,max_eta=2,eta_scale=0.01,max_var=None,
+                 checkpoint_file=None,checkpoint_iter=5,timer=None,nmf_chunk=None,nmf_workers=1,precision='float64'):
     
         #calc G
         self.randomState = randomState
+        self.nmf_chunk = nmf_chunk #positions per NTF tau chunk for large genes
+        self.nmf_workers = nmf_workers
+        self.precision = precision #of NTF and variant likelihood products
         self.delta = np.transpose(delta)
         self.cov_sd = np.transpose(cov_sd)
         self.gamma = np.copy(gamma,order='C')
-        self.cov = covs.as_matrix()
+        self.cov = covs.values
         self.epsilon = np.copy(epsilon,order='C')
         
         self.G = self.gamma.shape[1]
@@ -79,9 +85,9 @@ class Eta_Sampler():
                     gene_variants = gene_variants.to_frame()
                     gene_variants = gene_variants.transpose()
             
-                gene_variants_matrix = gene_variants.as_matrix()
+                gene_variants_matrix = gene_variants.values
                 
-                gene_snps = np.reshape(gene_variants_matrix, (gene_variants_matrix.shape[0],gene_variants_matrix.shape[1]/4,4))
+                gene_snps = np.reshape(gene_variants_matrix, (gene_variants_matrix.shape[0],gene_variants_matrix.shape[1]//4,4))
                 NV = gene_snps.shape[0]
                 if max_var is not None and NV > max_var:
                     select = np.sort(self.randomState.choice(NV,max_var, replace=False))
@@ -122,15 +128,18 @@ class Eta_Sampler():
         self.eta_star = np.copy(init_eta)
         self.eta_store = np.zeros((self.max_iter,self.C,self.G))
         
-        for gene in self.genes:
+        
+        #wall time and calls per phase of the tau initialisation and Gibbs updates
+        if timer is None:
+            timer = pt.Phase_Timer()
+        self.timer = timer
+
+        init_genes = [gene for gene in self.genes if self.gene_V[gene] > 0]
+        init_tau = self.initTauNTF(init_genes)
+        for gene in init_genes:
             c = self.gene_map[gene]
-            if self.gene_V[gene] > 0:
-                init_NMFT = inmft.Init_NMFT(self.gene_variants[gene],self.G,self.randomState)
-                gammaR = self.maskGamma(self.gamma,self.eta[c,:])
-                init_NMFT.gamma = np.transpose(gammaR)
-                init_NMFT.factorize_tau()
-                self.gene_tau[gene] = np.copy(init_NMFT.get_tau(),order='C')
-                self.sampleTauC(self.gene_tau[gene],self.gene_variants[gene],self.eta[c,:])    
+            self.gene_tau[gene] = np.copy(init_tau[gene],order='C')
+            self.sampleTauC(self.gene_tau[gene],self.gene_variants[gene],self.eta[c,:])    
     
     
 
@@ -141,7 +150,35 @@ class Eta_Sampler():
         
         tempnorm = np.sum(np.exp(self.eta_log_prior))
         self.eta_log_prior -= np.log(tempnorm)
+        
+        #periodic checkpoints written during update if checkpoint_file set
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_iter = checkpoint_iter
+        self.n_update = 0
 
+    def initTauNTF(self,genes):
+        """NTF tau with the eta masked gamma fixed for genes, genes with more than nmf_chunk 
+        positions are fitted alone in chunks and the rest stacked together"""
+        gene_tau = {}
+        
+        stacked = [gene for gene in genes if self.nmf_chunk is None or self.gene_V[gene] <= self.nmf_chunk]
+        if len(stacked) > 0:
+            gammas = [self.maskGamma(self.gamma,self.eta[self.gene_map[gene],:]) for gene in stacked]
+            taus = inmft.factorize_tau_genes([self.gene_variants[gene] for gene in stacked],gammas,self.randomState,timer=self.timer,
+                                              precision=self.precision)
+            gene_tau.update(zip(stacked,taus))
+        
+        for gene in genes:
+            if gene not in gene_tau:
+                init_NMFT = inmft.Init_NMFT(self.gene_variants[gene],self.G,self.randomState,workers=self.nmf_workers,
+                                            precision=self.precision)
+                gammaR = self.maskGamma(self.gamma,self.eta[self.gene_map[gene],:])
+                init_NMFT.gamma = np.transpose(gammaR)
+                init_NMFT.factorize_tau_chunks(self.nmf_chunk)
+                gene_tau[gene] = init_NMFT.get_tau()
+        
+        return gene_tau
+    
     def maskGamma(self,gamma,eta):
         gammaR = np.copy(gamma)
         
@@ -203,18 +240,23 @@ class Eta_Sampler():
         newTau = np.copy(tau)
         nchange = self.sampleTauC(newTau,variants,eta)
                         
-        siteVariantsProb = np.einsum('ijk,lj,km->ilm',newTau,gammaT,self.epsilon)
-        st0 = np.log(siteVariantsProb)*variants    
-        logprob0 = st0.sum()
+        if self.precision == 'float64':
+            siteVariantsProb = np.einsum('ijk,lj,km->ilm',newTau,gammaT,self.epsilon)
+            st0 = np.log(siteVariantsProb)*variants    
+        else:
+            siteVariantsProb = np.einsum('ijk,lj,km->ilm',newTau.astype(self.precision),gammaT.astype(self.precision),self.epsilon.astype(self.precision))
+            st0 = np.log(siteVariantsProb)*variants.astype(self.precision)
+        logprob0 = st0.sum(dtype=np.float64)
     
         return(logprob0, newTau)
     
-    def update(self): #perform max_iter Gibbs updates
-        iter = 0
-        self.ll = self.logLikelihood()
-        for c in range(self.C):
-            self.eta_star[c,:] = np.copy(self.eta[c,:])
-            self.gene_llstar[c] = self.gene_ll[c]
+    def update(self,start_iter=0): #perform max_iter Gibbs updates
+        iter = start_iter
+        if iter == 0:
+            self.ll = self.logLikelihood()
+            for c in range(self.C):
+                self.eta_star[c,:] = np.copy(self.eta[c,:])
+                self.gene_llstar[c] = self.gene_ll[c]
         
         while (iter < self.max_iter):
         
@@ -236,7 +278,8 @@ class Eta_Sampler():
                     if V > 0:
                         variants = self.gene_variants[gene]
                         if(tempEta.sum() > 0):
-                            (logVar0, newTau0) = self.computeVarLLContrib(tempEta,self.gene_tau[gene],variants)
+                            with self.timer.phase('variant likelihood'):
+                                (logVar0, newTau0) = self.computeVarLLContrib(tempEta,self.gene_tau[gene],variants)
                         else:
                             logVar0 = -1.0e20;
                         
@@ -250,7 +293,8 @@ class Eta_Sampler():
                     
                     if V > 0:
                         variants = self.gene_variants[gene]
-                        (logVar1, newTau1) = self.computeVarLLContrib(tempEta,self.gene_tau[gene],variants)
+                        with self.timer.phase('variant likelihood'):
+                            (logVar1, newTau1) = self.computeVarLLContrib(tempEta,self.gene_tau[gene],variants)
                     else:
                         logVar1 = 0.0
                     
@@ -269,14 +313,64 @@ class Eta_Sampler():
                         else:
                             self.gene_tau[gene] = newTau1
                         
-            self.ll = self.logLikelihood()
+            with self.timer.phase('likelihood'):
+                self.ll = self.logLikelihood()
    
             logging.info('Gibbs Iter %d, nll = %f'%(iter,self.ll))
             
-            self.storeStarState(iter)
-            self.eta_store[iter,]=np.copy(self.eta)
+            with self.timer.phase('store'):
+                self.storeStarState(iter)
+                self.eta_store[iter,]=np.copy(self.eta)
 
             iter = iter + 1
+            self.timer.logIter(iter)
+            
+            if self.checkpoint_file is not None and iter % self.checkpoint_iter == 0:
+                self.writeCheckpoint(iter)
+        
+        self.n_update += 1
+    
+    def writeCheckpoint(self,iter):
+        """Writes eta state, star state, gene taus, traces up to iter and both RNG 
+        states so that update(start_iter=iter) after readCheckpoint continues identically"""
+        state = {'iter' : np.array(iter), 'n_update' : np.array(self.n_update),
+                 'eta' : self.eta, 'eta_star' : self.eta_star, 'gene_ll' : self.gene_ll,
+                 'gene_llstar' : self.gene_llstar, 'll' : np.array(self.ll),
+                 'eta_store' : self.eta_store[:iter], 'sampletau_rng' : sampletau.getRNGState()}
+        
+        for gene in self.genes:
+            if self.gene_V[gene] > 0:
+                state['gene_tau_%d'%self.gene_map[gene]] = self.gene_tau[gene]
+        
+        state.update(du.get_rng_state(self.randomState))
+        
+        du.write_checkpoint(self.checkpoint_file,state)
+        logging.info('Wrote checkpoint at Gibbs Iter %d to %s'%(iter,self.checkpoint_file))
+    
+    def readCheckpoint(self,fileName):
+        """Restores state written by writeCheckpoint returning the iteration to resume from,
+        n_update gives the number of completed calls to update"""
+        state = du.read_checkpoint(fileName)
+        
+        self.eta = state['eta']
+        self.eta_star = state['eta_star']
+        self.gene_ll = state['gene_ll']
+        self.gene_llstar = state['gene_llstar']
+        self.ll = float(state['ll'])
+        
+        for gene in self.genes:
+            if self.gene_V[gene] > 0:
+                self.gene_tau[gene] = np.copy(state['gene_tau_%d'%self.gene_map[gene]],order='C')
+        
+        iter = int(state['iter'])
+        self.n_update = int(state['n_update'])
+        self.eta_store[:iter] = state['eta_store']
+        
+        du.set_rng_state(self.randomState,state)
+        sampletau.setRNGState(state['sampletau_rng'])
+        
+        logging.info('Read checkpoint at Gibbs Iter %d from %s'%(iter,fileName))
+        return iter
     
     def update2(self): #perform max_iter Gibbs updates
         iter = 0
@@ -411,17 +505,13 @@ class Eta_Sampler():
             self.gene_tau_star[gene] = np.zeros((V,self.G,4), dtype=np.int,order='C')
             self.gene_tau_store[gene] = np.zeros((self.tau_iter,V,self.G,4), dtype=np.int,order='C')
             
-            c = self.gene_map[gene]
-            etaSum = eta[c,:].sum()
             
-            if V > 0 and etaSum > 0:
-                init_NMFT = inmft.Init_NMFT(self.gene_variants[gene],self.G,self.randomState)
-                gammaR = self.maskGamma(self.gamma,self.eta[c,:])
-                init_NMFT.gamma = np.transpose(gammaR)
-                init_NMFT.factorize_tau()
-                self.gene_tau_star[gene] = np.copy(init_NMFT.get_tau(),order='C')
-                self.gene_tau[gene] = np.copy(init_NMFT.get_tau(),order='C')
-                logging.info('Tau star NTF %d'%(c))
+        init_genes = [gene for gene in self.genes if self.gene_V[gene] > 0 and eta[self.gene_map[gene],:].sum() > 0]
+        init_tau = self.initTauNTF(init_genes)
+        for gene in init_genes:
+            self.gene_tau_star[gene] = np.copy(init_tau[gene],order='C')
+            self.gene_tau[gene] = np.copy(init_tau[gene],order='C')
+        logging.info('Tau star NTF for %d genes'%(len(init_genes)))
                 
         while (iter < self.tau_iter):
             lltausum = 0.0
@@ -539,7 +629,7 @@ class Eta_Sampler():
                 start = Vcum_array[c]
                 end = start + V
                 contig_index[start:end] = [gene]*V
-                positions[start:end] = gene_pos.as_matrix()        
+                positions[start:end] = gene_pos.values        
             except KeyError:
                 pass
         return (tauStar,tauMean, positions,contig_index)
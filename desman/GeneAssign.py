@@ -8,7 +8,9 @@ import scipy.stats as ss
 from scipy.stats import norm
 import argparse
 import math
+import multiprocessing
 from . import Eta_Sampler as es
+from . import Phase_Timer as pt
 import sampletau
 import logging
 
@@ -84,7 +86,8 @@ class KLAssign():
         
             
     def factorize(self):
-    
+        """Fits eta from n_run random starts keeping the lowest divergence"""
+        best = None
         for run in range(self.n_run):
             
             self.random_initialize()
@@ -102,6 +105,11 @@ class KLAssign():
                     logging.info('KL iter %d divergence = %f' %(iter,div))
 
                 iter += 1
+            
+            if best is None or div < best[0]:
+                best = (div, self.eta)
+        
+        (self.divergence, self.eta) = best
     
     def _adjustment(self):
         """Adjust small values to factors to avoid numerical underflow."""
@@ -188,6 +196,22 @@ def main(argv):
 
     parser.add_argument('--assign_tau', dest='assign_tau', action='store_true')
     parser.set_defaults(assign_tau=False)
+    
+    parser.add_argument('--checkpoint_iter', nargs='?', const=5, type=int,
+        help=("write sampler state to <output_stub>_checkpoint.npz every n iterations, default 5 if given without value"))
+    
+    parser.add_argument('--timing_iter', type=int, 
+        help=("log accumulated per phase timings every this many iterations, always written to <output_stub>_timings.json"))
+    
+    parser.add_argument('--precision', choices=['float64','float32'], default='float64',
+        help=("precision of the NTF and variant likelihood matrix products, defaults to float64"))
+    
+    parser.add_argument('--nmf_chunk', type=int, 
+        help=("fit NTF tau of genes with more positions than this in chunks of this size on all cores"))
+    
+    parser.add_argument('--resume', dest='resume', action='store_true',
+        help=("resume from <output_stub>_checkpoint.npz if present"))
+    parser.set_defaults(resume=False)
     args = parser.parse_args()
 
     #import ipdb; ipdb.set_trace()
@@ -199,7 +223,7 @@ def main(argv):
     logging.basicConfig(
             filename=log_file_name,
             level=logging.INFO,
-            filemode='w', # Overwrites old log file
+            filemode='a' if args.resume else 'w', # Overwrites old log file unless resuming
             format='%(asctime)s:%(levelname)s:%(name)s:%(message)s'
             )
 
@@ -218,7 +242,7 @@ def main(argv):
     cov = p.read_csv(args.cov_file, header=0, index_col=0)
     logging.info('Read epsilon from %s' %(args.epsilon_file))
     epsilon = p.read_csv(args.epsilon_file, header=0, index_col=0)
-    epsilon_matrix = epsilon.as_matrix()
+    epsilon_matrix = epsilon.values
     
     if args.variant_file is not None:
         logging.info('Read variants from %s' %(args.variant_file))
@@ -235,11 +259,11 @@ def main(argv):
     scg_cov = scg_cov.reindex(intersect_names)
     gamma_star = gamma_star.reindex(intersect_names)
         
-    total_mean = scg_cov['mean'].as_matrix()
-    total_sd = scg_cov['sd'].as_matrix()
+    total_mean = scg_cov['mean'].values
+    total_sd = scg_cov['sd'].values
     
     #renormalise gamma matrix
-    gamma_star_matrix = gamma_star.as_matrix()
+    gamma_star_matrix = gamma_star.values
     row_sums = gamma_star_matrix.sum(axis=1)
     gamma_star_matrix = gamma_star_matrix / row_sums[:, np.newaxis]
 
@@ -247,7 +271,7 @@ def main(argv):
     
     #reorder coverage matrix
     cov = cov[intersect_names]
-    cov_matrix = cov.as_matrix()
+    cov_matrix = cov.values
     logging.info('Perform KL estimation of contig counts')
     klassign = KLAssign(prng,cov_matrix,delta)
     klassign.factorize()
@@ -260,12 +284,31 @@ def main(argv):
     #import ipdb; ipdb.set_trace()
     etaD = np.rint(klassign.eta)
  
+    checkpoint_file = None
+    checkpoint_iter = args.checkpoint_iter
+    if args.resume and checkpoint_iter is None:
+        checkpoint_iter = 5
+    if checkpoint_iter is not None:
+        checkpoint_file = output_stub + "_checkpoint.npz"
+ 
+    timer = pt.Phase_Timer(log_iter=args.timing_iter)
+ 
     etaSampler = es.Eta_Sampler(prng,variants_intersect,cov,gamma_star_matrix,delta,total_sd,epsilon_matrix,etaD,
-        max_iter=args.iter_max,max_eta=args.eta_max, max_var=args.var_max)
+        max_iter=args.iter_max,max_eta=args.eta_max, max_var=args.var_max,
+        checkpoint_file=checkpoint_file,checkpoint_iter=checkpoint_iter,timer=timer,
+        nmf_chunk=args.nmf_chunk,nmf_workers=multiprocessing.cpu_count(),precision=args.precision)
+    
+    start_iter = 0
+    if args.resume and os.path.exists(checkpoint_file):
+        start_iter = etaSampler.readCheckpoint(checkpoint_file)
+    
+    if etaSampler.n_update == 0:
+        etaSampler.update(start_iter=start_iter)
+        start_iter = 0
     
-    etaSampler.update()
+    etaSampler.update(start_iter=start_iter)
     
-    etaSampler.update()
+    pt.write_timings(output_stub+"_timings.json", {'eta_sampler' : timer})
     
     #Now assign tau given eta_star
     contig_names = cov.index.tolist()
@@ -313,7 +356,7 @@ def main(argv):
     if args.genomes:
         genomes    = p.read_csv(args.genomes, header=0, index_col=0)
         genomes = genomes.loc[contig_names]
-        genomes_M   = genomes.as_matrix()
+        genomes_M   = genomes.values
         genomes_D = np.copy(genomes_M)
         
         #genomes_D[genomes_D < 0.5] = 0.
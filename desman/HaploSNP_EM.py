@@ -0,0 +1,203 @@
+import sys, getopt
+import os
+import numpy as np
+import math
+import logging
+
+from numpy import array, log, exp
+from scipy.special import gammaln
+
+#user defined modules
+from . import Desman_Utils as du
+
+class HaploSNP_EM():
+    """Deterministic EM/MAP estimation of gamma and eta with exact posteriors
+    over all 4^G tau states at each position, only practical for small G. EM maximises 
+    the posterior with tau summed out but lp_star and meanDeviance are the joint values 
+    at tau_star as HaploSNP_Sampler writes to fit.txt"""
+
+    def __init__(self,snps,G,max_iter=None,min_change=1.0e-3,alpha_constant=0.1,delta_constant=0.1,epsilon=1.0e-6,chunk_size=10000):
+
+        if max_iter is None:
+            self.max_iter = 100
+        else:
+            self.max_iter = max_iter
+
+        self.min_change = min_change
+        self.chunk_size = chunk_size
+
+        self.G = G
+        self.V = snps.shape[0] #number of variants
+        self.S = snps.shape[1]
+
+        self.variants = np.copy(snps,order='C')
+        self.variants_flat = np.reshape(self.variants,(self.V,self.S*4)).astype(np.float)
+
+        self.epsilon = epsilon
+
+        self.delta = np.empty(4); self.delta.fill(delta_constant)
+        self.delta_constant = delta_constant
+
+        self.alpha = np.empty(self.G); self.alpha.fill(alpha_constant)
+        self.alpha_constant = alpha_constant
+
+        #multinomial coefficients do not depend on parameters so compute once
+        self.logMultCoeff = (du.log_factorial(self.variants.sum(axis=2)) - du.log_factorial(self.variants).sum(axis=2)).sum()
+
+        self.nTauStates = 4 ** self.G
+        self.tauStates = du.tau_states(self.G)
+        self.tauMap = du.tau_map(self.G)
+
+        self.gamma = np.ones((self.S,self.G))/float(self.G)
+        self.eta = 0.96*np.identity((4)) + 0.01*np.ones((4,4))
+
+        self.tau = np.zeros((self.V,self.G,4), dtype=np.int)
+        self.tauIndices = np.zeros((self.V),dtype=np.int)
+        self.tauProb = np.zeros((self.V,self.G,4))
+
+        self.ll = 0.0
+        self.lp = 0.0
+        self.ll_store = np.zeros(self.max_iter)
+
+    def eStep(self,gamma,eta):
+        """Computes posterior responsibilities over tau states returning expected
+        mu counts SXG, expected E counts AXB and the marginal log likelihood"""
+
+        siteProb = np.einsum('tjk,lj,km->tlm',self.tauStates,gamma,eta)
+        logSiteProb = np.reshape(np.log(siteProb),(self.nTauStates,self.S*4))
+
+        A = np.zeros((self.nTauStates,self.S*4))
+        logLL = 0.0
+
+        #chunk positions so that VXT responsibilities stay bounded
+        for start in range(0,self.V,self.chunk_size):
+            end = min(start + self.chunk_size,self.V)
+
+            stateLogProb = np.dot(self.variants_flat[start:end,:],logSiteProb.T)
+
+            maxLog = np.max(stateLogProb,axis=1)
+            resp = np.exp(stateLogProb - maxLog[:,np.newaxis])
+            respSum = resp.sum(axis=1)
+            resp /= respSum[:,np.newaxis]
+
+            logLL += (maxLog + np.log(respSum)).sum()
+
+            A += np.dot(resp.T,self.variants_flat[start:end,:])
+
+            self.tauIndices[start:end] = np.argmax(resp,axis=1)
+            self.tauProb[start:end,:,:] = np.einsum('vt,tga->vga',resp,self.tauStates)
+
+        A = np.reshape(A,(self.nTauStates,self.S,4))/siteProb
+
+        sum_mu = gamma*np.einsum('tsa,tgb,ba->sg',A,self.tauStates,eta)
+
+        #AXB with A observed deriving from B true as in HaploSNP_Sampler
+        sum_E = np.transpose(eta)*np.einsum('tsa,tgb,sg->ab',A,self.tauStates,gamma)
+
+        #uniform prior over tau states
+        logLL += self.logMultCoeff + self.V*self.G*log(1.0/4.0)
+
+        return (sum_mu,sum_E,logLL)
+
+    def mStep(self,sum_mu,sum_E):
+        """MAP updates of gamma and eta given expected counts"""
+
+        gamma = sum_mu + self.alpha[np.newaxis,:] - 1.0
+        gamma[gamma < self.epsilon] = self.epsilon
+        self.gamma = gamma/gamma.sum(axis=1)[:,np.newaxis]
+
+        eta = np.transpose(sum_E) + self.delta[np.newaxis,:] - 1.0
+        eta[eta < self.epsilon] = self.epsilon
+        self.eta = eta/eta.sum(axis=1)[:,np.newaxis]
+
+    def logPrior(self,cGamma,cEta):
+
+        logGammaPrior = 0.0
+        for s in range(self.S):
+            logGammaPrior += du.log_dirichlet_pdf(cGamma[s,:], self.alpha)
+
+        logEtaPrior = 0.0
+        for a in range(4):
+            logEtaPrior += du.log_dirichlet_pdf(cEta[a,:],self.delta)
+
+        return logGammaPrior + logEtaPrior
+
+    def storeStarState(self,iter):
+        self.gamma_star = np.copy(self.gamma)
+        self.eta_star = np.copy(self.eta)
+        self.tau_star = np.copy(self.tauStates[self.tauIndices,:,:],order='C')
+        self.tauIndices_star = np.copy(self.tauIndices)
+        self.tauProb_star = np.copy(self.tauProb)
+        self.iter_star = iter
+        self.ll_marginal_star = self.ll
+        self.lp_marginal_star = self.lp
+
+    def update(self): #perform EM updates to convergence or max_iter
+        iter = 0
+        lpl = -np.inf
+
+        (sum_mu,sum_E,self.ll) = self.eStep(self.gamma,self.eta)
+        self.lp = self.ll + self.logPrior(self.gamma,self.eta)
+        self.storeStarState(iter)
+
+        while iter < self.max_iter and math.fabs(self.lp - lpl) > self.min_change:
+            self.mStep(sum_mu,sum_E)
+
+            lpl = self.lp
+            (sum_mu,sum_E,self.ll) = self.eStep(self.gamma,self.eta)
+            self.lp = self.ll + self.logPrior(self.gamma,self.eta)
+            self.ll_store[iter] = self.ll
+
+            if self.lp > self.lp_marginal_star:
+                self.storeStarState(iter)
+
+            if (iter % 10 == 0):
+                logging.info('EM Iter %d, nlp = %f'%(iter,self.lp))
+
+            iter = iter + 1
+
+        self.tau = np.copy(self.tau_star,order='C')
+        self.jointFit()
+        logging.info('EM finished after %d iterations, nlp = %f, joint lp at tau star = %f'%(iter,self.lp_marginal_star,self.lp_star))
+
+    def updateTau(self):
+        """Computes tau posteriors with gamma_star and eta_star fixed"""
+        (sum_mu,sum_E,self.ll) = self.eStep(self.gamma_star,self.eta_star)
+
+        self.lp = self.ll + self.logPrior(self.gamma_star,self.eta_star)
+        self.storeStarState(0)
+        self.tau = np.copy(self.tau_star,order='C')
+        self.jointFit()
+
+    def logLikelihood(self,cGamma,cTau,cEta):
+        """Data log likelihood given tau as HaploSNP_Sampler.logLikelihood"""
+        probVS = np.einsum('ijk,lj,km->ilm',cTau,cGamma,cEta)
+
+        return self.logMultCoeff + (self.variants*np.log(probVS)).sum()
+
+    def jointFit(self):
+        """Sets ll_star and lp_star to the log likelihood and log posterior at tau_star, 
+        gamma_star and eta_star with the uniform tau prior of HaploSNP_Sampler.logPosterior"""
+        self.ll_star = self.logLikelihood(self.gamma_star,self.tau_star,self.eta_star)
+        self.lp_star = self.ll_star + self.logPrior(self.gamma_star,self.eta_star) + self.V*self.G*log(1.0/4.0)
+
+    def meanDeviance(self):
+        """Deviance at the MAP point, the sampler's mean over posterior samples has no 
+        EM counterpart"""
+        return -2.0*self.ll_star
+
+    def gammaMean(self):
+
+        return np.copy(self.gamma_star)
+
+    def etaMean(self):
+
+        return np.copy(self.eta_star)
+
+    def tauMean(self):
+        """Posterior marginal probability of each base in each strain"""
+        return np.copy(self.tauProb_star)
+
+    def probabilisticTau(self):
+
+        return self.tauMean()
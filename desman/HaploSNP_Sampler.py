@@ -10,6 +10,7 @@ import argparse
 import pickle
 import sampletau
 import logging 
+import multiprocessing
 
 from numpy import array, log, exp
 from scipy.special import gammaln
@@ -20,13 +21,54 @@ from numpy.random import RandomState
 from . import Variant_Filter as vf
 from . import Init_NMFT as inmft
 from . import Desman_Utils as du
+from . import Phase_Timer as pt
 
 class Constants(object):
     MAX_LOG_DIR_PROB = 100.0
 
+def tempered_log_likelihoods(variants, betas, tau, gamma, eta):
+    """Returns the log likelihood, less multinomial coefficients which cancel in swaps, 
+    of state tau, gamma, eta given the variant counts scaled by each inverse temperature 
+    and rounded. These are the targets the tempered chains sample, the Gibbs updates need 
+    integer counts so rounding approximates the likelihood raised to the power beta. The 
+    cold chain at beta = 1 is exact and swaps between the rounded targets are exact"""
+    logProb = np.log(np.einsum('ijk,lj,km->ilm',tau,gamma,eta))
+    
+    return np.array([(np.rint(beta*variants)*logProb).sum() for beta in betas])
+
+def run_tempered_chain(conn, variants, betas, k, G, seed, mini_batch, tau_batch):
+    """Runs tempered chain k in its own process on counts scaled by betas[k] and rounded,
+    an approximation to the likelihood raised to the power betas[k]. Each request
+    (n_iter, state) received on conn sets the state if given then performs n_iter Gibbs 
+    updates replying with the state and its tempered log likelihoods, None stops the chain"""
+    sampletau.initRNG()
+    sampletau.setRNG(seed)
+    
+    counts = np.rint(betas[k]*variants).astype(variants.dtype)
+    sampler = HaploSNP_Sampler(counts,G,RandomState(seed),max_iter=1,mini_batch=mini_batch,tau_batch=tau_batch)
+    
+    request = conn.recv()
+    while request is not None:
+        (n_iter, state) = request
+        if state is not None:
+            sampler.setChainState(state)
+        
+        for i in range(n_iter):
+            sampler.gibbsStep()
+        
+        conn.send((sampler.getChainState(), tempered_log_likelihoods(variants,betas,sampler.tau,sampler.gamma,sampler.eta)))
+        request = conn.recv()
+    
+    sampletau.freeRNG()
+
 class HaploSNP_Sampler():
     
-    def __init__(self,snps,G,randomState,fixed_tau=None,burn_iter=None,max_iter=None,alpha_constant=0.1,delta_constant=0.1, epsilon=1.0e-6):
+    #stores too large to rewrite at every checkpoint
+    BULK_STORES = ['tau_store','mu_store','E_store']
+    
+    def __init__(self,snps,G,randomState,fixed_tau=None,burn_iter=None,max_iter=None,alpha_constant=0.1,delta_constant=0.1, epsilon=1.0e-6,
+                 checkpoint_file=None,checkpoint_iter=50,tau_block=4096,position_block=1024,mini_batch=None,tau_batch=None,
+                 temper=None,temper_beta=0.2,swap_iter=10,timer=None,store='full',thin=1,store_file=None,precision='float64'):
 
         if burn_iter is None:
             self.burn_iter = 250
@@ -39,6 +81,13 @@ class HaploSNP_Sampler():
             self.max_iter = max_iter
             
         self.tau_comp_iter = 10
+        
+        #'full' stores mu, E and tau every thin iterations, 'compact' stores only the mu and E
+        #sums needed for gamma and eta with int8 tau, 'stream' memory maps that to store_file
+        self.store = store
+        self.thin = thin
+        self.store_file = store_file
+        self.n_store = (self.max_iter + thin - 1)//thin
 
         self.randomState = randomState
         self.G = G
@@ -46,8 +95,15 @@ class HaploSNP_Sampler():
         self.V = snps.shape[0] #number of variants
         self.S = snps.shape[1]
 
-        #set read counts per contig per sample
-        self.variants = np.copy(snps,order='C') 
+        #set read counts per contig per sample, only copied if not already C-ordered
+        self.variants = np.ascontiguousarray(snps) 
+        
+        #likelihood and tau state products run in precision, sums accumulate in float64
+        self.dtype = np.dtype(precision)
+        self.variants_compute = self.compute(self.variants)
+        
+        #multinomial coefficients do not depend on parameters so compute once
+        self.logMultCoeff = (du.log_factorial(self.variants.sum(axis=2)) - du.log_factorial(self.variants).sum(axis=2)).sum()
         
         self.epsilon = epsilon
         
@@ -64,17 +120,13 @@ class HaploSNP_Sampler():
         #assignments of genomes to SNPs
         if fixed_tau is None: 
             self.tau = np.zeros((self.V,self.G,4), dtype=np.int)
-            self.tau_store = np.zeros((self.max_iter,self.V,self.G,4), dtype=np.int)
             self.tauIndices = np.zeros((self.V),dtype=np.int)
             #assign randomly
             tri = self.randomState.randint(0, 4, self.V*self.G)
             trir = np.reshape(tri,(self.V,self.G))
-            for v in range(self.V):
-                for g in range(self.G):
-                    self.tau[v,g,trir[v,g]] = 1
+            self.tau[np.arange(self.V)[:,np.newaxis],np.arange(self.G)[np.newaxis,:],trir] = 1
         else:
             self.tau = np.reshape(fixed_tau,(self.V,self.G,4))
-            self.tau_store = np.zeros((self.max_iter,self.V,self.G,4), dtype=np.int)
             self.tauIndices = np.zeros((self.V),dtype=np.int)
             
         
@@ -84,22 +136,16 @@ class HaploSNP_Sampler():
         
         #numbers of bases of type a deriving from b with VXSXAXB
         self.E = np.zeros((self.V,self.S,4,4),dtype=np.int)
-        self.E_store = np.zeros((self.max_iter,self.V,self.S,4,4),dtype=np.int)
         
         #assignment of bases to genomes
         self.mu = np.zeros((self.V,self.S,4,self.G),dtype=np.int)
-        self.mu_store = np.zeros((self.max_iter,self.V,self.S,4,self.G),dtype=np.int)
         
-        t1 = np.tile(np.arange(4,dtype=np.int),(self.G,1))
-        temparray = du.cartesian(t1)
-        self.nTauStates = 4 ** self.G;
-        #stores all possible assignments of states to genomes TXGX4
-        self.tauStates = np.zeros((self.nTauStates,self.G,4),dtype=np.int)
+        self.allocateStores()
         
-        for t in range(self.nTauStates):
-            for g in range(self.G):
-                self.tauStates[t,g,temparray[t,g]] = 1
-                
+        #tau states are decoded from their base 4 index in blocks when needed
+        self.nTauStates = 4 ** self.G;
+        self.tau_block = tau_block
+        self.position_block = position_block
             
         #useful to store vectorized matrix of base assignments
         self.amatrix = np.identity(4, dtype=np.int)
@@ -108,12 +154,47 @@ class HaploSNP_Sampler():
         self.lp = 0.0
         self.ll_store = np.zeros(self.max_iter)
         
-        self.tauMap = np.zeros((self.G,4),dtype=np.int)
-        
-        for g in range(G):
-            for a in range(4):
-                self.tauMap[g,a] = a*(4**(G - g - 1))
-                
+        self.tauMap = du.tau_map(self.G)
+        
+        #periodic checkpoints written during update if checkpoint_file set, the tau, mu 
+        #and E stores are appended to a file each per update from row checkpointed
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_iter = checkpoint_iter
+        self.checkpointed = 0
+        self.n_update = 0
+        
+        #if set gamma and eta are sampled from mu and E on mini_batch random positions
+        #scaled up to V and tau is sampled on tau_batch positions rotating through V
+        if mini_batch is not None and mini_batch >= self.V:
+            mini_batch = None
+        if tau_batch is not None and tau_batch >= self.V:
+            tau_batch = None
+        self.mini_batch = mini_batch
+        self.tau_batch = tau_batch
+        self.tau_offset = 0
+        
+        #if temper = K > 1 update runs K - 1 hotter chains in other processes on counts
+        #scaled by inverse temperatures down to temper_beta and rounded, an approximation 
+        #to tempering the likelihood, proposing swaps every swap_iter
+        self.temper = temper
+        self.temper_beta = temper_beta
+        self.swap_iter = swap_iter
+        self.chains = None
+        
+        #hot chain states and random number generators live in their own processes
+        if checkpoint_file is not None and temper is not None and temper > 1:
+            raise ValueError('Tempered chains are not checkpointed so cannot resume identically, checkpoint without temper')
+        
+        #wall time and calls per phase of the Gibbs updates
+        if timer is None:
+            timer = pt.Phase_Timer()
+        self.timer = timer
+    
+    def compute(self, x):
+        """Casts x to the compute precision, float64 arrays are passed through unchanged"""
+        if self.dtype == np.float64:
+            return x
+        return np.asarray(x, dtype=self.dtype)
     
     def calcK(self):
     
@@ -132,6 +213,40 @@ class HaploSNP_Sampler():
         return np.einsum('jk,lj,km->lm',tauState,gamma,eta)
         #tensortdot(np.dot(tauState,eta),gamma,axes=([1],[1])) 
     
+    def tauStateProb(self,gamma,eta,start=0,end=None):
+        #returns TXSX4 base probabilities at each sample for tau states start to end
+        return np.einsum('tjk,lj,km->tlm',self.compute(du.tau_states(self.G,start,end)),self.compute(gamma),self.compute(eta))
+    
+    def stateLogProbBlocks(self,variants,gamma,eta):
+        """Generates (start, NXT log probabilities) of the NXSX4 variants for consecutive 
+        blocks of tau_block tau states"""
+        N = variants.shape[0]
+        variants_flat = np.reshape(self.compute(variants),(N,self.S*4))
+        
+        for start in range(0,self.nTauStates,self.tau_block):
+            end = min(start + self.tau_block,self.nTauStates)
+            logSiteProb = np.log(np.reshape(self.tauStateProb(gamma,eta,start,end),(end - start,self.S*4)))
+            
+            yield (start, np.dot(variants_flat,logSiteProb.T))
+    
+    def stateLogNorm(self,variants,gamma,eta):
+        """Returns the maximum, log normalising constant and most probable state 
+        over all tau states for each of the NXSX4 variants"""
+        N = variants.shape[0]
+        maxLog = np.empty(N); maxLog.fill(-np.inf)
+        sumExp = np.zeros(N)
+        maxState = np.zeros(N,dtype=np.int)
+        
+        for (start, stateLogProb) in self.stateLogProbBlocks(variants,gamma,eta):
+            blockMax = np.max(stateLogProb,axis=1)
+            newMax = np.maximum(maxLog,blockMax)
+            
+            sumExp = sumExp*np.exp(maxLog - newMax) + np.exp(stateLogProb - newMax.astype(stateLogProb.dtype)[:,np.newaxis]).sum(axis=1,dtype=np.float64)
+            maxState[blockMax > maxLog] = start + np.argmax(stateLogProb[blockMax > maxLog],axis=1)
+            maxLog = newMax
+        
+        return (maxLog, maxLog + np.log(sumExp), maxState)
+    
     def tauDist(self,tau1,tau2):
         dist = 0
         for g in range(self.G):
@@ -224,9 +339,7 @@ class HaploSNP_Sampler():
         return map
 
     def updateTauIndices(self):
-        for v in range(self.V):
-            tidx = self.mapTauState(self.tau[v,:,:])
-            self.tauIndices[v] = tidx
+        self.tauIndices = du.tau_encode(self.tau)
             
     def assignTau(self,assignMatrix):
         """Computes tau matrix for new sets of variants"""
@@ -235,33 +348,38 @@ class HaploSNP_Sampler():
         
         assignTau = np.zeros((N,self.G,4), dtype=np.int)
         conf = np.zeros(N)
-        #first compute base probabilities at each site for each state
-        siteProb = np.zeros((self.nTauStates,self.S,4))
         
-        for t in range(self.nTauStates): 
-                siteProb[t,:,:] = self.baseProbabilityGivenTau(self.tauStates[t,:,:],self.gamma_star,self.eta_star)
-        stateLogProb = np.zeros(self.nTauStates)
-        #loop each variant
-        for n in range(N):
-            #calculate probability of all possible assignments of genomes to variants
-            #at each SNP
-            #there are 4^G of these
-            for t in range(self.nTauStates):
-                st1 = np.log(siteProb[t,:,:])*assignVariants[n,:,:]
-                
-                stateLogProb[t] = st1.sum()
-            tsample = self.sampleLogProb(stateLogProb)
-            dP = np.exp(stateLogProb - np.max(stateLogProb))
-            dP = dP/np.sum(dP,axis=0)
-            conf[n] = np.amax(dP)
-            #print "Assign " + str(n) + " " + str(conf[n])
-            assignTau[n,:,:] = self.tauStates[tsample,:,:]
+        #sample each position by inverting the cumulative probability over state blocks
+        for nstart in range(0,N,self.position_block):
+            nend = min(nstart + self.position_block,N)
+            blockVariants = assignVariants[nstart:nend]
+            
+            (maxLog, logNorm, maxState) = self.stateLogNorm(blockVariants,self.gamma_star,self.eta_star)
+            conf[nstart:nend] = np.exp(maxLog - logNorm)
+            
+            u = self.randomState.uniform(size=nend - nstart)
+            cumProb = np.zeros(nend - nstart)
+            tsample = np.copy(maxState)
+            found = np.zeros(nend - nstart,dtype=bool)
+            
+            for (start, stateLogProb) in self.stateLogProbBlocks(blockVariants,self.gamma_star,self.eta_star):
+                cumBlock = cumProb[:,np.newaxis] + np.cumsum(np.exp(stateLogProb - logNorm[:,np.newaxis]),axis=1)
+                hit = np.logical_and(found != True, cumBlock[:,-1] > u)
+                tsample[hit] = start + np.argmax(cumBlock[hit] > u[hit,np.newaxis],axis=1)
+                found[hit] = True
+                cumProb = cumBlock[:,-1]
+            
+            assignTau[nstart:nend] = du.tau_decode(tsample,self.G)
+        
         return (assignTau,conf)
         
-    def sampleGamma(self):
+    def sampleGamma(self,positions=None):
         #sample gamma from Dirichlet in each sample
         #get frequencies SXG sites X genomes
-        sum_mu = self.mu.sum(axis=(0,2))
+        if positions is None:
+            sum_mu = self.mu.sum(axis=(0,2))
+        else:
+            sum_mu = self.mu[positions].sum(axis=(0,2))*(self.V/float(len(positions)))
         #loop samples setting genome frequencies
         for s in range(self.S):
             self.gamma[s,:] = self.randomState.dirichlet(self.alpha + sum_mu[s,:])
@@ -270,8 +388,11 @@ class HaploSNP_Sampler():
         row_sums = self.gamma.sum(axis=1)
         self.gamma = self.gamma / row_sums[:, np.newaxis]
         
-    def sampleEta(self):
-        Esum =  self.E.sum(axis=(0,1)) #AXB with A deriving from B
+    def sampleEta(self,positions=None):
+        if positions is None:
+            Esum =  self.E.sum(axis=(0,1)) #AXB with A deriving from B
+        else:
+            Esum = self.E[positions].sum(axis=(0,1))*(self.V/float(len(positions)))
         
         #self.E = np.zeros((self.V,self.S,4,4),dtype=np.int)
         
@@ -279,18 +400,21 @@ class HaploSNP_Sampler():
             self.eta[a,:] = self.randomState.dirichlet(self.delta + Esum[:,a])
         
         
-    def sampleMu(self,tauC,gammaC,etaC):
+    def sampleMu(self,tauC,gammaC,etaC,positions=None):
         
-        tau_gamma_eta = np.einsum('ijk,lj,km->ilmkj',tauC,gammaC,etaC)
+        if positions is None:
+            positions = np.arange(self.V)
+        
+        tau_gamma_eta = np.einsum('ijk,lj,km->ilmkj',tauC[positions],gammaC,etaC)
   
         tau_gamma_eta_gsum = tau_gamma_eta.sum(axis=4)
   
         #loop each variant
-        for v in range(self.V):
+        for (i, v) in enumerate(positions):
             #loop each site
             for s in range(self.S):
                 
-                trans_matrix = tau_gamma_eta_gsum[v,s,:,:] 
+                trans_matrix = tau_gamma_eta_gsum[i,s,:,:] 
                 tsum = trans_matrix.sum(axis=1)
                 trans_matrix = trans_matrix/tsum[:,np.newaxis] 
                 
@@ -302,11 +426,24 @@ class HaploSNP_Sampler():
                     
                     for b in range(4):
                         if(self.E[v,s,a,b] > 0):
-                            tge = tau_gamma_eta[v,s,a,b,:]
+                            tge = tau_gamma_eta[i,s,a,b,:]
                             tge = tge/tge.sum()
                             self.mu[v,s,a,:] += self.randomState.multinomial(self.E[v,s,a,b], tge)
-                     
-                       
+    
+    def sampleTauBatch(self):
+        """Samples tau with the C sampler at all positions or at the next tau_batch 
+        positions wrapping around V, returning the number changed"""
+        if self.tau_batch is None:
+            return sampletau.sample_tau(self.tau, self.gamma, self.eta, self.variants)
+        
+        start = self.tau_offset
+        end = start + self.tau_batch
+        nchange = sampletau.sample_tau(self.tau[start:end], self.gamma, self.eta, self.variants[start:end])
+        if end > self.V:
+            nchange += sampletau.sample_tau(self.tau[:end - self.V], self.gamma, self.eta, self.variants[:end - self.V])
+        
+        self.tau_offset = end % self.V
+        return nchange
                  
     def burn(self): #perform max_iter Gibbs updates
         iter = 0
@@ -329,38 +466,237 @@ class HaploSNP_Sampler():
         self.iter_star = iter
         self.lp_star = self.lp
     
-    def update(self): #perform max_iter Gibbs updates
-        iter = 0
-        self.ll = self.logLikelihood(self.gamma,self.tau,self.eta)
-        self.lp = self.logPosterior(self.gamma,self.tau,self.eta)
-        self.storeStarState(iter)
+    def update(self,n_iter=None,start_iter=0): #perform max_iter or n_iter <= max_iter Gibbs updates
+        if n_iter is None:
+            n_iter = self.max_iter
         
-        while (iter < self.max_iter):
-            self.sampleMu(self.tau,self.gamma,self.eta)
-            self.sampleGamma()
-            
-            #nchange = self.sampleTau()
-            nchange = sampletau.sample_tau(self.tau, self.gamma, self.eta, self.variants)
-           
-            self.sampleEta()
-            
+        iter = start_iter
+        if iter == 0:
             self.ll = self.logLikelihood(self.gamma,self.tau,self.eta)
             self.lp = self.logPosterior(self.gamma,self.tau,self.eta)
-            self.ll_store[iter] = self.ll
-            if(self.lp > self.lp_star):
-                self.storeStarState(iter)
-            self.mu_store[iter,]=np.copy(self.mu)
-            self.tau_store[iter,]=np.copy(self.tau)
-            self.E_store[iter,]=np.copy(self.E)
-            self.eta_store[iter,] = np.copy(self.eta)
-            self.gamma_store[iter,] = np.copy(self.gamma)
+            self.storeStarState(iter)
+            self.checkpointed = 0
+        
+        if self.temper is not None and self.temper > 1 and iter < n_iter:
+            self.startTempering()
+        
+        try:
+            self.updateIter(iter,n_iter)
+        finally:
+            self.stopTempering()
+        
+        self.n_update += 1
+        self.updateTauIndices()
+    
+    def updateIter(self,iter,n_iter):
+        block_end = iter
+        while (iter < n_iter):
+            if self.chains is not None and iter == block_end:
+                block_end = min(iter + self.swap_iter,n_iter)
+                self.runChains(block_end - iter)
+            
+            nchange = self.gibbsStep()
+            
+            with self.timer.phase('likelihood'):
+                self.ll = self.logLikelihood(self.gamma,self.tau,self.eta)
+            with self.timer.phase('posterior'):
+                self.lp = self.logPosterior(self.gamma,self.tau,self.eta)
+            
+            with self.timer.phase('store'):
+                self.ll_store[iter] = self.ll
+                if(self.lp > self.lp_star):
+                    self.storeStarState(iter)
+                self.storeIter(iter)
+                self.eta_store[iter,] = np.copy(self.eta)
+                self.gamma_store[iter,] = np.copy(self.gamma)
             
             if (iter % 10 == 0):    
                 logging.info('Gibbs Iter %d, no. changed = %d, nlp = %f'%(iter,nchange,self.lp))
             
             iter = iter + 1
-
-        self.updateTauIndices()
+            self.timer.logIter(iter)
+            
+            if self.chains is not None and iter == block_end:
+                self.swapChains()
+            
+            if self.checkpoint_file is not None and iter % self.checkpoint_iter == 0:
+                self.writeCheckpoint(iter)
+    
+    def gibbsStep(self):
+        """Performs one Gibbs update of mu, gamma, tau and eta returning number of tau changes"""
+        positions = None
+        if self.mini_batch is not None:
+            positions = np.sort(self.randomState.choice(self.V, self.mini_batch, replace=False))
+        
+        with self.timer.phase('sampleMu'):
+            self.sampleMu(self.tau,self.gamma,self.eta,positions)
+        with self.timer.phase('sampleGamma'):
+            self.sampleGamma(positions)
+        
+        #nchange = self.sampleTau()
+        with self.timer.phase('sampleTau'):
+            nchange = self.sampleTauBatch()
+       
+        with self.timer.phase('sampleEta'):
+            self.sampleEta(positions)
+        
+        return nchange
+    
+    def getChainState(self):
+        return (du.tau_encode(self.tau), np.copy(self.gamma), np.copy(self.eta))
+    
+    def setChainState(self,state):
+        (tauIndices, gamma, eta) = state
+        self.tau = np.copy(du.tau_decode(tauIndices,self.G),order='C')
+        self.tauIndices = np.copy(tauIndices)
+        self.gamma = np.copy(gamma,order='C')
+        self.eta = np.copy(eta,order='C')
+    
+    def startTempering(self):
+        """Starts the hot chains from the current state each with a seed from randomState"""
+        self.betas = self.temper_beta ** (np.arange(self.temper)/float(self.temper - 1))
+        seeds = self.randomState.randint(np.iinfo(np.int32).max, size=self.temper - 1)
+        
+        self.chains = []
+        for k in range(1,self.temper):
+            (conn, child_conn) = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_tempered_chain, 
+                        args=(child_conn,self.variants,self.betas,k,self.G,seeds[k - 1],self.mini_batch,self.tau_batch))
+            process.start()
+            child_conn.close()
+            self.chains.append((process, conn))
+        
+        #states to send hot chains with their next request
+        self.chain_states = [None] + [self.getChainState() for k in range(1,self.temper)]
+        self.swap_parity = 0
+        self.chains_running = False
+        self.swap_proposed = np.zeros(self.temper - 1,dtype=np.int)
+        self.swap_accepted = np.zeros(self.temper - 1,dtype=np.int)
+        logging.info('Started %d tempered chains with inverse temperatures %s'%(self.temper - 1,str(self.betas[1:])))
+    
+    def runChains(self,n_iter):
+        for (c, (process, conn)) in enumerate(self.chains):
+            conn.send((n_iter, self.chain_states[c + 1]))
+            self.chain_states[c + 1] = None
+        self.chains_running = True
+    
+    def swapChains(self):
+        """Collects hot chain states and proposes swaps between alternately the even 
+        or odd adjacent pairs of chains with the exact replica exchange acceptance"""
+        states = [self.getChainState()]
+        #logLL[c,k] log likelihood of the state in chain c at inverse temperature k
+        logLL = [tempered_log_likelihoods(self.variants,self.betas,self.tau,self.gamma,self.eta)]
+        for (process, conn) in self.chains:
+            (state, chainLL) = conn.recv()
+            states.append(state)
+            logLL.append(chainLL)
+        logLL = np.array(logLL)
+        self.chains_running = False
+        
+        swapped = np.zeros(self.temper,dtype=bool)
+        for i in range(self.swap_parity,self.temper - 1,2):
+            j = i + 1
+            logAccept = logLL[i,j] + logLL[j,i] - logLL[i,i] - logLL[j,j]
+            self.swap_proposed[i] += 1
+            if log(self.randomState.uniform()) < logAccept:
+                (states[i], states[j]) = (states[j], states[i])
+                logLL[[i,j]] = logLL[[j,i]]
+                swapped[i] = swapped[j] = True
+                self.swap_accepted[i] += 1
+        self.swap_parity = 1 - self.swap_parity
+        
+        if swapped[0]:
+            self.setChainState(states[0])
+        
+        for c in range(1,self.temper):
+            if swapped[c]:
+                self.chain_states[c] = states[c]
+    
+    def stopTempering(self):
+        if self.chains is None:
+            return
+        
+        for (process, conn) in self.chains:
+            #chains still running a block if update was interrupted
+            if self.chains_running:
+                process.terminate()
+            else:
+                conn.send(None)
+            process.join()
+            conn.close()
+        self.chains = None
+        
+        rates = self.swap_accepted/np.maximum(self.swap_proposed,1).astype(np.float)
+        logging.info('Stopped tempered chains, swap acceptance rates %s'%str(rates))
+    
+    def checkpointStoreFile(self,name,n_update):
+        return '%s.%s.%d'%(self.checkpoint_file,name,n_update)
+    
+    def writeCheckpoint(self,iter):
+        """Writes sampler state, star state, traces up to iter and both RNG states so that
+        update(start_iter=iter) after readCheckpoint continues identically. The tau, mu and
+        E stores only grow during an update so just rows stored since the last checkpoint
+        are appended to their files, which are per update as each refills them from row 0"""
+        stored = self.storedCount(iter)
+        for name in self.BULK_STORES:
+            du.write_rows(self.checkpointStoreFile(name,self.n_update),getattr(self,name),self.checkpointed,stored)
+        self.checkpointed = stored
+        
+        state = {'G' : np.array(self.G), 'iter' : np.array(iter), 'n_update' : np.array(self.n_update),
+                 'tau' : self.tau, 'gamma' : self.gamma, 'eta' : self.eta, 'tauIndices' : self.tauIndices,
+                 'tau_star' : self.tau_star, 'gamma_star' : self.gamma_star, 'eta_star' : self.eta_star, 
+                 'tauIndices_star' : self.tauIndices_star, 'iter_star' : np.array(self.iter_star), 
+                 'lp_star' : np.array(self.lp_star), 'll' : np.array(self.ll), 'lp' : np.array(self.lp),
+                 'll_store' : self.ll_store[:iter], 'gamma_store' : self.gamma_store[:iter], 
+                 'eta_store' : self.eta_store[:iter], 'tau_offset' : np.array(self.tau_offset), 'sampletau_rng' : sampletau.getRNGState()}
+        state.update(du.get_rng_state(self.randomState))
+        
+        du.write_checkpoint(self.checkpoint_file,state)
+        
+        #stores of the previous update are no longer referenced
+        for name in self.BULK_STORES:
+            previous = self.checkpointStoreFile(name,self.n_update - 1)
+            if os.path.exists(previous):
+                os.remove(previous)
+        logging.info('Wrote checkpoint at Gibbs Iter %d to %s'%(iter,self.checkpoint_file))
+    
+    def readCheckpoint(self,fileName):
+        """Restores state written by writeCheckpoint returning the iteration to resume from,
+        n_update gives the number of completed calls to update"""
+        state = du.read_checkpoint(fileName)
+        
+        if int(state['G']) != self.G:
+            self.G = int(state['G'])
+            self.allocateG()
+        
+        self.tau = np.copy(state['tau'],order='C')
+        self.gamma = np.copy(state['gamma'],order='C')
+        self.eta = np.copy(state['eta'],order='C')
+        self.tauIndices = state['tauIndices']
+        
+        self.tau_star = state['tau_star']
+        self.gamma_star = state['gamma_star']
+        self.eta_star = state['eta_star']
+        self.tauIndices_star = state['tauIndices_star']
+        self.iter_star = int(state['iter_star'])
+        self.lp_star = float(state['lp_star'])
+        self.ll = float(state['ll'])
+        self.lp = float(state['lp'])
+        
+        iter = int(state['iter'])
+        self.n_update = int(state['n_update'])
+        self.tau_offset = int(state['tau_offset'])
+        for name in ['ll_store','gamma_store','eta_store']:
+            getattr(self,name)[:iter] = state[name]
+        self.checkpointed = self.storedCount(iter)
+        for name in self.BULK_STORES:
+            du.read_rows(self.checkpointStoreFile(name,self.n_update),getattr(self,name),self.checkpointed)
+        
+        du.set_rng_state(self.randomState,state)
+        sampletau.setRNGState(state['sampletau_rng'])
+        
+        logging.info('Read checkpoint at Gibbs Iter %d from %s'%(iter,fileName))
+        return iter
          
     def burnTau(self):
         iter = 0
@@ -384,19 +720,24 @@ class HaploSNP_Sampler():
         self.lp = self.logPosterior(self.gamma_store[0,:],self.tau,self.eta_store[0,:])
         self.lp_star = self.lp
         self.tau_star = np.copy(self.tau)
-        self.tau_store[iter,]=np.copy(self.tau)
+        self.storeTau(iter)
         
         while (iter < self.max_iter):
-            nchange = sampletau.sample_tau(self.tau, self.gamma_store[iter,:], self.eta_store[iter,:], self.variants)        
+            with self.timer.phase('sampleTau'):
+                nchange = sampletau.sample_tau(self.tau, self.gamma_store[iter,:], self.eta_store[iter,:], self.variants)        
             #nchange = self.sampleTau(self.gamma_star,self.eta_star)
-            self.ll = self.logLikelihood(self.gamma_store[iter,:],self.tau,self.eta_store[iter,:])
-            self.lp = self.logPosterior(self.gamma_store[iter,:],self.tau,self.eta_store[iter,:])
-            if (self.lp > self.lp_star):
-                self.tau_star = np.copy(self.tau)
-                self.lp_star = self.lp
-            
-            self.tau_store[iter,]=np.copy(self.tau)
-            self.ll_store[iter]=self.ll
+            with self.timer.phase('likelihood'):
+                self.ll = self.logLikelihood(self.gamma_store[iter,:],self.tau,self.eta_store[iter,:])
+            with self.timer.phase('posterior'):
+                self.lp = self.logPosterior(self.gamma_store[iter,:],self.tau,self.eta_store[iter,:])
+            
+            with self.timer.phase('store'):
+                if (self.lp > self.lp_star):
+                    self.tau_star = np.copy(self.tau)
+                    self.lp_star = self.lp
+                
+                self.storeTau(iter)
+                self.ll_store[iter]=self.ll
             if (iter % 10 == 0):    
                 logging.info('Gibbs Iter %d, no. changed = %d, nll = %f'%(iter,nchange,self.lp))
 
@@ -417,9 +758,7 @@ class HaploSNP_Sampler():
             self.lp = self.logPosterior(self.gamma,self.tau,self.eta)
             if(self.lp > self.lp_star):
                 self.storeStarState(iter)
-            self.mu_store[iter,]=np.copy(self.mu)
-            self.tau_store[iter,]=np.copy(self.tau)
-            self.E_store[iter,]=np.copy(self.E)
+            self.storeIter(iter)
             self.eta_store[iter,] = np.copy(self.eta)
             self.gamma_store[iter,] = np.copy(self.gamma)    
             
@@ -428,16 +767,9 @@ class HaploSNP_Sampler():
     
     def logLikelihood(self,cGamma,cTau,cEta):
         """Computes data log likelihood given parameter states"""
-        logLL = 0.0
-        
-        probVS = np.einsum('ijk,lj,km->ilm',cTau,cGamma,cEta)
+        probVS = np.einsum('ijk,lj,km->ilm',self.compute(cTau),self.compute(cGamma),self.compute(cEta))
         
-        #loop each variant
-        for v in range(self.V):
-            #loop each site
-            for s in range(self.S):                    
-                logLL += du.log_multinomial_pdf(self.variants[v,s,:], probVS[v,s,:])
-        return logLL
+        return self.logMultCoeff + (self.variants_compute*np.log(probVS)).sum(dtype=np.float64)
     
     def logPosterior(self,cGamma,cTau,cEta):
     
@@ -496,28 +828,17 @@ class HaploSNP_Sampler():
     def logTauProb(self,cGamma,cEta):
         
         ret = 0.0
-    
-        #first compute base probabilities at each site for each state
-        siteProb = np.zeros((self.nTauStates,self.S,4))
-        
-        for t in range(self.nTauStates): 
-            siteProb[t,:,:] = self.baseProbabilityGivenTau(self.tauStates[t,:,:],cGamma,cEta)
         
-        stateLogProb = np.zeros(self.nTauStates)
-        #loop each position
-        for v in range(self.V):
-            #calculate probability of all possible assignments of genomes to variants
-            #at each SNP
-            #there are 4^G of these
-            for t in range(self.nTauStates):
-                st1 = np.log(siteProb[t,:,:])*self.variants[v,:,:]
-                
-                stateLogProb[t] = st1.sum()
+        #log probability of star state at each position normalised over all tau states
+        for vstart in range(0,self.V,self.position_block):
+            vend = min(vstart + self.position_block,self.V)
             
-            dP = np.exp(stateLogProb - np.max(stateLogProb))
-            dP = dP/np.sum(dP,axis=0)
-        
-            ret += log(dP[self.tauIndices_star[v]])
+            (maxLog, logNorm, maxState) = self.stateLogNorm(self.variants[vstart:vend],cGamma,cEta)
+            
+            starProb = np.einsum('vga,sg,ab->vsb',self.compute(du.tau_decode(self.tauIndices_star[vstart:vend],self.G)),self.compute(cGamma),self.compute(cEta))
+            starLogProb = (np.log(starProb)*self.variants_compute[vstart:vend]).sum(axis=(1,2),dtype=np.float64)
+            
+            ret += (starLogProb - logNorm).sum()
             
         return ret
 
@@ -550,10 +871,10 @@ class HaploSNP_Sampler():
         logTauPrior = self.V*self.G*log(1.0/4.0)
 
         #compute eta term
-        storeLogEpsilon = np.zeros(self.max_iter)
-        for i in range(self.max_iter):
+        storeLogEpsilon = np.zeros(self.n_store)
+        for i in range(self.n_store):
             
-            sum_E =  self.E_store[i,].sum(axis=(0,1))
+            sum_E =  self.storedSumE(i)
             
             logTotalE = 0.0
             for a in range(4):
@@ -803,36 +1124,71 @@ class HaploSNP_Sampler():
         self.tau = tau_new
         self.G = NU
         
+        self.allocateG()
+    
+        self.updateTauIndices()
+    
+    def allocateStores(self):
+        """Allocates the tau, mu and E stores of n_store iterations given store"""
+        if self.store == 'full':
+            self.tau_store = np.zeros((self.n_store,self.V,self.G,4), dtype=np.int)
+            self.mu_store = np.zeros((self.n_store,self.V,self.S,4,self.G),dtype=np.int)
+            self.E_store = np.zeros((self.n_store,self.V,self.S,4,4),dtype=np.int)
+        else:
+            if self.store == 'stream':
+                self.tau_store = np.memmap(self.store_file, dtype=np.int8, mode='w+', shape=(self.n_store,self.V,self.G,4))
+            else:
+                self.tau_store = np.zeros((self.n_store,self.V,self.G,4), dtype=np.int8)
+            #mu summed over positions and bases SXG, E over positions and samples AXB
+            self.mu_store = np.zeros((self.n_store,self.S,self.G),dtype=np.int)
+            self.E_store = np.zeros((self.n_store,4,4),dtype=np.int)
+    
+    def storedCount(self,iter):
+        #number of stored iterations before iter
+        return (iter + self.thin - 1)//self.thin
+    
+    def storeIter(self,iter):
+        """Stores mu, E and tau if iter is a multiple of thin"""
+        if iter % self.thin != 0:
+            return
+        
+        if self.store == 'full':
+            self.mu_store[iter//self.thin,] = self.mu
+            self.E_store[iter//self.thin,] = self.E
+        else:
+            self.mu_store[iter//self.thin,] = self.mu.sum(axis=(0,2))
+            self.E_store[iter//self.thin,] = self.E.sum(axis=(0,1))
+        self.tau_store[iter//self.thin,] = self.tau
+    
+    def storeTau(self,iter):
+        if iter % self.thin == 0:
+            self.tau_store[iter//self.thin,] = self.tau
+    
+    def storedSumE(self,i):
+        #AXB sum of E at stored iteration i
+        if self.store == 'full':
+            return self.E_store[i,].sum(axis=(0,1))
+        
+        return self.E_store[i,]
+    
+    def allocateG(self):
+        """Reallocates priors, stores and tau states after a change in G"""
         self.alpha = np.empty(self.G); self.alpha.fill(self.alpha_constant)
         self.gamma_store = np.zeros((self.max_iter,self.S,self.G))
-        self.tau_store = np.zeros((self.max_iter,self.V,self.G,4), dtype=np.int)
         
         #assignment of bases to genomes
         self.mu = np.zeros((self.V,self.S,4,self.G),dtype=np.int)
-        self.mu_store = np.zeros((self.max_iter,self.V,self.S,4,self.G),dtype=np.int)
-        
-        t1 = np.tile(np.arange(4,dtype=np.int),(self.G,1))
-        temparray = du.cartesian(t1)
-        self.nTauStates = 4 ** self.G;
-        #stores all possible assignments of states to genomes TXGX4
-        self.tauStates = np.zeros((self.nTauStates,self.G,4),dtype=np.int)
         
-        for t in range(self.nTauStates):
-            for g in range(self.G):
-                self.tauStates[t,g,temparray[t,g]] = 1    
+        self.allocateStores()
         
-        self.tauMap = np.zeros((self.G,4),dtype=np.int)
+        self.nTauStates = 4 ** self.G;
         
-        for g in range(self.G):
-            for a in range(4):
-                self.tauMap[g,a] = a*(4**(self.G - g - 1))    
-    
-        self.updateTauIndices()
+        self.tauMap = du.tau_map(self.G)
     
     def probabilisticTau(self):    
         
         sumTau = self.tau_store.sum(axis = 0)
         
-        probTau = sumTau/float(self.max_iter)
+        probTau = sumTau/float(self.n_store)
         
         return probTau
\ No newline at end of file
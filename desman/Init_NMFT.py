@@ -6,9 +6,11 @@ import scipy.stats as ss
 import scipy as sp
 import scipy.misc as spm
 import math
+import time
 import argparse
 import pickle
 import logging
+import multiprocessing
 
 from operator import mul, eq, ne, add, ge, le, itemgetter
 
@@ -25,14 +27,53 @@ from numpy.random import RandomState
 
 #user defined modules
 from . import Desman_Utils as du
+from . import Phase_Timer as pt
+
+#per worker process state set by init_worker
+_worker = {}
+
+def init_worker(init_NMFT):
+    _worker['init_NMFT'] = init_NMFT
+
+def call_worker(task):
+    (method, argument) = task
+    return getattr(_worker['init_NMFT'], method)(argument)
+
+def recon_floor(dtype):
+    """Reconstructions at or below this are replaced by eps before dividing, only zeros in 
+    float64 but everything below eps in float32 where frequencies over denormal values overflow"""
+    if np.dtype(dtype) == np.float64:
+        return 0.0
+    return np.finfo(dtype).eps
+
+def dirichlet_tau(randomState, alpha4, V, G):
+    """Draws a VXGX4 Dirichlet(alpha4) sample for every position and strain as normalised 
+    gamma variates, consuming the random stream exactly as dirichlet called per (v,g)"""
+    temp = randomState.standard_gamma(alpha4, size=(V,G,4))
+    
+    #summed and inverted in the same order as dirichlet
+    temp_sum = temp[:,:,0] + temp[:,:,1] + temp[:,:,2] + temp[:,:,3]
+    temp *= (1.0/temp_sum)[:,:,np.newaxis]
+    
+    return temp
 
 class Init_NMFT:
     """Initialises tau and gamma based on tensor non-negative matrix factorization""" 
    
     BASE_PRIOR = 1.0
+    
+    SOLVERS = ['mu','accelerated']
+    
+    #extrapolation schedule of the accelerated solver
+    BETA_START = 0.5
+    BETA_GROW = 1.1
+    BETA_MAX_GROW = 1.05
+    BETA_SHRINK = 2.0
    
-    def __init__(self,snps, rank, randomState, n_run = 1, max_iter = 5000, min_change = 1.0e-5,alpha_constant=0.01):
+    def __init__(self,snps, rank, randomState, n_run = 1, max_iter = 5000, min_change = 1.0e-5,alpha_constant=0.01,timer=None,check_iter=1,workers=1,solver='mu',precision='float64'):
         
+        self.snps = snps
+        self.alpha_constant = alpha_constant
         self.V = snps.shape[0] #number of variants
         self.S = snps.shape[1] # cos there are 4 bases
         self.G = rank;
@@ -40,6 +81,19 @@ class Init_NMFT:
         self.n_run = n_run;
         self.max_iter = max_iter;
         self.min_change = min_change;
+        self.check_iter = check_iter #iterations between divergence evaluations
+        self.workers = workers #processes for n_run > 1 restarts and tau chunks
+        self.divergence = None
+        
+        if solver not in self.SOLVERS:
+            raise ValueError('Unknown NTF solver %s' % solver)
+        self.solver = solver
+        self.n_iter = 0
+        self.trace = []
+        
+        if timer is None:
+            timer = pt.Phase_Timer()
+        self.timer = timer
         
         self.alpha = np.empty(self.G); self.alpha.fill(alpha_constant)
         self.alpha4 = np.empty(4); self.alpha4.fill(alpha_constant)
@@ -50,15 +104,16 @@ class Init_NMFT:
         site_sum = variants.sum(axis = 2)
         freq = variants/site_sum[:,:,np.newaxis]
         
+        #rows are ordered base major so row v + a*V holds base a at position v
         self.N = self.V*4
-        self.freq_matrix = np.zeros((self.N,self.S))
-        
-        for a in range(4):
-            for v in range(self.V):
-                self.freq_matrix[v + a*self.V,:] = freq[v,:,a] 
+        #factors and work buffers take the dtype of freq_matrix, divergences are summed in float64
+        self.dtype = np.dtype(precision)
+        self.freq_matrix = np.ascontiguousarray(np.reshape(np.transpose(freq,(2,0,1)),(self.N,self.S)), dtype=self.dtype)
                 
         self.tau = np.zeros((self.N,self.G))
         self.gamma = np.zeros((self.G,self.S))        
+        
+        self.recon = None
                 
         
     def random_initialize(self):
@@ -68,176 +123,533 @@ class Init_NMFT:
         else:
             temp = np.ones((self.S,self.G))
         self.gamma = np.transpose(temp)
-                
-        for v in range(self.V):
-            for g in range(self.G):
-                tempvg = self.randomState.dirichlet(self.alpha4)
-                for a in range(4):
-                    self.tau[v + a*self.V,g] = tempvg[a] 
+
+        self.random_initialize_tau()
     
     def random_initialize_tau(self):
-                
-        for v in range(self.V):
-            for g in range(self.G):
-                tempvg = self.randomState.dirichlet(self.alpha4)
-                for a in range(4):
-                    self.tau[v + a*self.V,g] = tempvg[a] 
+        self.tau = self.to_rows(self.dirichlet_tau())
+    
+    def dirichlet_tau(self):
+        return dirichlet_tau(self.randomState, self.alpha4, self.V, self.G)
+    
+    def to_rows(self, tau):
+        """Converts VXGX4 into the 4V X G base major layout"""
+        return np.reshape(np.transpose(tau,(2,0,1)),(self.N,self.G))
+    
+    def tau_view(self):
+        """4 X V X G view of the 4V X G tau"""
+        return np.reshape(self.tau,(4,self.V,self.G))
     
     def _adjustment(self):
         """Adjust small values to factors to avoid numerical underflow."""
-        self.tau = np.maximum(self.tau, np.finfo(self.tau.dtype).eps)
-        self.gamma = np.maximum(self.gamma, np.finfo(self.gamma.dtype).eps)
+        np.maximum(self.tau, self.eps, out=self.tau)
+        np.maximum(self.gamma, self.eps, out=self.gamma)
+        self.recon_valid = False
    
     def _adjustment_input(self,X):
         """Adjust small values to factors to avoid numerical underflow."""
         X = np.maximum(X, np.finfo(self.tau.dtype).eps)
  
         return X
-    def factorize(self):
     
-        for run in range(self.n_run):
-            self.random_initialize()
-            self._adjustment()        
-            divl = 0.0
-            div = self.div_objective()
-            iter=0
-            while iter < self.max_iter and math.fabs(divl - div) > self.min_change:
-                self.div_update()
-                self._adjustment()
+    def allocate(self):
+        """Takes private C ordered copies of tau and gamma, which may have been set to views 
+        of sampler arrays, and allocates the NXS and NXG work buffers once so updates and 
+        objectives run in place"""
+        self.tau = np.array(self.tau, dtype=self.freq_matrix.dtype, order='C')
+        self.gamma = np.array(self.gamma, dtype=self.freq_matrix.dtype, order='C')
+        
+        self.eps = np.finfo(self.freq_matrix.dtype).eps
+        self.recon_floor = recon_floor(self.freq_matrix.dtype)
+        
+        #zeros are fixed points of the updates so draws that underflowed float32 start at eps
+        if self.recon_floor > 0:
+            np.maximum(self.tau, self.eps, out=self.tau)
+        
+        if self.recon is None or self.recon.shape != self.freq_matrix.shape:
+            #as du.elop zero entries are replaced by eps before dividing
+            self.freq_nonzero = np.copy(self.freq_matrix)
+            self.freq_nonzero[self.freq_nonzero == 0] = self.eps
+            
+            self.recon = np.empty_like(self.freq_matrix) #tau.gamma shared by updates and objective
+            self.ratio = np.empty_like(self.freq_matrix)
+            self.work = np.empty_like(self.freq_matrix)
+            self.tau_num = np.empty((self.N,self.G), dtype=self.freq_matrix.dtype)
+            self.tau_sum = np.empty((self.V,self.G), dtype=self.freq_matrix.dtype)
+            self.gamma_num = np.empty((self.G,self.S), dtype=self.freq_matrix.dtype)
+        
+        self.recon_valid = False
+    
+    def _nonzero(self, X, floor=0.0):
+        X[X <= floor] = self.eps
+        return X
+    
+    def reconstruct(self):
+        """Computes tau.gamma into the reconstruction buffer unless it is current"""
+        if not self.recon_valid:
+            np.dot(self.tau, self.gamma, out=self.recon)
+            self.recon_valid = True
+        return self.recon
+    
+    def iterate(self, update, adjust, factors=('tau','gamma')):
+        """Runs update until the divergence, evaluated every check_iter iterations, changes 
+        by no more than min_change or max_iter is reached, recording (iteration, seconds, 
+        divergence) at each evaluation in trace"""
+        if self.solver == 'accelerated':
+            return self.iterate_accelerated(update, adjust, factors)
+        
+        start = time.perf_counter()
+        divl = 0.0
+        div = self.div_objective()
+        self.trace = [(0, 0.0, div)]
+        iter=0
+        while iter < self.max_iter and math.fabs(divl - div) > self.min_change:
+            with self.timer.phase('NTF update'):
+                update()
+                if adjust:
+                    self._adjustment()
+            
+            if iter % self.check_iter == 0:
                 divl = div
-                div = self.div_objective()
+                with self.timer.phase('NTF objective'):
+                    div = self.div_objective()
+                self.trace.append((iter + 1, time.perf_counter() - start, div))
  
                 if iter % 100 == 0:
                     logging.info('NTF Iter %d, div = %f'%(iter,div)) 
 
-                iter += 1
-                
-    def factorize_gamma(self):
-        for run in range(self.n_run):
-           
-            divl = 0.0
-            div = self.div_objective()
-            iter=0
-            while iter < self.max_iter and math.fabs(divl - div) > self.min_change:
-                self.div_update_gamma()
-                #self._adjustment()
-                divl = div
+            iter += 1
+        
+        self.n_iter = iter
+        return div
+    
+    def iterate_accelerated(self, update, adjust, factors):
+        """Multiplicative updates with adaptive extrapolation (Ang and Gillis, Neural 
+        Computation 2019). Each update starts from y = x + beta(x - x_prev) projected back 
+        onto the simplices, beta grows while the divergence falls and is cut with a plain 
+        step from x when it rises. The divergence is evaluated every iteration at x, the 
+        update output, which is returned in tau and gamma"""
+        start = time.perf_counter()
+        
+        prev = {}
+        delta = {}
+        for name in factors:
+            prev[name] = np.copy(getattr(self, name))
+            delta[name] = np.empty_like(prev[name])
+        
+        beta = self.BETA_START
+        beta_max = 1.0
+        
+        divl = 0.0
+        div = self.div_objective()
+        self.trace = [(0, 0.0, div)]
+        iter=0
+        while iter < self.max_iter and math.fabs(divl - div) > self.min_change:
+            with self.timer.phase('NTF update'):
+                update()
+                if adjust:
+                    self._adjustment()
+            
+            divl = div
+            with self.timer.phase('NTF objective'):
                 div = self.div_objective()
- 
-                if iter % 100 == 0: 
-                    print(str(iter) + "," + str(div))
+            self.trace.append((iter + 1, time.perf_counter() - start, div))
+            
+            with self.timer.phase('NTF extrapolate'):
+                if div < divl:
+                    beta = min(beta_max, beta*self.BETA_GROW)
+                    beta_max = min(1.0, beta_max*self.BETA_MAX_GROW)
+                    
+                    for name in factors:
+                        x = getattr(self, name)
+                        np.subtract(x, prev[name], out=delta[name])
+                        np.copyto(prev[name], x)
+                        delta[name] *= beta
+                        x += delta[name]
+                    self.project(factors)
+                else:
+                    #restart from x without extrapolation
+                    beta_max = beta
+                    beta = beta/self.BETA_SHRINK
+                    for name in factors:
+                        np.copyto(prev[name], getattr(self, name))
+            
+            if iter % 100 == 0:
+                logging.info('NTF Iter %d, div = %f, beta = %f'%(iter,div,beta)) 
 
-                iter += 1
+            iter += 1
+        
+        #return x rather than the extrapolated point
+        for name in factors:
+            np.copyto(getattr(self, name), prev[name])
+        self.recon_valid = False
+        
+        self.n_iter = iter
+        return div
+    
+    def project(self, factors):
+        """Clips extrapolated factors at eps and renormalises tau over bases and gamma over strains"""
+        if 'tau' in factors:
+            np.maximum(self.tau, self.eps, out=self.tau)
+            tau_view = self.tau_view()
+            np.sum(tau_view, axis=0, out=self.tau_sum)
+            tau_view /= self.tau_sum[np.newaxis,:,:]
+        
+        if 'gamma' in factors:
+            np.maximum(self.gamma, self.eps, out=self.gamma)
+            self.gamma /= self.gamma.sum(axis = 0)[np.newaxis,:]
+        
+        self.recon_valid = False
+    
+    def __getstate__(self):
+        #work buffers are reallocated rather than sent to workers
+        state = dict(self.__dict__)
+        for name in ['recon','ratio','work','tau_num','tau_sum','gamma_num','freq_nonzero']:
+            state.pop(name, None)
+        state['recon'] = None
+        return state
+    
+    def factorize(self):
+        """Factorizes from n_run random starts keeping the lowest divergence solution, 
+        restarts are seeded from randomState and run on up to workers processes"""
+        if self.n_run == 1:
+            self.divergence = self.factorize_run()
+            return
+        
+        self.best_restart('restart', 'NTF restarts')
+    
+    def best_restart(self, method, description):
+        """Calls method with n_run seeds drawn from randomState keeping the returned 
+        divergence, tau and gamma with the lowest divergence"""
+        seeds = self.randomState.randint(np.iinfo(np.int32).max, size=self.n_run)
+        
+        results = self.run_tasks(method, seeds, description)
+        
+        for (run, (divergence, tau, gamma)) in enumerate(results):
+            logging.info('NTF restart %d, div = %f' % (run, divergence))
+        
+        best = np.argmin([divergence for (divergence, tau, gamma) in results])
+        (self.divergence, self.tau, self.gamma) = results[best]
+        self.allocate()
+        logging.info('Keep NTF restart %d with div = %f' % (best, self.divergence))
+    
+    def run_tasks(self, method, arguments, description):
+        """Calls method with each argument on a pool of up to workers processes, each 
+        holding a copy of this object, or serially in this process"""
+        workers = max(1, min(self.workers, len(arguments)))
+        if workers > 1 and multiprocessing.current_process().daemon:
+            logging.info('Already in a worker process so running %s serially' % description)
+            workers = 1
+        
+        logging.info('Run %d %s on %d workers' % (len(arguments), description, workers))
+        if workers > 1:
+            pool = multiprocessing.Pool(processes=workers, initializer=init_worker, initargs=(self,))
+            try:
+                return pool.map(call_worker, [(method, argument) for argument in arguments])
+            finally:
+                pool.close()
+                pool.join()
+        
+        return [getattr(self, method)(argument) for argument in arguments]
+    
+    def restart(self, seed):
+        """Runs one factorization seeded with seed returning its divergence, tau and gamma"""
+        return self.seeded_run(self.factorize_run, seed)
+    
+    def restart_tau(self, seed):
+        """As restart fitting tau alone with gamma fixed"""
+        return self.seeded_run(self.factorize_tau_run, seed)
+    
+    def seeded_run(self, run, seed):
+        randomState = self.randomState
+        self.randomState = RandomState(seed)
+        try:
+            divergence = run()
+        finally:
+            self.randomState = randomState
+        
+        return (divergence, np.copy(self.tau), np.copy(self.gamma))
+    
+    def child(self, snps, randomState, n_run = 1):
+        """Init_NMFT with these settings on a subset of positions fitted n_run times"""
+        return Init_NMFT(snps, self.G, randomState, n_run = n_run, max_iter = self.max_iter, min_change = self.min_change,
+                         alpha_constant = self.alpha_constant, timer = self.timer, check_iter = self.check_iter, 
+                         workers = self.workers, solver = self.solver, precision = self.dtype)
+    
+    def factorize_subsample(self, n_subsample, chunk_size=None):
+        """Factorizes n_subsample randomly chosen positions, keeping the best of n_run restarts, 
+        then fixes gamma and fits tau once alone over the remaining positions in chunks of 
+        chunk_size, defaulting to n_subsample, which run on up to workers processes"""
+        if n_subsample >= self.V:
+            self.factorize()
+            return
+        
+        if chunk_size is None:
+            chunk_size = n_subsample
+        
+        subsample = np.sort(self.randomState.choice(self.V, n_subsample, replace=False))
+        rest = np.setdiff1d(np.arange(self.V), subsample)
+        logging.info('Perform NTF on %d of %d positions' % (n_subsample, self.V))
+        
+        init_NMFT_sub = self.child(self.snps[subsample], self.randomState, self.n_run)
+        init_NMFT_sub.factorize()
+        self.gamma = init_NMFT_sub.gamma
+        
+        logging.info('Extend NTF tau to %d remaining positions' % rest.shape[0])
+        tau_view = np.empty((4,self.V,self.G), dtype=self.freq_matrix.dtype)
+        tau_view[:,subsample,:] = init_NMFT_sub.tau_view()
+        tau_view[:,rest,:] = self.extend_tau(rest, chunk_size)
+        self.tau = np.reshape(tau_view,(self.N,self.G))
+        
+        self.allocate()
+        self.divergence = self.div_objective()
+        logging.info('Subsample NTF div = %f' % self.divergence)
+    
+    def factorize_tau_chunks(self, chunk_size=None):
+        """As factorize_tau with gamma fixed, fitting positions in independent chunks of 
+        chunk_size on up to workers processes. Each chunk is fitted once from a random tau 
+        so n_run is ignored, restarts are only worth their cost on the full factorization"""
+        if chunk_size is None or self.V <= chunk_size:
+            self.factorize_tau_run()
+            return
+        
+        self.tau = np.reshape(self.extend_tau(np.arange(self.V), chunk_size),(self.N,self.G))
+        self.allocate()
+    
+    def extend_tau(self, positions, chunk_size):
+        """Fits tau at positions with gamma fixed in chunks each seeded from randomState 
+        returning the 4 X len(positions) X G tau"""
+        starts = list(range(0, positions.shape[0], chunk_size))
+        seeds = self.randomState.randint(np.iinfo(np.int32).max, size=len(starts))
+        chunks = [(positions[start:start + chunk_size], seed) for (start, seed) in zip(starts, seeds)]
+        
+        return np.concatenate(self.run_tasks('tau_chunk', chunks, 'NTF tau chunks'), axis=1)
+    
+    def tau_chunk(self, chunk):
+        (positions, seed) = chunk
+        init_NMFT_chunk = self.child(self.snps[positions], RandomState(seed))
+        init_NMFT_chunk.gamma = np.copy(self.gamma)
+        init_NMFT_chunk.factorize_tau()
+        return init_NMFT_chunk.tau_view()
+    
+    def factorize_run(self):
+        self.random_initialize()
+        self.allocate()
+        self._adjustment()
+        return self.iterate(self.div_update, True)
+                
+    def factorize_gamma(self):
+        """Fits gamma with tau fixed, the updates start from the current gamma rather than 
+        a random one so this runs once whatever n_run"""
+        self.allocate()
+        self.divergence = self.iterate(self.div_update_gamma, False, ('gamma',))
 
     def factorize_tau(self):
-        for run in range(self.n_run):
-            self.random_initialize_tau()
-            divl = 0.0
-            div = self.div_objective()
-            iter=0
-            while iter < self.max_iter and math.fabs(divl - div) > self.min_change:
-                self.div_update_tau()
-                #self._adjustment()
-                divl = div
-                div = self.div_objective()
- 
-                if iter % 100 == 0:
-                    logging.info('NTF Iter %d, div = %f'%(iter,div))
-
-                iter += 1
-
+        """Fits tau with gamma fixed from n_run random starts keeping the lowest divergence"""
+        if self.n_run == 1:
+            self.divergence = self.factorize_tau_run()
+            return
+        
+        self.best_restart('restart_tau', 'NTF tau restarts')
+    
+    def factorize_tau_run(self):
+        self.random_initialize_tau()
+        self.allocate()
+        return self.iterate(self.div_update_tau, False, ('tau',))
 
     def div_objective(self):
         """Compute divergence of target matrix from its NMF estimate."""
-        pa = self._adjustment_input(np.dot(self.tau, self.gamma))
+        pa = np.maximum(self.reconstruct(), self.eps, out=self.work)
         
-        return (np.multiply(self.freq_matrix, np.log(du.elop(self.freq_matrix, pa, div))) - self.freq_matrix + pa).sum()
+        terms = np.divide(self.freq_nonzero, pa, out=self.ratio)
+        np.log(terms, out=terms)
+        terms *= self.freq_matrix
+        terms -= self.freq_matrix
+        terms += pa
+        
+        return terms.sum(dtype=np.float64)
         
     def div_update(self):
         """Update basis and mixture matrix based on divergence multiplicative update rules."""
-        H1 = np.tile(self.tau.sum(0)[:,np.newaxis],(1, self.S))
-        
         if self.G > 1:
-            self.gamma = np.multiply(self.gamma, du.elop(np.dot(self.tau.T, du.elop(self.freq_matrix, np.dot(self.tau, self.gamma), div)), H1, div))
-
-            gamma_sum = self.gamma.sum(axis = 0)
-            self.gamma = self.gamma/gamma_sum[np.newaxis,:]
+            self.div_update_gamma()
         else:
-            self.gamma = np.ones((self.G,self.S))
+            self.gamma.fill(1.)
+            self.recon_valid = False
 
-        tau1 = np.tile(self.gamma.sum(1)[np.newaxis,:],(self.N, 1))
-        self.tau = np.multiply(
-            self.tau, du.elop(np.dot(du.elop(self.freq_matrix, np.dot(self.tau, self.gamma), div), self.gamma.T), tau1, div)) 
-            
-        for v in range(self.V):
-            for g in range(self.G):
-                sumvg = 0.0
-                for a in range(4):
-                    sumvg += self.tau[v + a*self.V,g]
-                    
-                for a in range(4):
-                    self.tau[v + a*self.V,g] = self.tau[v + a*self.V,g]/sumvg 
+        self.div_update_tau()
 
     def div_update_gamma(self):
         """Update basis and mixture matrix based on divergence multiplicative update rules."""
-        H1 = np.tile(self.tau.sum(0)[:,np.newaxis],(1, self.S))
+        ratio = np.divide(self.freq_nonzero, self._nonzero(self.reconstruct(), self.recon_floor), out=self.ratio)
         
-        self.gamma = np.multiply(self.gamma, du.elop(np.dot(self.tau.T, du.elop(self.freq_matrix, np.dot(self.tau, self.gamma), div)), H1, div))
+        num = self._nonzero(np.dot(self.tau.T, ratio, out=self.gamma_num))
+        num /= self._nonzero(self.tau.sum(0))[:,np.newaxis]
+        self.gamma *= num
 
-        gamma_sum = self.gamma.sum(axis = 0)
-        self.gamma = self.gamma/gamma_sum[np.newaxis,:]
+        self.gamma /= self.gamma.sum(axis = 0)[np.newaxis,:]
+        self.recon_valid = False
 
     def div_update_tau(self):
         """Update basis and mixture matrix based on divergence multiplicative update rules."""
-        tau1 = np.tile(self.gamma.sum(1)[np.newaxis,:],(self.N, 1))
-        self.tau = np.multiply(
-            self.tau, du.elop(np.dot(du.elop(self.freq_matrix, np.dot(self.tau, self.gamma), div), self.gamma.T), tau1, div)) 
-            
-        for v in range(self.V):
-            for g in range(self.G):
-                sumvg = 0.0
-                for a in range(4):
-                    sumvg += self.tau[v + a*self.V,g]
-                    
-                for a in range(4):
-                    self.tau[v + a*self.V,g] = self.tau[v + a*self.V,g]/sumvg 
-
+        ratio = np.divide(self.freq_nonzero, self._nonzero(self.reconstruct(), self.recon_floor), out=self.ratio)
+        
+        num = self._nonzero(np.dot(ratio, self.gamma.T, out=self.tau_num))
+        num /= self._nonzero(self.gamma.sum(1))[np.newaxis,:]
+        self.tau *= num
+        
+        #normalise over the four bases at each position and strain
+        tau_view = self.tau_view()
+        np.sum(tau_view, axis=0, out=self.tau_sum)
+        tau_view /= self.tau_sum[np.newaxis,:,:]
+        self.recon_valid = False
 
 
     def get_gamma(self):
-        return np.transpose(self.gamma)
+        #float32 stays inside the factorisation, samplers and EM take C-ordered float64
+        return np.array(np.transpose(self.gamma), dtype=np.float64, order='C')
 
     def discretise_tau(self):
     
-        #convert VX4 X G into VXGX4 shape
-        discrete_tau = np.zeros((self.V*4,self.G))
-        
-        for v in range(self.V):
-            for g in range(self.G):
-                maxt = 0.0
-                maxa = 0
-                for a in range(4):
-                    if(self.tau[v + a*self.V,g] > maxt):
-                        maxt = self.tau[v + a*self.V,g] 
-                        maxa = a 
-                
-                discrete_tau[v + self.V*maxa,g] = 1. 
+        #one at the most probable base, first on ties
+        maxa = np.argmax(self.tau_view(), axis=0)
         
-        self.tau = discrete_tau
+        discrete_tau = np.zeros((4,self.V,self.G))
+        np.put_along_axis(discrete_tau, maxa[np.newaxis,:,:], 1., axis=0)
+        
+        self.tau = np.reshape(discrete_tau,(self.V*4,self.G))
         
     def get_tau(self):
     
         #convert VX4 X G into VXGX4 shape
-        ret_tau = np.zeros((self.V,self.G,4), dtype=np.int)
+        maxa = np.argmax(self.tau_view(), axis=0)
         
-        for v in range(self.V):
-            for g in range(self.G):
-                maxt = 0.0
-                maxa = 0
-                for a in range(4):
-                    if(self.tau[v + a*self.V,g] > maxt):
-                        maxt = self.tau[v + a*self.V,g] 
-                        maxa = a 
-                ret_tau[v,g,maxa] = 1 
+        ret_tau = np.zeros((self.V,self.G,4), dtype=np.int)
+        np.put_along_axis(ret_tau, maxa[:,:,np.newaxis], 1, axis=2)
         
         return ret_tau
+
+def factorize_tau_genes(gene_snps, gene_gammas, randomState, max_iter = 5000, min_change = 1.0e-5, alpha_constant=0.01, timer=None, precision='float64'):
+    """Fits NTF tau with gamma fixed for many genes at once, gene_snps is a list of VcXSX4 
+    counts and gene_gammas the matching SXG gammas. Initial tau is drawn in gene order as 
+    Init_NMFT.factorize_tau per gene would draw it, then genes sharing a gamma are stacked 
+    and updated together, each stopping when its own divergence changes by no more than 
+    min_change. Returns the list of VcXGX4 discretised tau"""
+    if timer is None:
+        timer = pt.Phase_Timer()
+    
+    G = gene_gammas[0].shape[1]
+    sizes = np.array([snps.shape[0] for snps in gene_snps], dtype=np.int)
+    starts = np.concatenate(([0],np.cumsum(sizes)))
+    
+    alpha4 = np.empty(4); alpha4.fill(alpha_constant)
+    tau = np.ascontiguousarray(np.transpose(dirichlet_tau(randomState, alpha4, starts[-1], G),(0,2,1)))
+    
+    variants = np.concatenate(gene_snps).astype(np.float) + Init_NMFT.BASE_PRIOR
+    freq = np.ascontiguousarray(np.transpose(variants/variants.sum(axis = 2)[:,:,np.newaxis],(0,2,1)), dtype=precision)
+    tau = tau.astype(precision)
+    if recon_floor(precision) > 0:
+        np.maximum(tau, np.finfo(precision).eps, out=tau)
+    
+    groups = {}
+    for (gene, gamma) in enumerate(gene_gammas):
+        groups.setdefault(np.ascontiguousarray(gamma).tobytes(), []).append(gene)
+    logging.info('Fit NTF tau for %d genes in %d groups of shared gamma' % (len(gene_snps), len(groups)))
+    
+    for genes in groups.values():
+        positions = np.concatenate([np.arange(starts[gene],starts[gene + 1]) for gene in genes])
+        tau[positions] = factorize_tau_stacked(freq[positions], tau[positions], np.asarray(gene_gammas[genes[0]], dtype=precision), sizes[genes],
+                                               max_iter, min_change, timer)
+    
+    #discretise at the most probable base, first on ties
+    maxa = np.argmax(tau, axis=1)
+    discrete_tau = np.zeros((starts[-1],G,4), dtype=np.int)
+    np.put_along_axis(discrete_tau, maxa[:,:,np.newaxis], 1, axis=2)
+    
+    return [discrete_tau[starts[gene]:starts[gene + 1]] for gene in range(len(gene_snps))]
+
+def factorize_tau_stacked(freq, tau, gamma, sizes, max_iter, min_change, timer):
+    """Multiplicative tau updates of Init_NMFT.div_update_tau on the PX4XS frequencies and 
+    PX4XG tau of consecutive genes of sizes positions all with SXG gamma. Genes stop 
+    individually, once a quarter of the rows belong to stopped genes the remaining genes 
+    are packed into new arrays. Returns the fitted tau"""
+    eps = np.finfo(freq.dtype).eps
+    floor = recon_floor(freq.dtype)
+    gammaT = np.transpose(gamma)
+    gamma_sum = np.sum(gammaT, axis=1)
+    gamma_sum[gamma_sum == 0] = eps
+    
+    fitted = np.copy(tau)
+    offsets = np.concatenate(([0],np.cumsum(sizes)))
+    
+    active = np.arange(sizes.shape[0])
+    div = np.zeros(sizes.shape[0])
+    divl = np.zeros(sizes.shape[0])
+    iter = 0
+    
+    while active.shape[0] > 0:
+        #pack the rows of active genes
+        rows = np.concatenate([np.arange(offsets[gene],offsets[gene + 1]) for gene in active])
+        row_starts = np.concatenate(([0],np.cumsum(sizes[active])))[:-1]
+        
+        F = np.reshape(freq[rows],(-1,freq.shape[2]))
+        F_nonzero = np.copy(F)
+        F_nonzero[F_nonzero == 0] = eps
+        T = np.reshape(fitted[rows],(-1,fitted.shape[2]))
+        T_view = np.reshape(T,(-1,4,T.shape[1]))
+        
+        recon = np.empty_like(F)
+        ratio = np.empty_like(F)
+        work = np.empty_like(F)
+        num = np.empty_like(T)
+        T_sum = np.empty((T_view.shape[0],T_view.shape[2]), dtype=T.dtype)
+        
+        #genes in the pack, those stopped since packing keep being updated but are not read
+        packed = active
+        running = np.ones(packed.shape[0], dtype=bool)
+        stopped_rows = 0
+        
+        while stopped_rows*4 < rows.shape[0]:
+            with timer.phase('NTF objective'):
+                np.dot(T, gammaT, out=recon)
+                pa = np.maximum(recon, eps, out=ratio)
+                terms = np.divide(F_nonzero, pa, out=work)
+                np.log(terms, out=terms)
+                terms *= F
+                terms -= F
+                terms += pa
+                gene_div = np.add.reduceat(terms.sum(axis=1, dtype=np.float64), row_starts*4)
+            
+            (divl[packed], div[packed]) = (np.where(running, div[packed], divl[packed]), np.where(running, gene_div, div[packed]))
+            
+            #negation of the factorize_tau loop condition so genes with nan divergence stop at once
+            stop = running & (~(np.abs(divl[packed] - div[packed]) > min_change) | (iter >= max_iter))
+            for i in np.flatnonzero(stop):
+                fitted[offsets[packed[i]]:offsets[packed[i] + 1]] = T_view[row_starts[i]:row_starts[i] + sizes[packed[i]]]
+                stopped_rows += sizes[packed[i]]
+            running &= ~stop
+            
+            if not running.any():
+                break
+            
+            if iter % 1000 == 0:
+                logging.info('Stacked NTF Iter %d, %d genes running' % (iter, np.sum(running)))
+            
+            with timer.phase('NTF update'):
+                recon[recon <= floor] = eps
+                np.divide(F_nonzero, recon, out=ratio)
+                np.dot(ratio, gamma, out=num)
+                num[num == 0] = eps
+                num /= gamma_sum[np.newaxis,:]
+                T *= num
+                np.sum(T_view, axis=1, out=T_sum)
+                T_view /= T_sum[:,np.newaxis,:]
+            
+            iter += 1
+        
+        #running genes carry on from their current tau in the next pack
+        for i in np.flatnonzero(running):
+            fitted[offsets[packed[i]]:offsets[packed[i] + 1]] = T_view[row_starts[i]:row_starts[i] + sizes[packed[i]]]
+        active = packed[running]
+        
+    return fitted
@@ -23,7 +23,7 @@ def rchop(thestring, ending):
 
 class Output_Results():
 
-    def __init__(self,outputDir):
+    def __init__(self,outputDir,append=False):
         self.outputDir = outputDir
         
         if not os.path.exists(outputDir):
@@ -34,7 +34,7 @@ class Output_Results():
         logging.basicConfig(
             filename=self.log_file_name,
             level=logging.INFO,
-            filemode='w', # Overwrites old log file
+            filemode='a' if append else 'w', # Overwrites old log file unless resuming
             format='%(asctime)s:%(levelname)s:%(name)s:%(message)s'
             )
         
@@ -79,9 +79,17 @@ class Output_Results():
                 
         meanDev = haplo_SNP.meanDeviance()
         
+        self.outPredFitStats(genomes,haplo_SNP.G,haplo_SNP.lp_star,meanDev)
+        
+    def outPredFitStats(self,genomes,G,lp_star,meanDev):
+        """Writes fitP.txt, lp_star is the log posterior of the not selected tau star and 
+        meanDev the mean deviance over the sampled iterations. When not selected positions 
+        are assigned in chunks tau star is chosen per chunk and lp_star is its log posterior 
+        at the stored gamma and eta that maximise it"""
+        
         fitFile = self.outputDir+"/fitP.txt"
         with open(fitFile, "w") as text_file:
-            text_file.write("Fit,%d,%d,%f,%f\n"%(genomes,haplo_SNP.G,haplo_SNP.lp_star, meanDev))
+            text_file.write("Fit,%d,%d,%f,%f\n"%(genomes,G,lp_star, meanDev))
 
         logging.info("Wrote pred fit stats") 
         
@@ -109,53 +117,44 @@ class Output_Results():
         logging.info("Wrote probabilistic tau haplotype predictions")
     
     def output_collated_Tau(self,haplo_SNP_NS,full_variants):
-        VS = haplo_SNP_NS.V + self.haplo_SNP.V
+        #selected flags over all positions so restrict to the original filtered positions
+        indices_original = np.asarray(self.variantFilter.selected_indices_original)
+        selected = self.variantFilter.selected[indices_original]
+        VS = selected.shape[0]
+        
         collateTau = np.zeros((VS,self.haplo_SNP.G,4), dtype=np.int)
         collatePTau = np.zeros((VS,self.haplo_SNP.G,4))
-        pTau_NS = haplo_SNP_NS.probabilisticTau()
-        pTau = self.haplo_SNP.probabilisticTau()
-         
-        g = 0
-        h = 0
-        for v in range(VS):
-        
-            if self.variantFilter.selected[v] != True:
-                collateTau[v,:] = haplo_SNP_NS.tau_star[g,:]
-                collatePTau[v,:] = pTau_NS[g,:]
-                g = g+1
-            else:
-                collateTau[v,:] = self.haplo_SNP.tau_star[h,:]
-                collatePTau[v,:] = pTau[h,:]
-                h = h + 1
-                
-        
-        full_contig_names = full_variants.index.tolist()
-        full_position = full_variants['Position']
-        
-        original_contig_names = []
-        original_position = []
-        for i in self.variantFilter.selected_indices_original:
-            original_contig_names.append(full_contig_names[i])
-            original_position.append(full_position[i])
         
-        collateTau_res = np.reshape(collateTau,(VS,self.haplo_SNP.G*4))
-        collatePTau_res = np.reshape(collatePTau,(VS,self.haplo_SNP.G*4))
+        collateTau[selected != True] = haplo_SNP_NS.tau_star
+        collatePTau[selected != True] = haplo_SNP_NS.probabilisticTau()
+        collateTau[selected] = self.haplo_SNP.tau_star
+        collatePTau[selected] = self.haplo_SNP.probabilisticTau()
         
-        collate_tau_df = p.DataFrame(collateTau_res,index=original_contig_names)
-        collate_tau_df['Position'] = original_position
+        self.output_collated_Tau_chunks([(indices_original,collateTau,collatePTau)],full_variants)
+    
+    def output_collated_Tau_chunks(self,chunks,full_variants):
+        """Writes collated tau star and mean from an iterable of (indices, tau, probabilistic tau)
+        blocks in position order, indices being rows of full_variants, one block at a time"""
+        full_contig_names = full_variants.index.values
+        full_position = full_variants['Position'].values
+        G = self.haplo_SNP.G
+        
+        with open(self.outputDir+"/Collated_Tau_star.csv", "w") as tau_file, open(self.outputDir+"/Collated_Tau_mean.csv", "w") as ptau_file:
+            first = True
+            for (indices, collateTau, collatePTau) in chunks:
+                V = collateTau.shape[0]
+                
+                collate_tau_df = p.DataFrame(np.reshape(collateTau,(V,G*4)),index=full_contig_names[indices])
+                collate_tau_df.insert(0,'Position',full_position[indices])
+                collate_tau_df.to_csv(tau_file,header=first)
+                
+                collate_ptau_df = p.DataFrame(np.reshape(collatePTau,(V,G*4)),index=full_contig_names[indices])
+                collate_ptau_df.insert(0,'Position',full_position[indices])
+                collate_ptau_df.to_csv(ptau_file,header=first)
+                
+                first = False
         
-        cols = collate_tau_df.columns.tolist()
-        cols = cols[-1:] + cols[:-1]
-        collate_tau_df = collate_tau_df[cols]
-        collate_tau_df.to_csv(self.outputDir+"/Collated_Tau_star.csv")
         logging.info("Wrote all tau haplotype predictions")
-        collate_ptau_df = p.DataFrame(collatePTau_res,index=original_contig_names)
-        collate_ptau_df['Position'] = original_position
-        
-        cols = collate_ptau_df.columns.tolist()
-        cols = cols[-1:] + cols[:-1]
-        collate_ptau_df = collate_ptau_df[cols]
-        collate_ptau_df.to_csv(self.outputDir+"/Collated_Tau_mean.csv")
         logging.info("Wrote all probabilistic tau haplotype predictions")    
     
     def output_Gamma_Mean(self,gamma):
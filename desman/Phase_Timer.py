@@ -0,0 +1,64 @@
+import sys, getopt
+import os
+import time
+import json
+import logging
+
+class Phase():
+    """Context manager adding the wall time of its block to a Phase_Timer"""
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        return False
+
+class Phase_Timer():
+    """Accumulates wall time and call counts of named phases, e.g.
+
+        with timer.phase('sampleMu'):
+            ...
+
+    costs one perf_counter pair per phase call so is left on by default"""
+
+    def __init__(self, log_iter=None):
+        self.log_iter = log_iter
+        self.times = {}
+        self.calls = {}
+        self.created = time.perf_counter()
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add(self, name, elapsed):
+        self.times[name] = self.times.get(name, 0.0) + elapsed
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def summary(self):
+        """Returns elapsed seconds since creation and a dict of phase name to total seconds, 
+        calls and mean seconds per call"""
+        phases = {}
+        for name in self.times:
+            phases[name] = {'seconds' : self.times[name], 'calls' : self.calls[name],
+                            'mean' : self.times[name]/self.calls[name]}
+        
+        return {'elapsed' : time.perf_counter() - self.created, 'phases' : phases}
+
+    def logIter(self, iter):
+        """Logs accumulated phase times every log_iter iterations if set"""
+        if self.log_iter is not None and iter % self.log_iter == 0:
+            phases = ', '.join(['%s %.3fs/%d' % (name, self.times[name], self.calls[name]) for name in sorted(self.times)])
+            logging.info('Timing Iter %d: %s' % (iter, phases))
+
+def write_timings(fileName, timers):
+    """Writes the summaries of a dict of named Phase_Timers as JSON"""
+    with open(fileName, 'w') as f:
+        json.dump(dict([(name, timers[name].summary()) for name in timers]), f, indent=1, sort_keys=True)
+    logging.info('Wrote phase timings to %s' % fileName)
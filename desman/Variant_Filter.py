@@ -11,6 +11,9 @@ import math
 import argparse
 import pickle
 import logging
+import tempfile
+import shutil
+import multiprocessing
 
 from itertools import compress
 from numpy import array, log, exp
@@ -36,26 +39,210 @@ def mixNLL(p, eta, n, m, f):
 
     return np.dot(f,-np.log(mix))
 
-def benjamini_Hochberg(pvalues):
-    n = float(pvalues.shape[0])                                                                           
-    new_pvalues = np.zeros(int(n))
-
-    values = [ (pvalue, i) for i, pvalue in enumerate(pvalues) ]                                      
-    values.sort()
-    values.reverse()                                                                                  
-    new_values = []
-    for i, vals in enumerate(values):                                                                 
-        rank = n - i
-        pvalue, index = vals                                                                          
-        new_values.append((n/rank) * pvalue)                                                          
-    for i in range(0, int(n)-1):  
-        if new_values[i] < new_values[i+1]:                                                           
-            new_values[i+1] = new_values[i]                                                           
-    for i, vals in enumerate(values):
-        pvalue, index = vals
-        new_pvalues[index] = new_values[i] 
-        
-    return new_pvalues
+def mixNLL_batch(p, eta, n, m, f):
+    """mixNLL for every position, p, n, m are length V and f is VX4"""
+    mix = p[:,np.newaxis]*eta[n,:] + (1-p[:,np.newaxis])*eta[m,:]
+
+    return -(f*np.log(mix)).sum(axis=1)
+
+def minimise_mixNLL(eta, n, m, f, upper, xtol=1.0e-10, max_iter=100):
+    """Minimises mixNLL over p in [0, upper] for all positions at once. The NLL is convex 
+    in p, so positions whose derivative does not change sign over the interval take the 
+    bound and the rest take Newton steps within a bracket on the sign of the derivative, 
+    falling back to bisection when a step leaves the bracket"""
+    V = f.shape[0]
+    B = eta[m,:]
+    D = eta[n,:] - B
+    
+    def derivatives(x, idx):
+        mix = B[idx] + x[:,np.newaxis]*D[idx]
+        fD = f[idx]*D[idx]/mix
+        return (-fD.sum(axis=1), (fD*D[idx]/mix).sum(axis=1))
+    
+    all = np.arange(V)
+    (g_lo, h) = derivatives(np.zeros(V), all)
+    (g_hi, h) = derivatives(np.full(V, upper), all)
+    
+    p = np.where(g_hi <= 0.0, upper, 0.0)
+    idx = np.flatnonzero(np.logical_and(g_lo < 0.0, g_hi > 0.0))
+    lo = np.zeros(idx.shape[0])
+    hi = np.full(idx.shape[0], upper)
+    x = 0.5*(lo + hi)
+    
+    iter = 0
+    while idx.shape[0] > 0 and iter < max_iter:
+        (g, h) = derivatives(x, idx)
+        lo = np.where(g < 0.0, x, lo)
+        hi = np.where(g > 0.0, x, hi)
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = x - g/h
+        bisect = np.logical_not(np.logical_and(step > lo, step < hi))
+        step[bisect] = 0.5*(lo[bisect] + hi[bisect])
+        
+        done = np.logical_or(np.abs(step - x) < xtol, g == 0.0)
+        p[idx] = step
+        
+        keep = np.logical_not(done)
+        (idx, x, lo, hi) = (idx[keep], step[keep], lo[keep], hi[keep])
+        iter += 1
+    
+    if idx.shape[0] > 0:
+        p[idx] = x
+    
+    return p
+
+def benjamini_Hochberg(pvalues, out = None):
+    """Benjamini-Hochberg adjusted p-values, pvalues are ranked largest first with ties 
+    by decreasing index, scaled by n over rank and made monotone by a running minimum. 
+    The result is scattered into out if given, which may be a memory map as for pvalues"""
+    n = float(pvalues.shape[0])
+    
+    order = np.argsort(pvalues, kind='mergesort')[::-1]
+    rank = n - np.arange(pvalues.shape[0])
+    new_values = (n/rank) * pvalues[order]
+    np.minimum.accumulate(new_values, out=new_values)
+    
+    if out is None:
+        out = np.zeros(pvalues.shape[0])
+    out[order] = new_values
+    
+    return out
+
+def second_base(freq, maxA):
+    """Returns the index of the second most abundant base at each position, the first 
+    of the remaining bases on ties as argmax"""
+    ftemp = np.array(freq)
+    ftemp[np.arange(freq.shape[0]),maxA] = -1
+    return np.argmax(ftemp,axis=1)
+
+def accumulate_eta(eta, af, ff):
+    """Adds the base counts ff of positions to the eta rows af of their most abundant bases,
+    as grouped sums of each base so counts add exactly as in a loop over positions"""
+    for b in range(4):
+        eta[:,b] += np.bincount(af, weights=ff[:,b], minlength=4)
+
+def precedes(p, x, bp, bx):
+    """Whether each (p, x) of values and indices sorts no later than (bp, bx) in the 
+    value then index order of a stable argsort, which puts nan values last"""
+    if np.isnan(bp):
+        return np.logical_or(np.logical_not(np.isnan(p)), x <= bx)
+    return np.logical_or(p < bp, np.logical_and(p == bp, x <= bx))
+
+def merge_runs(sp, si, tp, ti, start, middle, end, chunk_size):
+    """Merges the sorted runs start to middle and middle to end of values sp with indices 
+    si into tp and ti holding at most two blocks of chunk_size in memory"""
+    (a, b, out) = (start, middle, start)
+    while a < middle or b < end:
+        (pa, xa) = (np.asarray(sp[a:min(a + chunk_size, middle)]), np.asarray(si[a:min(a + chunk_size, middle)]))
+        (pb, xb) = (np.asarray(sp[b:min(b + chunk_size, end)]), np.asarray(si[b:min(b + chunk_size, end)]))
+        
+        #everything up to the earlier of the two block ends is in its final place
+        if pb.shape[0] == 0 or (pa.shape[0] > 0 and precedes(pa[-1:], xa[-1:], pb[-1], xb[-1])[0]):
+            (bp, bx) = (pa[-1], xa[-1])
+        else:
+            (bp, bx) = (pb[-1], xb[-1])
+        na = int(precedes(pa, xa, bp, bx).sum())
+        nb = int(precedes(pb, xb, bp, bx).sum())
+        
+        p_merge = np.concatenate((pa[:na], pb[:nb]))
+        x_merge = np.concatenate((xa[:na], xb[:nb]))
+        order = np.lexsort((x_merge, p_merge))
+        tp[out:out + na + nb] = p_merge[order]
+        ti[out:out + na + nb] = x_merge[order]
+        
+        (a, b, out) = (a + na, b + nb, out + na + nb)
+
+def sort_stream(pvalues, chunk_size, work_dir):
+    """External merge sort of pvalues, which may be a memory map, into memory mapped 
+    values and indices in work_dir ordered as a stable argsort, sorting runs of chunk_size 
+    then merging pairs of runs so at most a few chunks are held in memory"""
+    n = pvalues.shape[0]
+    buffers = []
+    for name in ['sort_a','sort_b']:
+        buffers.append((np.memmap(os.path.join(work_dir, name + '_p.dat'), dtype=np.float64, mode='w+', shape=max(n,1)),
+                        np.memmap(os.path.join(work_dir, name + '_i.dat'), dtype=np.int64, mode='w+', shape=max(n,1))))
+    
+    (sp, si) = buffers[0]
+    for start in range(0, n, chunk_size):
+        values = np.asarray(pvalues[start:start + chunk_size])
+        order = np.argsort(values, kind='mergesort')
+        sp[start:start + chunk_size] = values[order]
+        si[start:start + chunk_size] = start + order
+    
+    run = chunk_size
+    current = 0
+    while run < n:
+        ((sp, si), (tp, ti)) = (buffers[current], buffers[1 - current])
+        for start in range(0, n, 2*run):
+            merge_runs(sp, si, tp, ti, start, min(start + run, n), min(start + 2*run, n), chunk_size)
+        current = 1 - current
+        run *= 2
+    
+    return buffers[current]
+
+def benjamini_Hochberg_stream(pvalues, out, chunk_size, work_dir):
+    """benjamini_Hochberg of memory mapped pvalues into the memory map out with memory 
+    bounded by chunk_size, ranking by sort_stream then taking the running minimum from 
+    the largest p-value down a chunk at a time"""
+    (sp, si) = sort_stream(pvalues, chunk_size, work_dir)
+    N = pvalues.shape[0]
+    n = float(N)
+    
+    carry = np.inf
+    for end in range(N, 0, -chunk_size):
+        start = max(end - chunk_size, 0)
+        #largest first as benjamini_Hochberg where rank n - i is the ascending position plus one
+        rank = np.arange(end, start, -1)
+        new_values = (n/rank) * np.asarray(sp[start:end])[::-1]
+        new_values = np.minimum.accumulate(np.concatenate(([carry], new_values)))[1:]
+        
+        out[np.asarray(si[start:end])[::-1]] = new_values
+        carry = new_values[-1]
+    
+    return out
+
+def log_ratio(freq, maxA, maxB, eta, optimise, upperP, Nthreshold):
+    """Twice the log likelihood ratio of a mixture of the two most abundant bases over the 
+    most abundant base alone for the VX4 summed base counts freq given error matrix eta, 
+    the mixture proportion starts at the observed frequency and is optimised if optimise"""
+    N = (freq.sum(axis=1)).astype(np.float64)
+    n = (freq[np.arange(freq.shape[0]),maxA]).astype(np.float64)
+    
+    p = np.zeros(freq.shape[0])
+    covered = N >= Nthreshold
+    p[covered] = n[covered]/N[covered]
+    p[p > upperP] = upperP
+    
+    BLL = - (log(eta[maxA,:])*freq).sum(axis=1)
+    if optimise:
+        p = minimise_mixNLL(eta,maxA,maxB,freq.astype(np.float),upperP)
+    MLL = mixNLL_batch(p,eta,maxA,maxB,freq.astype(np.float))
+    
+    return 2.0*(BLL - MLL)
+
+#per worker process state set by init_worker
+_worker = {}
+
+def init_worker(freq, optimise, upperP, Nthreshold, threshold):
+    _worker['freq'] = freq
+    _worker['parameters'] = (optimise, upperP, Nthreshold, threshold)
+
+def filter_shard(task):
+    """Log ratios of positions start to end under error matrix eta together with the 
+    eta sufficient statistics, base counts summed by most abundant base, of those filtered"""
+    (start, end, eta) = task
+    (optimise, upperP, Nthreshold, threshold) = _worker['parameters']
+    freq = _worker['freq'][start:end]
+    
+    maxA = np.argmax(freq,axis=1)
+    ratioNLL = log_ratio(freq,maxA,second_base(freq,maxA),eta,optimise,upperP,Nthreshold)
+    
+    filtered = np.logical_or(freq.sum(axis=1) < Nthreshold,ratioNLL < threshold)
+    eta_sum = np.zeros((4,4))
+    accumulate_eta(eta_sum, maxA[filtered], freq[filtered])
+    
+    return (ratioNLL, eta_sum)
 
 def reject_outliers(data, m = 2.):
     d = np.abs(data - np.median(data))
@@ -71,8 +258,10 @@ class Variant_Filter():
                 qvalue_cutoff = 0.1,max_iter = 100, min_p = 0.01, mCogFilter = 2.0,cogSampleFrac=0.95,Nthreshold=10):
         #first get array dimensions
         
-        variants_matrix = variants.as_matrix()
+        variants_matrix = variants.values
         self.genes = list(variants.index)
+        #gene of each position as a code into gene_names
+        (self.gene_codes, self.gene_names) = p.factorize(self.genes)
         self.position = variants_matrix[:,0]
         variants_matrix = np.delete(variants_matrix, 0, 1)
     
@@ -117,24 +306,43 @@ class Variant_Filter():
         #denotes whether a random selection of significant positions has occured
         self.randomSelect = False
     
+    def gene_coverages(self, totals):
+        """Mean over positions of totals, a V or VXS array, for each gene with positions,
+        returned with the codes of those genes"""
+        nGenes = len(self.gene_names)
+        counts = np.bincount(self.gene_codes, minlength=nGenes)
+        present = np.where(counts > 0)[0]
+        
+        if totals.ndim == 1:
+            sums = np.bincount(self.gene_codes, weights=totals, minlength=nGenes)
+        else:
+            S = totals.shape[1]
+            sums = np.bincount((self.gene_codes[:,np.newaxis]*S + np.arange(S)).ravel(), 
+                               weights=totals.ravel(), minlength=nGenes*S)
+            sums = np.reshape(sums,(nGenes,S))
+        
+        #only divide for genes with positions, removed genes would give 0/0
+        counts = counts[present]
+        if totals.ndim > 1:
+            counts = counts[:,np.newaxis]
+        
+        return (present, sums[present]/counts)
+    
+    def gene_select(self, filterGenes):
+        """Sets filteredGenes from the codes filterGenes and returns a mask of the positions 
+        in other genes by a lookup table over gene codes"""
+        geneFiltered = np.zeros(len(self.gene_names), dtype=bool)
+        geneFiltered[filterGenes] = True
+        self.filteredGenes = list(self.gene_names[geneFiltered])
+        
+        select = np.logical_not(geneFiltered[self.gene_codes])
+        self.gene_codes = self.gene_codes[select]
+        return select
+    
     def remove_outlier_cogs(self):
         totals = np.sum(self.freq,axis=1)
         
-        uniquegenes = set(self.genes)
-        
-        gene_coverages = defaultdict(lambda: 0.)
-        gene_freqs = defaultdict(lambda: 0.)
-        idx = 0
-        
-        for gene in self.genes:
-            gene_coverages[gene] += totals[idx]
-            gene_freqs[gene] += 1.0
-            idx = idx+1
-        
-        data = []
-        for gene in uniquegenes:
-            gene_coverages[gene] = gene_coverages[gene]/gene_freqs[gene]
-            data.append(gene_coverages[gene])
+        (genes, data) = self.gene_coverages(totals)
         
         d = np.abs(data - np.median(data))
         mdev = np.median(d)
@@ -142,15 +350,7 @@ class Variant_Filter():
         
         filterGenes = s > self.mCogFilter
     
-        self.filteredGenes = [i for (i, v) in zip(list(uniquegenes), filterGenes) if v]
-        
-        idx = 0
-        select = np.ones((self.V), dtype=bool)
-        for gene in self.genes:
-            if gene in self.filteredGenes:
-                select[idx] = False
-            
-            idx+=1
+        select = self.gene_select(genes[filterGenes])
     
         #stores filtered snp array
         self.snps_filter = self.snps_filter[select,:,:]
@@ -168,50 +368,22 @@ class Variant_Filter():
         self.selected = np.ones((self.V), dtype=bool)    
         self.selected_indices  = list(np.where(self.selected))
         self.selected_indices = self.selected_indices[0].tolist()
-        self.position = self.position[self.selected]
+        self.position = self.position[select]
     
     
     def remove_outlier_cogs_sample(self):
         
         totals_samples = self.snps_filter.sum(axis=2)
-        uniquegenes = list(set(self.genes))
-        
-        gene_sample_coverages = defaultdict(lambda: np.zeros(self.S))
-        gene_sample_freqs = defaultdict(lambda: np.zeros(self.S))
-
-        idx = 0
-        
-        for gene in self.genes:
-            for s in range(self.S):
-                gene_sample_coverages[gene][s] += totals_samples[idx][s]
-                gene_sample_freqs[gene][s] += 1.0
-            idx = idx+1
         
-        nGenes = len(uniquegenes)
-        
-        g = 0
-        geneSampleCovArray = np.zeros((nGenes,self.S))
-        for gene in uniquegenes:
-            for s in range(self.S):
-                gene_sample_coverages[gene][s] = gene_sample_coverages[gene][s]/gene_sample_freqs[gene][s]
-                geneSampleCovArray[g,s] = gene_sample_coverages[gene][s]
-            g = g + 1    
-            
+        (genes, geneSampleCovArray) = self.gene_coverages(totals_samples)
+        nGenes = genes.shape[0]
         
         outlierGeneSample = np.zeros((nGenes,self.S),dtype=bool)
         for s in range(self.S):
             outlierGeneSample[:,s] = reject_outliers(geneSampleCovArray[:,s], m = self.mCogFilter)
     
         filterGenes = outlierGeneSample.sum(axis=1) < (self.S*self.cogSampleFrac)
-        self.filteredGenes = [i for (i, v) in zip(uniquegenes, filterGenes) if v]
-        
-        idx = 0
-        select = np.ones((self.V), dtype=bool)
-        for gene in self.genes:
-            if gene in self.filteredGenes:
-                select[idx] = False
-            
-            idx+=1
+        select = self.gene_select(genes[filterGenes])
     
         #stores filtered snp array
         self.snps_filter = self.snps_filter[select,:,:]
@@ -291,12 +463,10 @@ class Variant_Filter():
             
             ff = self.freq[self.filtered] 
             af = self.maxA[self.filtered]
-            Nf = N[self.filtered]
             
             self.eta = 96*np.identity((4)) + np.ones((4,4))
             
-            for v in range(Nf.shape[0]):
-                self.eta[af[v],:] += ff[v,:]
+            accumulate_eta(self.eta, af, ff)
                 
             esums = self.eta.sum(axis = 1)
             self.eta = self.eta/esums[:,np.newaxis]
@@ -317,65 +487,86 @@ class Variant_Filter():
         self.NS = self.snps_filter.shape[0]
         return self.snps_filter
     
-    def get_filtered_VariantsLogRatio(self):
+    def contig_shards(self, shards):
+        """Splits positions into at most shards contiguous (start, end) blocks of about 
+        equal size that only break between contigs"""
+        breaks = np.where(self.gene_codes[1:] != self.gene_codes[:-1])[0] + 1
+        targets = (np.arange(1,shards)*self.V) // shards
+        
+        bounds = [0, self.V]
+        if breaks.shape[0] > 0:
+            nearest = np.argmin(np.abs(breaks[:,np.newaxis] - targets[np.newaxis,:]),axis=0)
+            bounds = bounds + breaks[nearest].tolist()
+        
+        bounds = np.unique(bounds)
+        return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+    
+    def get_filtered_VariantsLogRatio(self, workers = 1):
+        """Iterates the error matrix and likelihood ratio filter to convergence, with 
+        workers > 1 contig shards are filtered on a process pool reducing their eta 
+        sufficient statistics each iteration so selections are those of the serial filter"""
         iter = 0
         
         #get most abundant base
         self.maxA = np.argmax(self.freq,axis=1)
         #get second most abundant base
         
-        ftemp = np.copy(self.freq)
-        for v in range(self.V):
-            ftemp[v,self.maxA[v]] = -1
-        self.maxB = np.argmax(ftemp,axis=1)
+        self.maxB = second_base(self.freq,self.maxA)
         
         N = (self.freq.sum(axis=1)).astype(np.float64)
         n = (self.freq.max(axis=1)).astype(np.float64) #value of most abundant base
-        m =  (ftemp.max(axis=1)).astype(np.float64)     #value of second most abundant
+        m = (self.freq[np.arange(self.V),self.maxB]).astype(np.float64)     #value of second most abundant
         e = N -n
         self.filtered = N < self.Nthreshold
         self.minV = np.zeros(self.V)
         self.minV[self.filtered == False] = m[self.filtered == False]/N[self.filtered == False] 
         
-        p = np.zeros(self.V)
-        MLL = np.zeros(self.V)
+        pool = None
+        if workers > 1 and multiprocessing.current_process().daemon:
+            logging.info('Variant filter running serially as daemon processes cannot start a pool')
+        elif workers > 1 and len(self.contig_shards(workers)) > 1:
+            shards = self.contig_shards(workers)
+            logging.info('Variant filter on %d contig shards with %d workers' % (len(shards), min(workers, len(shards))))
+            pool = multiprocessing.Pool(processes=min(workers, len(shards)), initializer=init_worker, 
+                                        initargs=(self.freq, self.optimise, self.upperP, self.Nthreshold, self.threshold))
+        
         lastSelect = 0
         Select = self.V
-        p[self.filtered == False] = n[self.filtered == False]/N[self.filtered == False]
-        p[p > self.upperP] = self.upperP
-        while iter < self.max_iter and lastSelect != Select:
-            #filter based on current error rate
-        
-            
-            BLL = - (log(self.eta[self.maxA,:])*self.freq).sum(axis=1)
-         
-            for v in range(self.V):
-                if  self.optimise:
-                    res = minimize_scalar(mixNLL, bounds=(0.0, self.upperP), args = (self.eta,self.maxA[v],self.maxB[v],self.ffreq[v,:]), method='bounded')
-                    p[v] = res.x
-                MLL[v] = mixNLL(p[v],self.eta,self.maxA[v],self.maxB[v],self.ffreq[v,:])
-            
-            ratioNLL = 2.0*(BLL - MLL)
-            
-            self.filtered = np.logical_or(N < self.Nthreshold,ratioNLL < self.threshold)
-            
-            ff = self.freq[self.filtered] 
-            af = self.maxA[self.filtered]
-            Nf = N[self.filtered]
-            
-            self.eta = 96*np.identity((4)) + np.ones((4,4))
-            
-            for v in range(Nf.shape[0]):
-                self.eta[af[v],:] += ff[v,:]
+        try:
+            while iter < self.max_iter and lastSelect != Select:
+                #filter based on current error rate
+                eta_counts = 96*np.identity((4)) + np.ones((4,4))
+                if pool is None:
+                    ratioNLL = log_ratio(self.freq,self.maxA,self.maxB,self.eta,self.optimise,self.upperP,self.Nthreshold)
+                    
+                    self.filtered = np.logical_or(N < self.Nthreshold,ratioNLL < self.threshold)
+                    
+                    ff = self.freq[self.filtered] 
+                    af = self.maxA[self.filtered]
+                    
+                    accumulate_eta(eta_counts, af, ff)
+                else:
+                    results = pool.map(filter_shard, [(start, end, self.eta) for (start, end) in shards])
+                    
+                    ratioNLL = np.concatenate([ratio for (ratio, eta_sum) in results])
+                    self.filtered = np.logical_or(N < self.Nthreshold,ratioNLL < self.threshold)
+                    
+                    #counts are integers so shard sums add exactly in any order
+                    for (ratio, eta_sum) in results:
+                        eta_counts += eta_sum
                 
-            esums = self.eta.sum(axis = 1)
-            self.eta = self.eta/esums[:,np.newaxis]
-            
-            lastSelect = Select
-            Select = self.V - self.filtered.sum()
-            logging.info("Variant filter iter: " + str(iter) + " " + str(Select) + " " + str(self.eta))
-            sys.stdout.flush()
-            iter = iter + 1
+                esums = eta_counts.sum(axis = 1)
+                self.eta = eta_counts/esums[:,np.newaxis]
+                
+                lastSelect = Select
+                Select = self.V - self.filtered.sum()
+                logging.info("Variant filter iter: " + str(iter) + " " + str(Select) + " " + str(self.eta))
+                sys.stdout.flush()
+                iter = iter + 1
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
             
         self.pvalue = 1.0 - chi2.cdf(ratioNLL,1)
         self.qvalue = benjamini_Hochberg(self.pvalue)
@@ -416,10 +607,7 @@ class Variant_Filter():
         sbv_freq = self.freq[self.filtered]
         sbv_maxA = np.argmax(sbv_freq,axis=1)
         
-        F = sbv_freq.shape[0]
-        
-        for i in range(F):
-            self.tran_Matrix[sbv_maxA[i],] += sbv_freq[i]
+        accumulate_eta(self.tran_Matrix, sbv_maxA, sbv_freq)
             
         tSums = self.tran_Matrix.sum(axis=1)
         self.tran_Matrix = self.tran_Matrix / tSums[:,np.newaxis]
@@ -435,6 +623,179 @@ def addPositions(dataFrame,position):
     dataFrame = dataFrame[cols] 
     return dataFrame
     
+def save_state(directory, name, state):
+    """Writes the numeric arrays of the dict state to name_<key>.npy files in directory 
+    and its other values to name.pickle"""
+    rest = {}
+    for key in state:
+        value = state[key]
+        if isinstance(value, np.ndarray) and value.dtype != object:
+            np.save(os.path.join(directory, '%s_%s.npy' % (name, key)), value)
+        else:
+            rest[key] = value
+    
+    with open(os.path.join(directory, name + '.pickle'), 'wb') as f:
+        pickle.dump(rest, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_state(directory, name):
+    """Reads a dict written by save_state with its arrays memory mapped read only"""
+    with open(os.path.join(directory, name + '.pickle'), 'rb') as f:
+        state = pickle.load(f)
+    
+    prefix = name + '_'
+    for fileName in os.listdir(directory):
+        if fileName.startswith(prefix) and fileName.endswith('.npy'):
+            state[fileName[len(prefix):-len('.npy')]] = np.load(os.path.join(directory, fileName), mmap_mode='r')
+    
+    return state
+
+def save_filter(cache_dir, variants, variant_Filter):
+    """Writes the variants table and the state of a filter to cache_dir, staged in a 
+    temporary directory and renamed so readers never see a partial cache"""
+    parent = os.path.dirname(os.path.abspath(cache_dir))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    
+    stage_dir = tempfile.mkdtemp(prefix=os.path.basename(cache_dir) + '_', dir=parent)
+    try:
+        save_state(stage_dir, 'variants', {'values' : variants.values, 'index' : list(variants.index), 
+                                           'index_name' : variants.index.name, 'columns' : list(variants.columns)})
+        save_state(stage_dir, 'filter', dict(vars(variant_Filter)))
+        os.rename(stage_dir, cache_dir)
+    except OSError:
+        #another run wrote the same cache first
+        if not os.path.isdir(cache_dir):
+            raise
+    finally:
+        if os.path.isdir(stage_dir):
+            shutil.rmtree(stage_dir)
+
+def load_filter(cache_dir):
+    """Returns the variants table and filter written by save_filter"""
+    state = load_state(cache_dir, 'variants')
+    variants = p.DataFrame(state['values'], index=p.Index(state['index'], name=state['index_name']), columns=state['columns'])
+    
+    variant_Filter = Variant_Filter.__new__(Variant_Filter)
+    vars(variant_Filter).update(load_state(cache_dir, 'filter'))
+    
+    return (variants, variant_Filter)
+
+def read_chunks(variant_file, chunk_size):
+    return p.read_csv(variant_file, header=0, index_col=0, chunksize=chunk_size)
+
+def filter_stream(variant_file, output_stub, chunk_size, optimise = True, threshold = 3.84, min_coverage = 5.0, 
+                  qvalue_cutoff = 0.1, max_iter = 100, min_p = 0.01, Nthreshold = 10):
+    """Out of core get_filtered_VariantsLogRatio writing the same files as main for tables 
+    larger than memory. The table is read in chunks of chunk_size positions three times, for 
+    the sample coverages, for the summed base counts of covered samples which are kept with 
+    the two most abundant bases in memory mapped files that the eta iterations stream, then 
+    to write the selected variants and per position statistics. Returns the number selected"""
+    work_dir = tempfile.mkdtemp(prefix=os.path.basename(output_stub) + 'stream_', dir=os.path.dirname(os.path.abspath(output_stub)))
+    try:
+        #pass 1 mean coverage of each sample
+        V = 0
+        coverage = 0
+        for chunk in read_chunks(variant_file, chunk_size):
+            counts = chunk.values[:,1:]
+            coverage = coverage + np.reshape(counts,(counts.shape[0],counts.shape[1] // 4,4)).sum(axis=(0,2))
+            V += chunk.shape[0]
+        
+        sample_filter = coverage/float(V) > min_coverage
+        S = int(sample_filter.sum())
+        logging.info('Streaming %d variant positions in chunks of %d with %d samples above minimum coverage' % (V, chunk_size, S))
+        
+        #pass 2 summed base counts and two most abundant bases
+        freq = np.memmap(os.path.join(work_dir,'freq.dat'), dtype=np.int64, mode='w+', shape=(V,4))
+        maxA = np.memmap(os.path.join(work_dir,'maxA.dat'), dtype=np.int8, mode='w+', shape=V)
+        maxB = np.memmap(os.path.join(work_dir,'maxB.dat'), dtype=np.int8, mode='w+', shape=V)
+        start = 0
+        for chunk in read_chunks(variant_file, chunk_size):
+            counts = chunk.values[:,1:]
+            end = start + chunk.shape[0]
+            freq[start:end] = np.reshape(counts,(counts.shape[0],counts.shape[1] // 4,4))[:,sample_filter,:].sum(axis=1)
+            maxA[start:end] = np.argmax(freq[start:end],axis=1)
+            maxB[start:end] = second_base(freq[start:end],maxA[start:end])
+            start = end
+        
+        #iterate error matrix from the sums over positions filtered in each chunk
+        eta = 0.96*np.identity((4)) + 0.01*np.ones((4,4))
+        upperP = 1.0 - min_p
+        ratioNLL = np.memmap(os.path.join(work_dir,'ratio.dat'), dtype=np.float64, mode='w+', shape=V)
+        
+        iter = 0
+        lastSelect = 0
+        Select = V
+        while iter < max_iter and lastSelect != Select:
+            eta_sum = 96*np.identity((4)) + np.ones((4,4))
+            nfiltered = 0
+            for start in range(0, V, chunk_size):
+                end = min(start + chunk_size, V)
+                f = np.asarray(freq[start:end])
+                a = np.asarray(maxA[start:end], dtype=np.int)
+                ratioNLL[start:end] = log_ratio(f,a,np.asarray(maxB[start:end], dtype=np.int),eta,optimise,upperP,Nthreshold)
+                
+                filtered = np.logical_or(f.sum(axis=1) < Nthreshold,ratioNLL[start:end] < threshold)
+                accumulate_eta(eta_sum, a[filtered], f[filtered])
+                nfiltered += filtered.sum()
+            
+            eta = eta_sum/eta_sum.sum(axis = 1)[:,np.newaxis]
+            
+            lastSelect = Select
+            Select = V - nfiltered
+            logging.info("Variant filter iter: " + str(iter) + " " + str(Select) + " " + str(eta))
+            iter = iter + 1
+        
+        pvalue = np.memmap(os.path.join(work_dir,'pvalue.dat'), dtype=np.float64, mode='w+', shape=V)
+        for start in range(0, V, chunk_size):
+            pvalue[start:start + chunk_size] = 1.0 - chi2.cdf(ratioNLL[start:start + chunk_size],1)
+        qvalue = benjamini_Hochberg_stream(pvalue, np.memmap(os.path.join(work_dir,'qvalue.dat'), dtype=np.float64, mode='w+', shape=V), 
+                                           chunk_size, work_dir)
+        
+        #pass 3 write selected variants and statistics chunk by chunk
+        tran_Matrix = np.ones((4,4)) #effective Laplace prior on transition matrix
+        NS = 0
+        files = dict([(name, open(output_stub + name + '.csv', 'w')) for name in ['sel_var','v_df','p_df','q_df','r_df']])
+        try:
+            start = 0
+            for chunk in read_chunks(variant_file, chunk_size):
+                end = start + chunk.shape[0]
+                first = start == 0
+                contig_names = list(chunk.index)
+                position = chunk.values[:,0]
+                counts = chunk.values[:,1:]
+                
+                f = np.asarray(freq[start:end])
+                N = (f.sum(axis=1)).astype(np.float64)
+                filtered = np.logical_or(N < Nthreshold,qvalue[start:end] > qvalue_cutoff)
+                selected = filtered != True
+                accumulate_eta(tran_Matrix, np.argmax(f[filtered],axis=1), f[filtered])
+                
+                sampleNames = [name for (name, s) in zip(chunk.columns[1:], np.repeat(sample_filter,4)) if s]
+                snps = np.reshape(np.reshape(counts,(counts.shape[0],counts.shape[1] // 4,4))[selected][:,sample_filter,:],(selected.sum(),S*4))
+                sel_df = p.DataFrame(snps,index=[i for (i, v) in zip(contig_names, selected) if v],columns=sampleNames)
+                sel_df.insert(0, 'Position', position[selected])
+                sel_df.to_csv(files['sel_var'], header=first)
+                NS += selected.sum()
+                
+                minV = np.zeros(end - start)
+                covered = N >= Nthreshold
+                minV[covered] = f[np.arange(end - start),maxB[start:end]][covered]/N[covered]
+                
+                for (name, values) in [('v_df', minV), ('p_df', pvalue[start:end]), ('q_df', qvalue[start:end]), ('r_df', ratioNLL[start:end])]:
+                    addPositions(p.DataFrame(np.asarray(values),index=contig_names),position).to_csv(files[name], header=first)
+                start = end
+        finally:
+            for name in files:
+                files[name].close()
+        
+        tran_Matrix = tran_Matrix / tran_Matrix.sum(axis=1)[:,np.newaxis]
+        p.DataFrame(tran_Matrix).to_csv(output_stub+"tran_df.csv")
+    finally:
+        shutil.rmtree(work_dir)
+    
+    logging.info('Selected %d of %d variant positions' % (NS, V))
+    return NS
+
 def main(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument("variant_file", help="input SNP frequencies")
@@ -467,8 +828,17 @@ def main(argv):
     parser.add_argument('-s','--random_seed',default=23724839, type=int, 
         help=("specifies seed for numpy random number generator defaults to 23724839"))
     
+    parser.add_argument('--workers', type=int, default=1,
+        help=("filter contig shards on this many processes defaults to 1"))
+    
+    parser.add_argument('--chunk_size', type=int, 
+        help=("stream the table in chunks of this many positions so memory is bounded by the chunk size, not with -c"))
+    
     args = parser.parse_args()
     
+    if args.chunk_size is not None and args.cog_filter:
+        parser.error('COG filtering needs the whole table so cannot be combined with --chunk_size')
+    
     variant_file = args.variant_file
     
     min_coverage = args.min_coverage
@@ -505,6 +875,14 @@ def main(argv):
     if args.min_variant_freq is not None:
         min_variant_freq = args.min_variant_freq
         
+    if args.chunk_size is not None:
+        logging.info('Begun streaming filter of variants with parameters: optimise probability = %s, lr threshold = %s, min. coverage = %s, q-value threshold = %s, min. variant frequency = %s' % (optimiseP, filter_variants, min_coverage, 
+            max_qvalue, min_variant_freq))
+        filter_stream(variant_file, output_stub, args.chunk_size, optimise = optimiseP, threshold = filter_variants, 
+            min_coverage = min_coverage, qvalue_cutoff = max_qvalue, min_p = min_variant_freq)
+        logging.info("Completed variant filtering")
+        return
+    
     #read in snp variants
     #import ipdb; ipdb.set_trace()
     variants    = p.read_csv(variant_file, header=0, index_col=0)
@@ -520,7 +898,7 @@ def main(argv):
     
     logging.info('Begun filtering variants with parameters: optimise probability = %s, lr threshold = %s, min. coverage = %s, q-value threshold = %s, min. variant frequency = %s' % (optimiseP, filter_variants, min_coverage, 
         max_qvalue, min_variant_freq))
-    snps_filter = variant_Filter.get_filtered_VariantsLogRatio()
+    snps_filter = variant_Filter.get_filtered_VariantsLogRatio(workers = args.workers)
     logging.info("Completed variant filtering")       
     transition_matrix = variant_Filter.calc_Error_Matrix()
     
@@ -0,0 +1,215 @@
+"""Synthetic strain mixture benchmark, generates base counts from known tau, gamma and
+eta then times each stage writing per stage throughput and peak RSS as JSON, and compares
+the iterations and seconds each NTF solver takes to converge:
+
+    python -m desman.bench -V 5000 -S 20 -G 5 -o bench.json
+"""
+import sys, getopt
+import os
+import time
+import json
+import resource
+import argparse
+import logging
+import pandas as p
+import numpy as np
+
+from numpy.random import RandomState
+
+#user defined modules
+from . import Variant_Filter as vf
+from . import Init_NMFT as inmft
+from . import HaploSNP_Sampler as hsnp
+from . import Eta_Sampler as es
+
+#C code for tau sampling
+import sampletau
+
+def generate(V, S, G, randomState, coverage=50.0, error=0.01, variable=0.5, contig_length=50):
+    """Returns a variants DataFrame in the desman frequency format of V positions in S
+    samples mixed from G strains together with the true tau VXGX4, gamma SXG and eta.
+    A fraction variable of positions differ between strains, the rest are shared,
+    each position has Poisson(coverage) reads per sample and bases are misread with
+    probability error spread evenly over the other three"""
+    bases = randomState.randint(0, 4, (V,G))
+    shared = randomState.rand(V) > variable
+    bases[shared] = bases[shared,0:1]
+    tau = np.zeros((V,G,4), dtype=np.int)
+    tau[np.arange(V)[:,np.newaxis],np.arange(G)[np.newaxis,:],bases] = 1
+
+    gamma = randomState.dirichlet(np.ones(G), size=S)
+    eta = (1.0 - error)*np.identity(4) + (error/3.0)*(np.ones((4,4)) - np.identity(4))
+
+    prob = np.einsum('vgb,sg,ba->vsa', tau, gamma, eta)
+    cov = randomState.poisson(coverage, (V,S))
+
+    #multinomial counts by sequential binomials on the remaining reads
+    counts = np.zeros((V,S,4), dtype=np.int)
+    remaining = cov
+    remaining_prob = np.ones((V,S))
+    for a in range(3):
+        p_a = np.clip(prob[:,:,a]/np.maximum(remaining_prob,1.0e-12), 0.0, 1.0)
+        counts[:,:,a] = randomState.binomial(remaining, p_a)
+        remaining = remaining - counts[:,:,a]
+        remaining_prob = remaining_prob - prob[:,:,a]
+    counts[:,:,3] = remaining
+
+    columns = ['Sample%d-%s' % (s, b) for s in range(S) for b in 'ACGT']
+    variants = p.DataFrame(np.reshape(counts,(V,S*4)), columns=columns,
+                           index=['contig%d' % (v // contig_length) for v in range(V)])
+    variants.insert(0, 'Position', np.arange(V) % contig_length)
+    variants.index.name = 'Contig'
+
+    return (variants, tau, gamma, eta)
+
+def peak_rss():
+    """Peak resident set size of this process in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def time_stage(results, name, units, calls, function):
+    """Runs function calls times recording seconds, throughput in units per second and
+    the process peak RSS so far, which is cumulative over the stages run before"""
+    start = time.perf_counter()
+    for call in range(calls):
+        function()
+    seconds = time.perf_counter() - start
+
+    results[name] = {'seconds' : seconds, 'calls' : calls, 'throughput' : units*calls/max(seconds,1.0e-12),
+                     'peak_rss' : peak_rss()}
+    logging.info('Bench %s: %.3fs for %d calls, %.1f positions.samples/s' % (name, seconds, calls, results[name]['throughput']))
+
+def compare_solvers(snps, G, seed, max_iter=1000, min_change=1.0e-5):
+    """Runs every Init_NMFT solver from the same random start, returning for each the 
+    iterations, seconds and divergence at convergence together with the iterations and 
+    seconds it took to reach the final divergence of plain multiplicative updates"""
+    solvers = {}
+    for solver in inmft.Init_NMFT.SOLVERS:
+        init_NMFT = inmft.Init_NMFT(snps, G, RandomState(seed), max_iter = max_iter, min_change = min_change, solver = solver)
+        start = time.perf_counter()
+        init_NMFT.factorize()
+        solvers[solver] = {'seconds' : time.perf_counter() - start, 'iterations' : init_NMFT.n_iter,
+                           'divergence' : init_NMFT.divergence, 'trace' : init_NMFT.trace}
+
+    target = solvers['mu']['divergence']
+    for solver in solvers:
+        reached = [(iter, seconds) for (iter, seconds, div) in solvers[solver].pop('trace') if div <= target]
+        (solvers[solver]['iterations_to_mu'], solvers[solver]['seconds_to_mu']) = reached[0] if len(reached) > 0 else (None, None)
+        logging.info('Bench NTF solver %s: %d iterations %.3fs to div = %f, reached multiplicative update div after %s iterations' %
+                     (solver, solvers[solver]['iterations'], solvers[solver]['seconds'], solvers[solver]['divergence'], solvers[solver]['iterations_to_mu']))
+
+    return solvers
+
+def run_bench(V, S, G, seed=23724839, coverage=50.0, error=0.01, variable=0.5, iterations=5,
+              ntf_iter=100, assign_positions=1000, gene_positions=50, solver_iter=1000):
+    """Generates synthetic data and times the filter, NTF, Gibbs kernels, assignTau and
+    Eta_Sampler stages returning a dict of parameters and per stage results"""
+    prng = RandomState(seed)
+    sampletau.initRNG()
+    sampletau.setRNG(seed)
+
+    (variants, tau, gamma, eta) = generate(V, S, G, prng, coverage=coverage, error=error,
+                                           variable=variable, contig_length=gene_positions)
+    snps = np.ascontiguousarray(np.reshape(variants.values[:,1:],(V,S,4)).astype(np.int))
+
+    results = {}
+
+    variant_Filter = vf.Variant_Filter(variants, randomState = RandomState(238329), min_coverage = 0.0)
+    time_stage(results, 'filter', V*S, 1, variant_Filter.get_filtered_VariantsLogRatio)
+
+    init_NMFT = inmft.Init_NMFT(snps, G, prng, max_iter = ntf_iter, min_change = 0.0)
+    time_stage(results, 'ntf', V*S*ntf_iter, 1, init_NMFT.factorize)
+
+    ntf_solvers = compare_solvers(snps, G, seed, max_iter = solver_iter) if solver_iter > 0 else None
+
+    haplo_SNP = hsnp.HaploSNP_Sampler(snps, G, prng, max_iter = 1)
+    haplo_SNP.tau = np.copy(tau, order='C')
+    haplo_SNP.gamma = np.copy(gamma, order='C')
+    haplo_SNP.eta = np.copy(eta, order='C')
+
+    time_stage(results, 'sampleMu', V*S, iterations, lambda: haplo_SNP.sampleMu(haplo_SNP.tau, haplo_SNP.gamma, haplo_SNP.eta))
+    time_stage(results, 'sampleTau', V*S, iterations, lambda: sampletau.sample_tau(haplo_SNP.tau, haplo_SNP.gamma, haplo_SNP.eta, haplo_SNP.variants))
+    time_stage(results, 'likelihood', V*S, iterations, lambda: haplo_SNP.logLikelihood(haplo_SNP.gamma, haplo_SNP.tau, haplo_SNP.eta))
+
+    N = min(assign_positions, V)
+    haplo_SNP.gamma_star = gamma
+    haplo_SNP.eta_star = eta
+    time_stage(results, 'assignTau', N*S, 1, lambda: haplo_SNP.assignTau(np.reshape(snps[:N],(N,S*4))))
+
+    #genes are the contigs each present in a random subset of strains
+    genes = variants.index.unique().tolist()
+    C = len(genes)
+    gene_eta = (prng.rand(C,G) < 0.8).astype(np.float)
+    delta = gamma*coverage
+    covs = p.DataFrame(prng.poisson(np.dot(gene_eta, np.transpose(delta))).astype(np.float),
+                       index=genes, columns=['Sample%d' % s for s in range(S)])
+    sd = np.sqrt(delta.sum(axis=1))
+
+    eta_Sampler = es.Eta_Sampler(prng, variants.drop('Position', axis=1), covs, gamma, delta, sd, eta, gene_eta,
+                                 max_iter = iterations)
+    time_stage(results, 'etaSampler', V*S*iterations, 1, eta_Sampler.update)
+
+    parameters = {'V' : V, 'S' : S, 'G' : G, 'seed' : seed, 'coverage' : coverage, 'error' : error,
+                  'variable' : variable, 'iterations' : iterations, 'ntf_iter' : ntf_iter,
+                  'assign_positions' : N, 'genes' : C, 'solver_iter' : solver_iter}
+
+    sampletau.freeRNG()
+
+    return {'parameters' : parameters, 'stages' : results, 'ntf_solvers' : ntf_solvers, 'peak_rss' : peak_rss()}
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m desman.bench')
+
+    parser.add_argument('-V','--positions', type=int, default=2000,
+        help=("number of variant positions defaults to 2000"))
+
+    parser.add_argument('-S','--samples', type=int, default=20,
+        help=("number of samples defaults to 20"))
+
+    parser.add_argument('-G','--genomes', type=int, default=4,
+        help=("number of strains defaults to 4"))
+
+    parser.add_argument('-c','--coverage', type=float, default=50.0,
+        help=("mean coverage per position and sample defaults to 50"))
+
+    parser.add_argument('-e','--error', type=float, default=0.01,
+        help=("base misread probability defaults to 0.01"))
+
+    parser.add_argument('-i','--iterations', type=int, default=5,
+        help=("calls per Gibbs kernel and Eta_Sampler iterations defaults to 5"))
+
+    parser.add_argument('-n','--ntf_iter', type=int, default=100,
+        help=("NTF iterations defaults to 100"))
+
+    parser.add_argument('-t','--solver_iter', type=int, default=1000,
+        help=("maximum iterations when comparing NTF solvers to convergence, 0 to skip, defaults to 1000"))
+
+    parser.add_argument('-a','--assign_positions', type=int, default=1000,
+        help=("positions passed to assignTau defaults to 1000"))
+
+    parser.add_argument('-s','--random_seed', type=int, default=23724839,
+        help=("seed for data generation and samplers"))
+
+    parser.add_argument('-f','--freq_file', type=str,
+        help=("also write the generated counts in desman frequency format"))
+
+    parser.add_argument('-o','--output_file', type=str, default="bench.json",
+        help=("JSON results file defaults to bench.json"))
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+
+    if args.freq_file is not None:
+        (variants, tau, gamma, eta) = generate(args.positions, args.samples, args.genomes, RandomState(args.random_seed),
+                                               coverage=args.coverage, error=args.error)
+        variants.to_csv(args.freq_file)
+
+    results = run_bench(args.positions, args.samples, args.genomes, seed=args.random_seed, coverage=args.coverage,
+                        error=args.error, iterations=args.iterations, ntf_iter=args.ntf_iter,
+                        assign_positions=args.assign_positions, solver_iter=args.solver_iter)
+
+    with open(args.output_file, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -44,6 +44,21 @@ void c_freeRNG()
     gsl_rng_free (ptGSLRNG);
 }
 
+size_t c_sizeRNGState()
+{
+    return gsl_rng_size (ptGSLRNG);
+}
+
+void c_getRNGState(unsigned char *acState)
+{
+    memcpy(acState, gsl_rng_state (ptGSLRNG), gsl_rng_size (ptGSLRNG));
+}
+
+void c_setRNGState(unsigned char *acState)
+{
+    memcpy(gsl_rng_state (ptGSLRNG), acState, gsl_rng_size (ptGSLRNG));
+}
+
 
 void normaliseLog4(double *adLogProb)
 {
@@ -18,6 +18,12 @@ cdef extern void c_setRNG(unsigned long int seed)
 
 cdef extern void c_freeRNG()
 
+cdef extern size_t c_sizeRNGState()
+
+cdef extern void c_getRNGState(unsigned char *acState)
+
+cdef extern void c_setRNGState(unsigned char *acState)
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 def initRNG():
@@ -33,6 +39,27 @@ def setRNG(int seed):
 def freeRNG():
     c_freeRNG()
 
+def getRNGState():
+    """
+    getRNGState ()
+    Returns a copy of the GSL random number generator state as a 1-d numpy array of np.uint8
+    """
+    cdef np.ndarray[np.uint8_t, ndim=1, mode="c"] state = np.zeros(c_sizeRNGState(), dtype=np.uint8)
+    
+    c_getRNGState(&state[0])
+    
+    return state
+
+def setRNGState(np.ndarray[np.uint8_t, ndim=1, mode="c"] state not None):
+    """
+    setRNGState (state)
+    Restores a GSL random number generator state returned by getRNGState
+    """
+    if state.shape[0] != c_sizeRNGState():
+        raise ValueError("RNG state has %d bytes expected %d" % (state.shape[0], c_sizeRNGState()))
+    
+    c_setRNGState(&state[0])
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 def sample_tau(np.ndarray[long, ndim=3, mode="c"] tau not None, np.ndarray[double, ndim=2, mode="c"] pi not None, 
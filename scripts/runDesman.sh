@@ -11,11 +11,5 @@ echo $stub
 echo $eFile
 echo $oFile
 
-for g in 2 3 4 5 6 7 8  
-do
-	for r in 0 1 2 3 4
-        do
-		echo $g
-        	desman $varFile -e $eFile -o ${stub}_${g}_${r} -i 500 -g $g -s $r -r 1000 > ${stub}_${g}_${r}.out&  
-        done
-done
+#single process sweep over genomes 2-8 and seeds 0-4 sharing the filtered variants
+desman sweep $varFile -e $eFile -o ${stub} -i 500 -g 2-8 -s 0-4 -r 1000 > ${stub}_sweep.out
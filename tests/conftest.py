@@ -0,0 +1,20 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+DESMAN = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bin', 'desman')
+
+@pytest.fixture
+def desman():
+    """Runs bin/desman, or a subcommand of it, on a variant file writing to output with further options"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(os.path.dirname(DESMAN), os.pardir)] + 
+                                        [path for path in [env.get('PYTHONPATH')] if path])
+    
+    def run(variant_file, output, options, command=None):
+        subprocess.check_call([sys.executable, DESMAN] + ([command] if command is not None else []) + 
+                              [str(variant_file), '-o', str(output)] + options, env=env)
+    
+    return run
@@ -0,0 +1,44 @@
+"""Chunked assignment of not selected positions against the serial assignment"""
+import numpy as np
+import pandas as p
+import pytest
+
+from numpy.random import RandomState
+
+from desman import bench
+
+V = 600
+S = 10
+G = 3
+SEED = 23724839
+
+def read_fit(output):
+    with open(str(output / 'fitP.txt')) as fit_file:
+        fields = fit_file.readline().strip().split(',')
+    return (float(fields[3]), float(fields[4]))
+
+@pytest.mark.parametrize('chunk', [10, 100000])
+def test_chunked_matches_serial(desman, tmp_path, chunk):
+    (variants, tau, gamma, eta) = bench.generate(V, S, G, RandomState(SEED), contig_length=100)
+    variants.to_csv(str(tmp_path / 'variants.freq'))
+    options = ['-g', str(G), '-i', '20', '-r', '100', '-s', '1']
+    
+    desman(tmp_path / 'variants.freq', tmp_path / 'serial', options)
+    desman(tmp_path / 'variants.freq', tmp_path / 'chunked', options + ['--ns_workers', '2', '--ns_chunk', str(chunk)])
+    
+    #the selected positions are fitted before assignment so agree exactly
+    for name in ['Gamma_star.csv', 'Eta_star.csv', 'Filtered_Tau_star.csv']:
+        serial = p.read_csv(str(tmp_path / 'serial' / name), header=0, index_col=0)
+        chunked = p.read_csv(str(tmp_path / 'chunked' / name), header=0, index_col=0)
+        assert serial.equals(chunked)
+    
+    serial = p.read_csv(str(tmp_path / 'serial' / 'Collated_Tau_star.csv'), header=0, index_col=0)
+    chunked = p.read_csv(str(tmp_path / 'chunked' / 'Collated_Tau_star.csv'), header=0, index_col=0)
+    assert (serial.index == chunked.index).all()
+    assert np.mean(np.all(serial.values == chunked.values, axis=1)) >= 0.99
+    
+    #chains differ in seed so a position may settle in another strain ordering
+    (lp_serial, dev_serial) = read_fit(tmp_path / 'serial')
+    (lp_chunked, dev_chunked) = read_fit(tmp_path / 'chunked')
+    assert abs(lp_chunked - lp_serial) <= 0.05*abs(lp_serial)
+    assert abs(dev_chunked - dev_serial) <= 0.05*abs(dev_serial)
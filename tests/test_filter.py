@@ -0,0 +1,197 @@
+"""Vectorised, streamed and sharded variant filtering against per position references"""
+import logging
+
+import numpy as np
+import pandas as p
+import pytest
+
+from numpy.random import RandomState
+from scipy.optimize import minimize_scalar
+from scipy.stats import chi2
+
+from desman import bench
+from desman import Variant_Filter as vf
+
+V = 1500
+S = 10
+G = 3
+SEED = 238329
+
+@pytest.fixture(scope='module')
+def variants():
+    (variants, tau, gamma, eta) = bench.generate(V, S, G, RandomState(7), variable=0.1, contig_length=100)
+    return variants
+
+def reference_benjamini_Hochberg(pvalues):
+    """The original loop over p-values sorted as (p-value, index) tuples"""
+    n = float(pvalues.shape[0])
+    new_pvalues = np.zeros(int(n))
+    
+    values = [ (pvalue, i) for i, pvalue in enumerate(pvalues) ]
+    values.sort()
+    values.reverse()
+    new_values = []
+    for i, vals in enumerate(values):
+        rank = n - i
+        pvalue, index = vals
+        new_values.append((n/rank) * pvalue)
+    for i in range(0, int(n)-1):
+        if new_values[i] < new_values[i+1]:
+            new_values[i+1] = new_values[i]
+    for i, vals in enumerate(values):
+        pvalue, index = vals
+        new_pvalues[index] = new_values[i]
+    
+    return new_pvalues
+
+def variant_filter(variants, optimise=True):
+    return vf.Variant_Filter(variants, randomState=RandomState(SEED), optimise=optimise, threshold=3.84, 
+                             min_coverage=5.0, qvalue_cutoff=0.1)
+
+def reference_log_ratio(freq, maxA, maxB, eta, upperP):
+    """Log ratios with the mixture proportion minimised per position by minimize_scalar"""
+    ffreq = freq.astype(np.float64)
+    BLL = - (np.log(eta[maxA,:])*freq).sum(axis=1)
+    p = np.zeros(freq.shape[0])
+    MLL = np.zeros(freq.shape[0])
+    for v in range(freq.shape[0]):
+        res = minimize_scalar(vf.mixNLL, bounds=(0.0, upperP), args = (eta,maxA[v],maxB[v],ffreq[v,:]), method='bounded')
+        p[v] = res.x
+        MLL[v] = vf.mixNLL(p[v],eta,maxA[v],maxB[v],ffreq[v,:])
+    
+    return (p, 2.0*(BLL - MLL))
+
+def test_minimise_mixNLL(variants):
+    variant_Filter = variant_filter(variants)
+    variant_Filter.get_filtered_VariantsLogRatio()
+    freq = variant_Filter.freq
+    maxA = np.argmax(freq,axis=1)
+    maxB = vf.second_base(freq,maxA)
+    
+    for eta in [0.96*np.identity((4)) + 0.01*np.ones((4,4)), variant_Filter.eta]:
+        (p_ref, ratio_ref) = reference_log_ratio(freq, maxA, maxB, eta, variant_Filter.upperP)
+        p = vf.minimise_mixNLL(eta, maxA, maxB, freq.astype(np.float64), variant_Filter.upperP)
+        ratio = vf.log_ratio(freq, maxA, maxB, eta, True, variant_Filter.upperP, variant_Filter.Nthreshold)
+        
+        #bounded Brent stops short of a bound optimum where Newton takes the bound itself
+        #so the batched fit is never worse and agrees closely in the interior
+        assert np.all(ratio >= ratio_ref - 1.0e-8)
+        assert np.allclose(p, p_ref, atol=1.0e-4)
+        interior = np.logical_and(p > 1.0e-3, p < variant_Filter.upperP - 1.0e-3)
+        assert np.allclose(ratio[interior], ratio_ref[interior], rtol=1.0e-8, atol=1.0e-6)
+        assert np.allclose(ratio, ratio_ref, atol=1.0e-2)
+
+def test_filter_selects_as_reference(variants):
+    variant_Filter = variant_filter(variants)
+    variant_Filter.get_filtered_VariantsLogRatio()
+    
+    #the original filter iterating eta with per position proportions
+    reference = variant_filter(variants)
+    freq = reference.freq
+    N = freq.sum(axis=1)
+    maxA = np.argmax(freq,axis=1)
+    maxB = vf.second_base(freq,maxA)
+    eta = reference.eta
+    lastSelect = 0
+    Select = reference.V
+    iter = 0
+    while iter < reference.max_iter and lastSelect != Select:
+        (p_ref, ratio_ref) = reference_log_ratio(freq, maxA, maxB, eta, reference.upperP)
+        filtered = np.logical_or(N < reference.Nthreshold,ratio_ref < reference.threshold)
+        eta = 96*np.identity((4)) + np.ones((4,4))
+        for v in np.flatnonzero(filtered):
+            eta[maxA[v],:] += freq[v,:]
+        eta = eta/eta.sum(axis = 1)[:,np.newaxis]
+        lastSelect = Select
+        Select = reference.V - filtered.sum()
+        iter += 1
+    
+    qvalue = vf.benjamini_Hochberg(1.0 - chi2.cdf(ratio_ref,1))
+    selected = np.logical_not(np.logical_or(N < reference.Nthreshold,qvalue > reference.qvalue_cutoff))
+    
+    assert np.allclose(variant_Filter.eta, eta, rtol=1.0e-12)
+    assert np.allclose(variant_Filter.ratioNLL, ratio_ref, atol=1.0e-2)
+    assert np.array_equal(variant_Filter.selected, selected)
+
+def pvalue_cases():
+    prng = RandomState(SEED)
+    uniform = prng.uniform(size=1000)
+    
+    ties = prng.choice([0.0, 1.0e-8, 0.01, 0.05, 0.5, 1.0], size=1000)
+    
+    zeros = uniform.copy()
+    zeros[prng.choice(1000, 300, replace=False)] = 0.0
+    
+    chi2_ratios = 1.0 - chi2.cdf(prng.exponential(20.0, size=1000), 1)
+    
+    return [('uniform', uniform), ('ties', ties), ('zeros', zeros), ('chi2', chi2_ratios), ('all zero', np.zeros(10)), 
+            ('all one', np.ones(10)), ('single', np.array([0.3])), ('empty', np.zeros(0))]
+
+@pytest.mark.parametrize('name,pvalues', pvalue_cases(), ids=[name for (name, pvalues) in pvalue_cases()])
+def test_benjamini_Hochberg(name, pvalues):
+    expected = reference_benjamini_Hochberg(pvalues)
+    
+    assert np.array_equal(vf.benjamini_Hochberg(pvalues), expected)
+    
+    out = np.full(pvalues.shape[0], -1.0)
+    assert vf.benjamini_Hochberg(pvalues, out=out) is out
+    assert np.array_equal(out, expected)
+
+@pytest.mark.parametrize('name,pvalues', pvalue_cases() + [('nan', np.where(RandomState(SEED).uniform(size=100) < 0.1, np.nan, 0.5))], 
+                         ids=[name for (name, pvalues) in pvalue_cases()] + ['nan'])
+def test_benjamini_Hochberg_stream(name, pvalues, tmp_path):
+    expected = vf.benjamini_Hochberg(pvalues)
+    n = pvalues.shape[0]
+    
+    for chunk_size in sorted(set([1, 2, 3, 7, max(n // 2, 1), max(n, 1), n + 1])):
+        out = np.full(n, -1.0)
+        vf.benjamini_Hochberg_stream(pvalues, out, chunk_size, str(tmp_path))
+        assert np.array_equal(out, expected, equal_nan=True), chunk_size
+
+def filter_files(monkeypatch, variant_file, output_stub, options):
+    monkeypatch.setattr('sys.argv', ['Variant_Filter.py', str(variant_file), '-o', str(output_stub)] + options)
+    vf.main([])
+    
+    files = {}
+    for name in ['sel_var','v_df','p_df','q_df','r_df','tran_df']:
+        with open(str(output_stub) + name + '.csv') as f:
+            files[name] = f.read()
+    return files
+
+@pytest.mark.parametrize('options', [[], ['-p','-f','3.84','-q','0.1']])
+def test_filter_stream_matches_main(variants, monkeypatch, tmp_path, options):
+    n = 60
+    variants[:n].to_csv(str(tmp_path / 'variants.freq'))
+    
+    expected = filter_files(monkeypatch, tmp_path / 'variants.freq', tmp_path / 'memory', options)
+    for chunk_size in [1, 2, 7, n - 1, n, n + 1]:
+        streamed = filter_files(monkeypatch, tmp_path / 'variants.freq', tmp_path / ('stream%d' % chunk_size), 
+                                options + ['--chunk_size', str(chunk_size)])
+        for name in expected:
+            assert streamed[name] == expected[name], (chunk_size, name)
+
+def test_contig_shards(variants):
+    variant_Filter = variant_filter(variants)
+    for shards in [1, 2, 3, 7, 100]:
+        bounds = variant_Filter.contig_shards(shards)
+        assert len(bounds) <= shards
+        assert bounds[0][0] == 0 and bounds[-1][1] == V
+        assert all(end == start for ((s0, end), (start, e1)) in zip(bounds[:-1], bounds[1:]))
+        #shards only break between contigs
+        for (start, end) in bounds[1:]:
+            assert variant_Filter.genes[start - 1] != variant_Filter.genes[start]
+
+@pytest.mark.parametrize('optimise', [True, False])
+def test_workers_match_serial(variants, optimise, caplog):
+    caplog.set_level(logging.INFO)
+    serial = variant_filter(variants, optimise)
+    serial.get_filtered_VariantsLogRatio(workers=1)
+    
+    for workers in [2, 3]:
+        sharded = variant_filter(variants, optimise)
+        sharded.get_filtered_VariantsLogRatio(workers=workers)
+        assert 'contig shards with %d workers' % workers in caplog.text
+        
+        for name in ['eta','ratioNLL','pvalue','qvalue','selected','snps_filter']:
+            assert np.array_equal(getattr(sharded, name), getattr(serial, name)), (workers, name)
+        assert sharded.selected_indices == serial.selected_indices
@@ -0,0 +1,151 @@
+"""Bounds on how far the float32 precision mode drifts from float64 results, run with
+
+    python -m pytest tests
+"""
+import numpy as np
+import pandas as p
+import pytest
+
+from numpy.random import RandomState
+
+from desman import bench
+from desman import Init_NMFT as inmft
+from desman import HaploSNP_Sampler as hsnp
+from desman import Eta_Sampler as es
+
+#C code for tau sampling
+import sampletau
+
+V = 2000
+S = 10
+G = 3
+SEED = 23724839
+
+@pytest.fixture(scope='module')
+def synthetic():
+    (variants, tau, gamma, eta) = bench.generate(V, S, G, RandomState(SEED), contig_length=100)
+    snps = np.ascontiguousarray(np.reshape(variants.values[:,1:],(V,S,4)).astype(np.int64))
+    return (variants, snps, tau, gamma, eta)
+
+@pytest.fixture(scope='module', autouse=True)
+def rng():
+    sampletau.initRNG()
+    yield
+    sampletau.freeRNG()
+
+def factorize(snps, precision):
+    init_NMFT = inmft.Init_NMFT(snps, G, RandomState(SEED), max_iter=300, precision=precision)
+    init_NMFT.factorize()
+    return init_NMFT
+
+def test_ntf_divergence_and_tau(synthetic):
+    (variants, snps, tau, gamma, eta) = synthetic
+    ntf64 = factorize(snps, 'float64')
+    ntf32 = factorize(snps, 'float32')
+    
+    #float64 factors approach zero more slowly from below eps so float32 may fit better
+    assert ntf32.tau.dtype == np.float32
+    assert np.isfinite(ntf32.divergence)
+    assert ntf32.divergence <= ntf64.divergence*(1.0 + 1.0e-3)
+    
+    #strains are unordered so compare recovery of the true tau
+    recovered64 = np.mean(ntf64.get_tau() == tau)
+    recovered32 = np.mean(ntf32.get_tau() == tau)
+    assert recovered32 >= recovered64 - 0.01
+
+def test_ntf_tau_only(synthetic):
+    (variants, snps, tau, gamma, eta) = synthetic
+    fits = []
+    for precision in ['float64','float32']:
+        init_NMFT = inmft.Init_NMFT(snps, G, RandomState(SEED), max_iter=300, precision=precision)
+        init_NMFT.gamma = np.transpose(gamma)
+        init_NMFT.factorize_tau()
+        fits.append(init_NMFT)
+    
+    assert fits[1].divergence <= fits[0].divergence*(1.0 + 1.0e-3)
+    assert np.mean(fits[1].get_tau() == fits[0].get_tau()) >= 0.99
+
+def sampler(snps, gamma, eta, tau, precision):
+    haplo_SNP = hsnp.HaploSNP_Sampler(snps, G, RandomState(SEED), max_iter=1, precision=precision)
+    haplo_SNP.tau = np.copy(tau, order='C')
+    haplo_SNP.gamma_star = np.copy(gamma, order='C')
+    haplo_SNP.eta_star = np.copy(eta, order='C')
+    return haplo_SNP
+
+def test_log_likelihood(synthetic):
+    (variants, snps, tau, gamma, eta) = synthetic
+    ll64 = sampler(snps, gamma, eta, tau, 'float64').logLikelihood(gamma, tau, eta)
+    ll32 = sampler(snps, gamma, eta, tau, 'float32').logLikelihood(gamma, tau, eta)
+    
+    assert abs(ll32 - ll64) <= 1.0e-5*abs(ll64)
+
+def test_assign_tau(synthetic):
+    (variants, snps, tau, gamma, eta) = synthetic
+    assign = np.reshape(snps[:500],(500,S*4))
+    (tau64, conf64) = sampler(snps, gamma, eta, tau, 'float64').assignTau(assign)
+    (tau32, conf32) = sampler(snps, gamma, eta, tau, 'float32').assignTau(assign)
+    
+    assert np.mean(np.all(tau32 == tau64, axis=(1,2))) >= 0.99
+    assert np.max(np.abs(conf32 - conf64)) <= 1.0e-3
+
+def test_eta_sampler_variant_likelihood(synthetic):
+    (variants, snps, tau, gamma, eta) = synthetic
+    genes = variants.index.unique().tolist()
+    delta = gamma*50.0
+    gene_eta = np.ones((len(genes),G))
+    covs = p.DataFrame(np.tile(delta.sum(axis=1),(len(genes),1)), index=genes, columns=['Sample%d' % s for s in range(S)])
+    
+    contribs = []
+    for precision in ['float64','float32']:
+        sampletau.setRNG(SEED)
+        eta_Sampler = es.Eta_Sampler(RandomState(SEED), variants.drop('Position', axis=1), covs, gamma, delta, 
+                                     np.sqrt(delta.sum(axis=1)), eta, gene_eta, max_iter=1, precision=precision)
+        gene = genes[0]
+        sampletau.setRNG(SEED)
+        (logprob, newTau) = eta_Sampler.computeVarLLContrib(gene_eta[0], eta_Sampler.gene_tau[gene], eta_Sampler.gene_variants[gene])
+        contribs.append((logprob, newTau))
+    
+    assert (contribs[0][1] == contribs[1][1]).all()
+    assert abs(contribs[1][0] - contribs[0][0]) <= 1.0e-5*abs(contribs[0][0])
+
+def test_recon_floor():
+    assert inmft.recon_floor(np.float64) == 0.0
+    assert inmft.recon_floor(np.float32) == np.finfo(np.float32).eps
+
+def test_float32_underflowing_tau_starts_at_eps(synthetic):
+    (variants, snps, tau, gamma, eta) = synthetic
+    init_NMFT = inmft.Init_NMFT(snps[:100], G, RandomState(SEED), max_iter=10, precision='float32')
+    init_NMFT.random_initialize()
+    init_NMFT.tau[::2] = 1.0e-60
+    init_NMFT.allocate()
+    
+    assert init_NMFT.tau.min() >= np.finfo(np.float32).eps
+    init_NMFT.div_update()
+    assert np.all(init_NMFT.tau > 0.0)
+
+def test_float32_denormal_reconstruction(synthetic):
+    (variants, snps, tau, gamma, eta) = synthetic
+    init_NMFT = inmft.Init_NMFT(snps[:100], G, RandomState(SEED), max_iter=10, precision='float32')
+    init_NMFT.random_initialize()
+    #strains with denormal weight in every sample give denormal reconstructions
+    init_NMFT.gamma[:] = 1.0e-40
+    init_NMFT.allocate()
+    
+    init_NMFT.div_update()
+    assert np.all(np.isfinite(init_NMFT.tau))
+    assert np.all(np.isfinite(init_NMFT.gamma))
+    assert np.isfinite(init_NMFT.div_objective())
+
+def test_float32_desman_run(synthetic, desman, tmp_path):
+    (variants, snps, tau, gamma, eta) = synthetic
+    variants[:300].to_csv(str(tmp_path / 'variants.freq'))
+    
+    #NTF in float32 hands gamma to the sampler and EM, whose C tau sampling takes float64
+    for options in [[],['-x','5']]:
+        output = tmp_path / ('out%d' % len(options))
+        desman(tmp_path / 'variants.freq', output, ['-g', str(G), '-i', '10', '-s', '1', '--precision', 'float32'] + options)
+        
+        gamma_star = p.read_csv(str(output / 'Gamma_star.csv'), header=0, index_col=0)
+        assert gamma_star.shape == (S,G)
+        assert np.all(np.isfinite(gamma_star.values))
+        assert (output / 'Filtered_Tau_star.csv').exists()
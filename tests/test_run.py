@@ -0,0 +1,91 @@
+"""Filter cache hits and invalidation"""
+import argparse
+import filecmp
+import logging
+import os
+
+import numpy as np
+import pytest
+
+from numpy.random import RandomState
+
+from desman import bench
+from desman import Desman_Run as drun
+
+V = 300
+S = 6
+G = 3
+
+@pytest.fixture
+def variant_file(tmp_path):
+    (variants, tau, gamma, eta) = bench.generate(V, S, G, RandomState(7), variable=0.5, contig_length=100)
+    variants.to_csv(str(tmp_path / 'variants.freq'))
+    return tmp_path / 'variants.freq'
+
+def filter_args(variant_file, filter_cache, **options):
+    args = argparse.Namespace(variant_file=str(variant_file), filter_cache=str(filter_cache), filter_variants=3.84, 
+                              optimiseP=False, min_coverage=5.0, max_qvalue=1.0e-3, min_variant_freq=None, 
+                              random_select=None, eta_file=None, filter_workers=1)
+    vars(args).update(options)
+    return args
+
+def test_filter_cache_hit(variant_file, tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    args = filter_args(variant_file, tmp_path / 'cache')
+    
+    (variants, variant_Filter, random_select) = drun.read_filter(args)
+    assert 'Writing variants and filter to cache' in caplog.text
+    caplog.clear()
+    
+    (cached_variants, cached_Filter, cached_select) = drun.read_filter(args)
+    assert 'Loading variants and filter from cache' in caplog.text
+    assert os.listdir(str(tmp_path / 'cache')) == [drun.filter_key(args)]
+    
+    assert cached_variants.equals(variants)
+    for name in ['snps_filter','selected','eta','qvalue','ratioNLL','sample_filter','position']:
+        assert np.array_equal(getattr(cached_Filter, name), getattr(variant_Filter, name)), name
+    assert cached_Filter.selected_indices == variant_Filter.selected_indices
+    assert cached_Filter.genes == variant_Filter.genes
+
+@pytest.mark.parametrize('option,value', [('filter_variants', 10.0), ('optimiseP', True), ('min_coverage', 20.0), 
+                                          ('max_qvalue', 0.1), ('min_variant_freq', 0.05)])
+def test_filter_cache_invalidated_by_options(variant_file, tmp_path, option, value):
+    args = filter_args(variant_file, tmp_path / 'cache')
+    changed = filter_args(variant_file, tmp_path / 'cache', **{option : value})
+    assert drun.filter_key(changed) != drun.filter_key(args)
+    
+    #options applied after the cached filter share its key
+    unkeyed = filter_args(variant_file, tmp_path / 'cache', random_select=50, filter_workers=2)
+    assert drun.filter_key(unkeyed) == drun.filter_key(args)
+
+def test_filter_cache_invalidated_by_input(variant_file, tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    args = filter_args(variant_file, tmp_path / 'cache')
+    drun.read_filter(args)
+    key = drun.filter_key(args)
+    
+    #the same name with changed contents misses the cache
+    with open(str(variant_file)) as f:
+        lines = f.readlines()
+    with open(str(variant_file), 'w') as f:
+        f.writelines(lines[:-10])
+    caplog.clear()
+    
+    (variants, variant_Filter, random_select) = drun.read_filter(args)
+    assert drun.filter_key(args) != key
+    assert 'Writing variants and filter to cache' in caplog.text
+    assert variants.shape[0] == V - 10
+    assert sorted(os.listdir(str(tmp_path / 'cache'))) == sorted([key, drun.filter_key(args)])
+
+def test_filter_cache_run_outputs(variant_file, desman, tmp_path):
+    options = ['-g', str(G), '-i', '10', '-s', '1', '-f', '-r', '50', '--filter_cache', str(tmp_path / 'cache')]
+    desman(variant_file, tmp_path / 'uncached', options[:-2])
+    desman(variant_file, tmp_path / 'miss', options)
+    desman(variant_file, tmp_path / 'hit', options)
+    assert len(os.listdir(str(tmp_path / 'cache'))) == 1
+    
+    names = [name for name in os.listdir(str(tmp_path / 'uncached')) if name.endswith('.csv') or name.startswith('fit')]
+    assert 'Gamma_star.csv' in names
+    for output in ['miss', 'hit']:
+        (match, mismatch, errors) = filecmp.cmpfiles(str(tmp_path / 'uncached'), str(tmp_path / output), names, shallow=False)
+        assert mismatch == [] and errors == [], output
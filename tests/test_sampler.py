@@ -0,0 +1,188 @@
+"""Tempering and checkpoints of the Gibbs sampler"""
+import multiprocessing
+import subprocess
+
+import numpy as np
+import pytest
+
+from numpy.random import RandomState
+
+from desman import bench
+from desman import HaploSNP_Sampler as hsnp
+from desman import Desman_Utils as du
+
+#C code for tau sampling
+import sampletau
+
+V = 200
+S = 6
+G = 3
+SEED = 23724839
+
+@pytest.fixture(scope='module')
+def synthetic():
+    (variants, tau, gamma, eta) = bench.generate(V, S, G, RandomState(SEED), contig_length=100)
+    snps = np.ascontiguousarray(np.reshape(variants.values[:,1:],(V,S,4)).astype(np.int64))
+    return (variants, snps, tau, gamma, eta)
+
+@pytest.fixture(scope='module', autouse=True)
+def rng():
+    sampletau.initRNG()
+    yield
+    sampletau.freeRNG()
+
+def test_temper_refuses_checkpoint(synthetic, desman, tmp_path):
+    (variants, snps, tau, gamma, eta) = synthetic
+    with pytest.raises(ValueError):
+        hsnp.HaploSNP_Sampler(snps, G, RandomState(SEED), max_iter=10, checkpoint_file=str(tmp_path / 'checkpoint.npz'), temper=2)
+    
+    variants.to_csv(str(tmp_path / 'variants.freq'))
+    for option in ['--resume', '--checkpoint_iter']:
+        with pytest.raises(subprocess.CalledProcessError):
+            desman(tmp_path / 'variants.freq', tmp_path / 'out', ['-g', str(G), '-i', '10', '--temper', '2', option])
+
+def test_sweep_refuses_temper(synthetic, desman, tmp_path):
+    (variants, snps, tau, gamma, eta) = synthetic
+    variants.to_csv(str(tmp_path / 'variants.freq'))
+    with pytest.raises(subprocess.CalledProcessError):
+        desman(tmp_path / 'variants.freq', tmp_path / 'out', ['-g', '2-3', '-s', '0', '-i', '10', '--temper', '2'], command='sweep')
+
+def rounded_log_likelihood(snps, beta, state):
+    """Log likelihood less multinomial coefficients of the sampler a tempered chain runs"""
+    (tau, gamma, eta) = state
+    counts = np.rint(beta*snps).astype(snps.dtype)
+    sampler = hsnp.HaploSNP_Sampler(counts, G, RandomState(SEED), max_iter=1)
+    return sampler.logLikelihood(gamma, tau, eta) - sampler.logMultCoeff
+
+@pytest.mark.parametrize('hot_true', [True, False])
+def test_swap_acceptance(synthetic, hot_true):
+    (variants, snps, tau, gamma, eta) = synthetic
+    betas = np.array([1.0, 0.5])
+    
+    random_tau = np.zeros((V,G,4), dtype=np.int64)
+    random_tau[np.arange(V)[:,np.newaxis],np.arange(G)[np.newaxis,:],RandomState(SEED).randint(4, size=(V,G))] = 1
+    true_state = (np.copy(tau, order='C'), np.copy(gamma, order='C'), np.copy(eta, order='C'))
+    random_state = (random_tau, np.copy(gamma, order='C'), np.copy(eta, order='C'))
+    (cold, hot) = (random_state, true_state) if hot_true else (true_state, random_state)
+    
+    sampler = hsnp.HaploSNP_Sampler(snps, G, RandomState(SEED), max_iter=10, temper=2, temper_beta=betas[1])
+    sampler.setChainState((du.tau_encode(cold[0]), cold[1], cold[2]))
+    sampler.betas = betas
+    sampler.swap_parity = 0
+    sampler.swap_proposed = np.zeros(1, dtype=np.int64)
+    sampler.swap_accepted = np.zeros(1, dtype=np.int64)
+    sampler.chain_states = [None, None]
+    
+    #the hot chain replies with its state and tempered log likelihoods
+    (conn, chain_conn) = multiprocessing.Pipe()
+    sampler.chains = [(None, conn)]
+    hot_state = (du.tau_encode(hot[0]), hot[1], hot[2])
+    chain_conn.send((hot_state, hsnp.tempered_log_likelihoods(snps, betas, hot[0], hot[1], hot[2])))
+    
+    logAccept = (rounded_log_likelihood(snps, betas[0], hot) + rounded_log_likelihood(snps, betas[1], cold) - 
+                 rounded_log_likelihood(snps, betas[0], cold) - rounded_log_likelihood(snps, betas[1], hot))
+    uniform = RandomState()
+    uniform.set_state(sampler.randomState.get_state())
+    accept = np.log(uniform.uniform()) < logAccept
+    
+    sampler.swapChains()
+    
+    assert accept == hot_true
+    assert sampler.swap_proposed[0] == 1
+    assert sampler.swap_accepted[0] == int(accept)
+    assert np.array_equal(sampler.tau, hot[0] if accept else cold[0])
+    if accept:
+        assert np.array_equal(sampler.chain_states[1][0], du.tau_encode(cold[0]))
+    else:
+        assert sampler.chain_states[1] is None
+    
+    chain_conn.close()
+    conn.close()
+
+class Interrupted(Exception):
+    pass
+
+def run_sampler(snps, checkpoint_file, store, thin, interrupt=None, resume=False):
+    """Burn-in then sampling as in Desman_Run.run_desman, raising Interrupted after 
+    interrupt checkpoints have been written"""
+    sampletau.setRNG(SEED)
+    sampler = hsnp.HaploSNP_Sampler(snps, G, RandomState(SEED), max_iter=30, checkpoint_file=checkpoint_file, checkpoint_iter=4,
+                                     store=store, thin=thin, store_file=checkpoint_file + '.tau_store.dat')
+    if interrupt is not None:
+        written = []
+        writeCheckpoint = sampler.writeCheckpoint
+        def interrupted(iter):
+            writeCheckpoint(iter)
+            written.append(iter)
+            if len(written) == interrupt:
+                raise Interrupted()
+        sampler.writeCheckpoint = interrupted
+    
+    start_iter = 0
+    if resume:
+        start_iter = sampler.readCheckpoint(checkpoint_file)
+    else:
+        sampler.updateTauIndices()
+    
+    if sampler.n_update == 0:
+        sampler.update(20, start_iter=start_iter)
+        sampler.removeDegenerate()
+        start_iter = 0
+    sampler.update(start_iter=start_iter)
+    
+    return sampler
+
+@pytest.mark.parametrize('store,thin', [('full',1), ('compact',3), ('stream',2)])
+@pytest.mark.parametrize('interrupt', [2, 7])
+def test_resume_matches_uninterrupted(synthetic, tmp_path, store, thin, interrupt):
+    (variants, snps, tau, gamma, eta) = synthetic
+    snps = np.copy(snps[:60], order='C')
+    complete = run_sampler(snps, str(tmp_path / 'complete.npz'), store, thin)
+    
+    #interrupted in the burn-in or the sampling update
+    checkpoint_file = str(tmp_path / 'checkpoint.npz')
+    with pytest.raises(Interrupted):
+        run_sampler(snps, checkpoint_file, store, thin, interrupt=interrupt)
+    resumed = run_sampler(snps, checkpoint_file, store, thin, resume=True)
+    
+    for name in ['tau','gamma','eta','tau_star','gamma_star','eta_star','ll_store','gamma_store','eta_store',
+                 'tau_store','mu_store','E_store']:
+        assert np.array_equal(getattr(resumed, name), getattr(complete, name)), name
+    assert resumed.lp_star == complete.lp_star
+    assert resumed.iter_star == complete.iter_star
+    
+    #checkpoints no longer hold the bulky stores
+    state = du.read_checkpoint(checkpoint_file)
+    assert not set(hsnp.HaploSNP_Sampler.BULK_STORES) & set(state.keys())
+
+def reference_assign(sampler, assign, u):
+    """The original assignTau over all states at once inverting the cumulative state 
+    probabilities at uniforms u"""
+    variants = np.reshape(assign, (assign.shape[0],S,4))
+    siteProb = np.einsum('tjk,lj,km->tlm', du.tau_states(G), sampler.gamma_star, sampler.eta_star)
+    stateLogProb = np.einsum('nlm,tlm->nt', variants, np.log(siteProb))
+    
+    dP = np.exp(stateLogProb - np.max(stateLogProb, axis=1)[:,np.newaxis])
+    dP = dP/np.sum(dP, axis=1)[:,np.newaxis]
+    tsample = np.argmax(np.cumsum(dP, axis=1) > u[:,np.newaxis], axis=1)
+    
+    return (du.tau_states(G)[tsample], np.max(dP, axis=1))
+
+@pytest.mark.parametrize('tau_block,position_block', [(64, 1024), (5, 7), (1, 1), (13, 100)])
+def test_blocked_assign_tau(synthetic, tau_block, position_block):
+    (variants, snps, tau, gamma, eta) = synthetic
+    sampler = hsnp.HaploSNP_Sampler(snps, G, RandomState(SEED), max_iter=1, tau_block=tau_block, position_block=position_block)
+    sampler.gamma_star = np.copy(gamma, order='C')
+    sampler.eta_star = np.copy(eta, order='C')
+    
+    #low coverage counts leave several probable states to sample between
+    for assign in [np.reshape(snps, (V,S*4)), np.reshape(snps // 25, (V,S*4))]:
+        #one uniform per position drawn in position order whatever the blocks
+        u = RandomState()
+        u.set_state(sampler.randomState.get_state())
+        (tau_ref, conf_ref) = reference_assign(sampler, assign, u.uniform(size=V))
+        
+        (tau_assign, conf) = sampler.assignTau(assign)
+        
+        assert np.array_equal(tau_assign, tau_ref)
+        assert np.allclose(conf, conf_ref, rtol=1.0e-10)
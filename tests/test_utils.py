@@ -0,0 +1,38 @@
+"""Base 4 tau state enumeration"""
+import numpy as np
+import pytest
+
+from numpy.random import RandomState
+
+from desman import Desman_Utils as du
+
+def cartesian_states(G):
+    """All TXGX4 tau states enumerated from the cartesian product of bases"""
+    bases = du.cartesian([np.arange(4)]*G)
+    states = np.zeros((4 ** G,G,4), dtype=np.int64)
+    for t in range(4 ** G):
+        for g in range(G):
+            states[t,g,bases[t,g]] = 1
+    return states
+
+@pytest.mark.parametrize('G', [1, 2, 3, 4, 5])
+def test_tau_states_round_trip(G):
+    states = du.tau_states(G)
+    
+    assert np.array_equal(states, cartesian_states(G))
+    assert np.array_equal(du.tau_encode(states), np.arange(4 ** G))
+    assert np.array_equal(du.tau_decode(du.tau_encode(states), G), states)
+    
+    tau = states[RandomState(G).randint(4 ** G, size=500)]
+    assert np.array_equal(du.tau_decode(du.tau_encode(tau), G), tau)
+    
+    for (start, end) in [(0, 1), (3, 4 ** G), (4 ** G - 1, 4 ** G)]:
+        assert np.array_equal(du.tau_states(G, start, end), states[start:end])
+
+@pytest.mark.parametrize('block_size', [1, 7, 64, 5000])
+def test_tau_state_blocks(block_size):
+    G = 4
+    blocks = list(du.tau_state_blocks(G, block_size))
+    
+    assert [start for (start, block) in blocks] == list(range(0, 4 ** G, block_size))
+    assert np.array_equal(np.concatenate([block for (start, block) in blocks]), du.tau_states(G))